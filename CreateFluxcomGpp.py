@@ -1,41 +1,103 @@
-import xarray as xr
-import zarr
 import numpy as np
 import os
 import glob
-from dask.distributed import Client
-from dask.diagnostics import ProgressBar
+from zarrconverter import cli, dryrun, runreport, subset
 
 def main():
 
-    client = Client(n_workers=8, threads_per_worker=4, memory_limit='10GB')
-    # client = Client(n_workers=2, threads_per_worker=2, memory_limit='8GB')
-    # link to dashboard
-    print(client.dashboard_link)
+    parser = cli.converter_parser("Convert FLUXCOM-X GPP daily data to Zarr format.")
+    args = parser.parse_args()
+    if args.readers is not None and args.no_index:
+        parser.error("--readers reads through the file index, it can not be combined with --no-index")
+    report = runreport.RunReport(os.path.basename(__file__), progress=args.progress)
 
     netcdf_dir = "Fluxcom-X-GPP-daily-0.25deg"
-    zarr_dir = "Fluxcom-X-GPP-daily-0.25deg-100x720x1440.zarr"
+    zarr_dir = args.output or "Fluxcom-X-GPP-daily-0.25deg-100x720x1440.zarr"
 
-    filelist = glob.glob(os.path.join(netcdf_dir,"*.nc"))
-    ds = xr.open_mfdataset(filelist,
-                           combine='by_coords',
-                           chunks={}
-    )
+    with report.stage("discover files"):
+        filelist = glob.glob(os.path.join(netcdf_dir,"*.nc"))
+    report.read_files(filelist)
+    chunks = {'time': 100, 'lat': 720, 'lon': 1440}
+    if args.plan:
+        # only the file names and the index (or the headers) of the files are read, nothing is converted
+        index = None if args.no_index else os.path.join(netcdf_dir, dryrun.INDEX_NAME)
+        inputs = dryrun.netcdfs(filelist, index, time_range=args.time_range, variables=args.variables,
+                                bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, chunks, args.access, args.chunk_bytes,
+                    shards=cli.shards(args), levels=args.pyramid, zarr_dir=zarr_dir, aggregates=args.aggregate,
+                    precisions=args.precision)
+        return
+
+    # the converters need xarray, dask and zarr, their import takes seconds and is not needed for --plan
+    import xarray as xr
+    import numcodecs
+    from zarrconverter import checkpoint, chunkplan, cluster, codectuning, fileindex, objectstore, precision, readerpool, verify
+    report.path = args.report or objectstore.local_path(zarr_dir, ".report.json")
+    readers = None
+    if args.readers is not None:
+        # the files are decoded by the reader processes, the tasks compress and write in threads of this script
+        with report.stage("start readers"):
+            readers = readerpool.start(args.readers or None)
+    with report.stage("open files"):
+        if args.no_index:
+            # files outside of --time-range are never opened for their data
+            filelist = subset.netcdf_files(filelist, args.time_range)
+            ds = xr.open_mfdataset(filelist,
+                                   combine='by_coords',
+                                   chunks={}
+            )
+        else:
+            # only new and changed files are opened, everything else comes from the index next to the files
+            index = fileindex.load(filelist)
+            index.reader = readers
+            filelist = subset.netcdf_files(filelist, args.time_range, index)
+            ds = index.open_mfdataset(filelist,
+                                      combine='by_coords',
+                                      chunks={}
+            )
+        # only the chunks of the files inside --bbox are decoded
+        ds = subset.select(ds, args.bbox, args.bbox_crs, args.time_range, args.variables)
 
     encoding = {vname: {
-        'compressor': zarr.Blosc(cname='zstd', clevel=5),
+        'compressor': numcodecs.Blosc(cname='zstd', clevel=5),
         } for vname in ds.data_vars}
+    if args.tune_codecs:
+        with report.stage("tune codecs"):
+            encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, ".codecs.json"))
+    if args.precision:
+        with report.stage("precision"):
+            ds, encoding = precision.apply(ds, encoding, args.precision)
     ds.attrs["history"] = "converted to zarr by Martin Reinhardt, RSC4Earth, University of Leipzig"
 
-    ds["GPP"].attrs["_FillValue"] = np.nan
-    ds["land_fraction"].attrs["_FillValue"] = np.nan
-    ds["GPP"] = ds["GPP"].chunk({'time': 100, 'lat': 720, 'lon': 1440})
-    ds["land_fraction"] = ds["land_fraction"].chunk({'time': 100, 'lat': 720, 'lon': 1440})
+    for vname in ds.data_vars:
+        ds[vname].attrs["_FillValue"] = np.nan
+    with report.stage("build graph"):
+        if args.access:
+            chunks = chunkplan.plan_dataset(ds, args.chunk_bytes, args.access)
+        for vname in ds.data_vars:
+            ds[vname] = ds[vname].chunk(chunks)
+    chunkplan.report(ds)
 
-    with ProgressBar():
-        ds.to_zarr(zarr_dir, mode="w", consolidated=True, compute=True, encoding=encoding)
+    client = None
+    if not args.verify_only:
+        # netCDF reads are serialized by the HDF5 lock of a process, so the cluster gets many single threaded workers
+        if readers is None:
+            with report.stage("start cluster"):
+                client = cluster.start("hdf5", cluster.task_memory(ds), **cli.cluster(args))
+        checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=args.resume, report=report,
+                           shards=cli.shards(args), overviews=cli.overviews(args), storage=cli.storage(args),
+                           aggregates=cli.aggregates(args))
+        report.measure_memory(client)
+    verified = None
+    if args.verify or args.verify_only:
+        verified = verify.verify(ds, zarr_dir, *args.tolerance, report=report,
+                                 storage_options=args.storage_options)
 
-    client.close()
+    cluster.stop(client)
+    readerpool.stop(readers)
+    report.write()
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The zarr store does not match the source files, see " + verify.manifest_path(zarr_dir))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
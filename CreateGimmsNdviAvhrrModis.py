@@ -1,32 +1,27 @@
-import xarray as xr
 import numpy as np
-import rioxarray
-import zarr
 import os
 import glob
 import datetime
 import warnings
-from dask.distributed import Client
-from dask.diagnostics import ProgressBar
+from zarrconverter import aggregate, cli, dryrun, runreport, subset
 
 def main():
+
+    parser = cli.converter_parser("Convert GIMMS NDVI AVHRR MODIS consolidated data to Zarr format.", tiff=True, packed=True)
+    args = parser.parse_args()
+    report = runreport.RunReport(os.path.basename(__file__), progress=args.progress)
     
     print("Converting GIMMS NDVI AVHRR MODIS consolidated data to Zarr format...")
     
     warnings.filterwarnings("ignore", category=UserWarning)
     
-    client = Client(n_workers=8, threads_per_worker=4, memory_limit='10GB')
-    # client = Client(n_workers=2, threads_per_worker=2, memory_limit='8GB')
-    # link to dashboard
-    print("Dashboard available under: " + str(client.dashboard_link))
-
     # Set the directory where the data is stored
     tiff_dir = "PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022"
-    zarr_dir = "PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022_1x4320x2160.zarr"
+    zarr_dir = args.output or "PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022_1x4320x2160.zarr"
     fill_value_old = 65535 # fill value in the original data from README
     fill_value_new = np.nan
 
-    def CubeFile(file):
+    def FileDate(file):
         # extract date from filename
         date = os.path.basename(file).split("_")[-1]
         date = date.split(".")[0]
@@ -34,29 +29,62 @@ def main():
         month = date[4:6]
         halfmonth = date[6:8]
         day = 8 if halfmonth == "01" else 23
-        cube = xr.open_dataarray(file,
-                                 engine="rasterio",
-                                 chunks={}
-        )
-        cube = cube.where(cube != fill_value_old, fill_value_new)
-        dt = np.datetime64(datetime.datetime(int(year), int(month), int(day)))
-        cube = cube.assign_coords({"time":dt})
-        cube = cube.expand_dims("time")
-        return cube
+        return np.datetime64(datetime.datetime(int(year), int(month), int(day)))
     
-    print("Reading TIFF files...")
+    print("Reading TIFF headers...")
 
-    # Create the new dataset
-    files = glob.glob(tiff_dir + "/*.tif")
-    cube = xr.concat([CubeFile(file) for file in files], dim="time")
-    cube = cube.sortby("time")
-    cube = cube.rename({"x":"lon", "y":"lat"})
-    ds = cube.to_dataset(dim="band")
-    ds = ds.rename_vars({1:"NDVI", 2:"QC"})
+    # Create the new dataset, only the headers are read here and the data is read lazily
+    with report.stage("discover files"):
+        files = glob.glob(tiff_dir + "/*.tif")
+    # files outside of --time-range are never opened
+    files = subset.files_in_time(files, FileDate, args.time_range)
+    report.read_files(files)
+    fill_values = [fill_value_old]
+    # with --packed the fill values are kept and described by attributes instead of replaced by NaN
+    mask_values = None if args.packed else fill_values
+    bands = {1:"NDVI", 2:"QC"}
+    # the aggregates of --aggregate only use the cells whose quality I (second digit of QC) is 0 or 1
+    quality = {"NDVI": aggregate.QualityFlag("QC", digit=2, good=(0, 1))}
+    try:
+        selected = subset.bands(bands, args.variables)
+        if args.aggregate:
+            aggregate.check_quality(quality, selected.values())
+    except ValueError as error:
+        # checked before any file is opened, e.g. --variables NDVI --aggregate without QC
+        parser.error(str(error))
+    chunks = {"time":1, "lat":2160, "lon":4320}
+    if args.plan:
+        # only the file names and the header of the first file are read, nothing is converted
+        inputs = dryrun.tiffs(files, FileDate, selected, masked=mask_values is not None, bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, chunks, args.access, args.chunk_bytes,
+                    args.direct, cli.shards(args), args.pyramid, zarr_dir=zarr_dir,
+                    aggregates=args.aggregate, categorical=("QC",), precisions=args.precision)
+        return
+
+    # the converters need xarray, dask, rasterio and zarr, their import takes seconds and is not needed for --plan
+    import numcodecs
+    from zarrconverter import checkpoint, chunkplan, cluster, codectuning, objectstore, packing, precision, tiffscan, tiffwriter, verify
+    report.path = args.report or objectstore.local_path(zarr_dir, ".report.json")
+    with report.stage("open files"):
+        headers = tiffscan.scan(files, FileDate)
+        # only the tiles inside --bbox are read
+        window = subset.tiff_window(tiffscan.check_grid(headers), args.bbox, args.bbox_crs)
+        cube = tiffscan.open_cube(headers, fill_values=mask_values, y="lat", x="lon", window=window)
+        ds = cube.to_dataset(dim="band")
+        ds = ds.rename_vars(bands)
 
     # set chunking
-    ds["NDVI"] = ds["NDVI"].chunk({"time":1, "lat":2160, "lon":4320})
-    ds["QC"] = ds["QC"].chunk({"time":1, "lat":2160, "lon":4320})
+    with report.stage("build graph"):
+        if args.access:
+            chunks = chunkplan.plan_dataset(ds, args.chunk_bytes, args.access)
+        ds["NDVI"] = ds["NDVI"].chunk(chunks)
+        ds["QC"] = ds["QC"].chunk(chunks)
+    chunkplan.report(ds)
+
+    if not (args.direct or args.verify_only):
+        # the cluster is sized for the blocks of the chunk plan, GDAL reads scale with a few threads per process
+        with report.stage("start cluster"):
+            client = cluster.start("gdal", cluster.task_memory(ds), **cli.cluster(args))
 
     ndvi_attrs = {
         "long_name":"Normalized Difference Vegetation Index",
@@ -72,6 +100,9 @@ def main():
     }
     ds["NDVI"].attrs = ndvi_attrs
     ds["QC"].attrs = qc_attrs
+    if args.packed:
+        ds["NDVI"] = packing.pack(ds["NDVI"], fill_values)
+        ds["QC"] = packing.pack(ds["QC"], fill_values)
     ds.attrs = {
         "title":"PKU GIMMS NDVI AVHRR MODIS consolidated",
         "history":"converted to zarr by Martin Reinhardt, RSC4Earth, University of Leipzig",
@@ -79,17 +110,47 @@ def main():
         "README for QC":"https://zenodo.org/records/8253971/files/Readme_for_PKU_GIMMS_NDVI_Product_updated_20230817.pdf?download=1"
     }
 
-    compressor = zarr.Blosc(cname="zstd", clevel=3, shuffle=2)
+    # only the selected variables are written, the bands of the others are never read
+    ds = subset.variables(ds, args.variables)
+    compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=2)
     encoding = {vname: {
         'compressor': compressor,
         } for vname in ds.data_vars}
+    if args.tune_codecs:
+        with report.stage("tune codecs"):
+            encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, ".codecs.json"))
+    if args.precision:
+        with report.stage("precision"):
+            ds, encoding = precision.apply(ds, encoding, args.precision, categorical=("QC",))
     
-    print("Writing Zarr files...")
+    if not args.verify_only:
+        print("Writing Zarr files...")
 
-    with ProgressBar():
-        ds.to_zarr(zarr_dir, mode="w", consolidated=True, compute=True, encoding=encoding)
+        if args.direct:
+            tiffwriter.to_zarr(ds, zarr_dir, headers, selected, encoding=encoding, fill_values=mask_values,
+                               resume=args.resume, workers=args.workers, report=report,
+                               shards=cli.shards(args),
+                               overviews=cli.overviews(args, categorical=("QC",)), storage=cli.storage(args),
+                               window=window, aggregates=cli.aggregates(args, quality, categorical=("QC",)))
+            report.measure_memory()
+        else:
+            checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=args.resume, report=report,
+                               shards=cli.shards(args),
+                               overviews=cli.overviews(args, categorical=("QC",)), storage=cli.storage(args),
+                               aggregates=cli.aggregates(args, quality, categorical=("QC",)))
+            report.measure_memory(client)
 
-    Client.close(client)
+            cluster.stop(client)
+    verified = None
+    if args.verify or args.verify_only:
+        # the files are read again without the mask of the writer, verify masks the fill values itself
+        source = tiffscan.open_cube(headers, chunks=chunks, y="lat", x="lon", window=window).to_dataset(dim="band")
+        source = subset.variables(source.rename_vars(bands), args.variables)
+        verified = verify.verify(source, zarr_dir, *args.tolerance, workers=args.workers, report=report,
+                                 storage_options=args.storage_options, fill_values=fill_values)
+    report.write()
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The zarr store does not match the source files, see " + verify.manifest_path(zarr_dir))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,67 +1,81 @@
-import xarray as xr
 import numpy as np
-import rioxarray
-import zarr
 import os
 import glob
 import datetime
 import warnings
-from dask.distributed import Client
-from dask.diagnostics import ProgressBar
+from zarrconverter import cli, dryrun, runreport, subset
 
 def main():
+
+    args = cli.converter_parser("Convert GOSIF GPP v2 consolidated data to Zarr format.", tiff=True, packed=True).parse_args()
+    report = runreport.RunReport(os.path.basename(__file__), progress=args.progress)
     
     print("Converting GOSIF GPP v2 consolidated data to Zarr format...")
         
-    client = Client(n_workers=8, threads_per_worker=4, memory_limit='10GB')
-    # client = Client(n_workers=2, threads_per_worker=2, memory_limit='8GB')
-    # link to dashboard
-    print("Dashboard available under: " + str(client.dashboard_link))
-
     # Set the directory where the data is stored
     tiff_dir = "GOSIF-GPP_v2/8day/Mean"
-    zarr_dir = "GOSIF-GPP_v2_2000_2023_1x3600x7200.zarr"
+    zarr_dir = args.output or "GOSIF-GPP_v2_2000_2023_1x3600x7200.zarr"
     fill_value_old_1 = 65535 # fill value in the original data from README
     fill_value_old_2 = 65534 # fill value in the original data from README
     fill_value_new = np.nan
 
-    def CubeFile(file, ref_coords=None):
+    def FileDate(file):
         # extract date from filename
         date = os.path.basename(file).split("_")[-2]
         # date = date.split(".")[0]
         year = date[0:4]
         dayofyear = date[4:7]
-        dt = datetime.datetime(int(year), 1, 1) + datetime.timedelta(int(dayofyear) - 1)
-        cube = xr.open_dataarray(file, 
-                                 engine="rasterio", 
-                                 chunks={}
-        )
-        cube = cube.where(cube != fill_value_old_1, fill_value_new)
-        cube = cube.where(cube != fill_value_old_2, fill_value_new)
-        cube = cube.assign_coords({"time":dt})
-        if ref_coords is not None:
-            x_axis = ref_coords["x"]
-            y_axis = ref_coords["y"]
-            cube = cube.assign_coords({"x": x_axis, "y": y_axis})
-        cube = cube.expand_dims("time")
-        return cube
+        return np.datetime64(datetime.datetime(int(year), 1, 1) + datetime.timedelta(int(dayofyear) - 1))
     
-    print("Reading TIFF files...")
+    print("Reading TIFF headers...")
 
-    # Create the new dataset
-    files = glob.glob(tiff_dir + "/*.tif")
-    files.sort()
-    ref_coords = CubeFile(files[0]).coords
-    cube = xr.concat([CubeFile(file, ref_coords) for file in files], dim="time")
-    cube = cube.sortby("time")
-    cube = cube.rename({"x":"lon", "y":"lat"})
-    ds = cube.to_dataset(dim="band")
-    ds = ds.rename_vars({1:"gpp"})
+    # Create the new dataset, only the headers are read here and the data is read lazily.
+    # Small float differences of the grids are tolerated, all files get the grid of the first one.
+    with report.stage("discover files"):
+        files = glob.glob(tiff_dir + "/*.tif")
+        files.sort()
+    # files outside of --time-range are never opened
+    files = subset.files_in_time(files, FileDate, args.time_range)
+    report.read_files(files)
+    fill_values = [fill_value_old_1, fill_value_old_2]
+    # with --packed the fill values are kept and described by attributes instead of replaced by NaN
+    mask_values = None if args.packed else fill_values
+    bands = {1:"gpp"}
+    selected = subset.bands(bands, args.variables)
+    chunks = {"time":1, "lat":3600, "lon":7200}
+    if args.plan:
+        # only the file names and the header of the first file are read, nothing is converted
+        inputs = dryrun.tiffs(files, FileDate, selected, masked=mask_values is not None, bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, chunks, args.access, args.chunk_bytes,
+                    args.direct, cli.shards(args), args.pyramid, zarr_dir=zarr_dir,
+                    aggregates=args.aggregate, precisions=args.precision)
+        return
+
+    # the converters need xarray, dask, rasterio and zarr, their import takes seconds and is not needed for --plan
+    import numcodecs
+    from zarrconverter import checkpoint, chunkplan, cluster, codectuning, objectstore, packing, precision, tiffscan, tiffwriter, verify
+    report.path = args.report or objectstore.local_path(zarr_dir, ".report.json")
+    with report.stage("open files"):
+        headers = tiffscan.scan(files, FileDate)
+        # only the tiles inside --bbox are read
+        window = subset.tiff_window(tiffscan.check_grid(headers), args.bbox, args.bbox_crs)
+        cube = tiffscan.open_cube(headers, fill_values=mask_values, y="lat", x="lon", window=window)
+        ds = cube.to_dataset(dim="band")
+        ds = ds.rename_vars(bands)
     # cube = cube.sel(band=1).drop_vars("band")
     # ds = cube.to_dataset(name="gpp")
 
     # set chunking
-    ds["gpp"] = ds["gpp"].chunk({"time":1, "lat":3600, "lon":7200})
+    with report.stage("build graph"):
+        if args.access:
+            chunks = chunkplan.plan_dataset(ds, args.chunk_bytes, args.access)
+        ds["gpp"] = ds["gpp"].chunk(chunks)
+    chunkplan.report(ds)
+
+    if not (args.direct or args.verify_only):
+        # the cluster is sized for the blocks of the chunk plan, GDAL reads scale with a few threads per process
+        with report.stage("start cluster"):
+            client = cluster.start("gdal", cluster.task_memory(ds), **cli.cluster(args))
 
     gpp_attrs = {
         "long_name":"Gross Primary Production (GPP) from GOSIF",
@@ -70,23 +84,53 @@ def main():
         "Scale_Factor":0.001,
     }
     ds["gpp"].attrs = gpp_attrs
+    if args.packed:
+        ds["gpp"] = packing.pack(ds["gpp"], fill_values, scale_factor=gpp_attrs["Scale_Factor"])
     ds.attrs = {
         "title":"GOSIF GPP v2",
         "history":"converted to zarr by Martin Reinhardt, RSC4Earth, University of Leipzig",
         "source":"https://climatedataguide.ucar.edu/climate-data/global-dataset-solar-induced-chlorophyll-fluorescence-gosif",
     }
 
-    compressor = zarr.Blosc(cname="zstd", clevel=3, shuffle=2)
+    # only the selected variables are written, the bands of the others are never read
+    ds = subset.variables(ds, args.variables)
+    compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=2)
     encoding = {vname: {
         'compressor': compressor,
         } for vname in ds.data_vars}
+    if args.tune_codecs:
+        with report.stage("tune codecs"):
+            encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, ".codecs.json"))
+    if args.precision:
+        with report.stage("precision"):
+            ds, encoding = precision.apply(ds, encoding, args.precision)
     
-    print("Writing Zarr files...")
+    if not args.verify_only:
+        print("Writing Zarr files...")
 
-    with ProgressBar():
-        ds.to_zarr(zarr_dir, mode="w", consolidated=True, compute=True, encoding=encoding)
+        if args.direct:
+            tiffwriter.to_zarr(ds, zarr_dir, headers, selected, encoding=encoding, fill_values=mask_values,
+                               resume=args.resume, workers=args.workers, report=report,
+                               shards=cli.shards(args), overviews=cli.overviews(args), storage=cli.storage(args),
+                               window=window, aggregates=cli.aggregates(args))
+            report.measure_memory()
+        else:
+            checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=args.resume, report=report,
+                               shards=cli.shards(args), overviews=cli.overviews(args), storage=cli.storage(args),
+                               aggregates=cli.aggregates(args))
+            report.measure_memory(client)
 
-    Client.close(client)
+            cluster.stop(client)
+    verified = None
+    if args.verify or args.verify_only:
+        # the files are read again without the mask of the writer, verify masks the fill values itself
+        source = tiffscan.open_cube(headers, chunks=chunks, y="lat", x="lon", window=window).to_dataset(dim="band")
+        source = subset.variables(source.rename_vars(bands), args.variables)
+        verified = verify.verify(source, zarr_dir, *args.tolerance, workers=args.workers, report=report,
+                                 storage_options=args.storage_options, fill_values=fill_values)
+    report.write()
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The zarr store does not match the source files, see " + verify.manifest_path(zarr_dir))
 
 if __name__ == '__main__':
     main()
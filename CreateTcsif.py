@@ -1,60 +1,78 @@
-import xarray as xr
 import numpy as np
-import rioxarray
-import zarr
 import os
 import glob
 import datetime
 import warnings
-from dask.distributed import Client
-from dask.diagnostics import ProgressBar
+from zarrconverter import cli, dryrun, runreport, subset
 
 def main():
+
+    args = cli.converter_parser("Convert TCSIF to Zarr format.", tiff=True).parse_args()
+    report = runreport.RunReport(os.path.basename(__file__), progress=args.progress)
     
     print("Converting TCSIF to Zarr format...")
     
     warnings.filterwarnings("ignore", category=UserWarning)
     
-    client = Client(n_workers=8, threads_per_worker=4, memory_limit='10GB')
-    # client = Client(n_workers=2, threads_per_worker=2, memory_limit='8GB')
-    # link to dashboard
-    print("Dashboard available under: " + str(client.dashboard_link))
-
     # Set the directory where the data is stored
     tiff_dir = "TCSIF_level3"
-    zarr_dir = "TCSIF_level3_2007_2021_1x360x720.zarr"
+    zarr_dir = args.output or "TCSIF_level3_2007_2021_1x360x720.zarr"
     fill_value_new = np.nan
 
-    def CubeFile(file):
+    def FileDate(file):
         # extract date from filename
         date = os.path.basename(file).split("_")[-1]
         date = date.split(".")[0]
         year = date[0:4]
         month = date[4:6]
         day = 15
-        cube = xr.open_dataarray(file,
-                                    engine="rasterio",
-                                    chunks={}
-        )
-        dt = np.datetime64(datetime.datetime(int(year), int(month), int(day)))
-        cube = cube.assign_coords({"time":dt})
-        cube = cube.expand_dims("time")
-        return cube
+        return np.datetime64(datetime.datetime(int(year), int(month), int(day)))
     
-    print("Reading TIFF files...")
+    print("Reading TIFF headers...")
 
-    # Create the new dataset
-    files = glob.glob(tiff_dir + "/*.tif")
-    cube = xr.concat([CubeFile(file) for file in files], dim="time")
-    cube = cube.sortby("time")
-    cube = cube.rename({"x":"lon", "y":"lat"})
-    ds = cube.to_dataset(dim="band")
-    ds = ds.rename_vars({1:"sif"})
+    # Create the new dataset, only the headers are read here and the data is read lazily
+    with report.stage("discover files"):
+        files = glob.glob(tiff_dir + "/*.tif")
+    # files outside of --time-range are never opened
+    files = subset.files_in_time(files, FileDate, args.time_range)
+    report.read_files(files)
+    fill_values = None
+    bands = {1:"sif"}
+    selected = subset.bands(bands, args.variables)
+    chunks = {"time":1, "lat":360, "lon":720}
+    if args.plan:
+        # only the file names and the header of the first file are read, nothing is converted
+        inputs = dryrun.tiffs(files, FileDate, selected, masked=fill_values is not None, bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, chunks, args.access, args.chunk_bytes,
+                    args.direct, cli.shards(args), args.pyramid, zarr_dir=zarr_dir,
+                    aggregates=args.aggregate, precisions=args.precision)
+        return
+
+    # the converters need xarray, dask, rasterio and zarr, their import takes seconds and is not needed for --plan
+    import numcodecs
+    from zarrconverter import checkpoint, chunkplan, cluster, codectuning, objectstore, precision, tiffscan, tiffwriter, verify
+    report.path = args.report or objectstore.local_path(zarr_dir, ".report.json")
+    with report.stage("open files"):
+        headers = tiffscan.scan(files, FileDate)
+        # only the tiles inside --bbox are read
+        window = subset.tiff_window(tiffscan.check_grid(headers), args.bbox, args.bbox_crs)
+        cube = tiffscan.open_cube(headers, y="lat", x="lon", window=window)
+        ds = cube.to_dataset(dim="band")
+        ds = ds.rename_vars(bands)
     # cube = cube.sel(band=1).drop_vars("band")
     # ds = cube.to_dataset(name="sif")
 
     # set chunking
-    ds["sif"] = ds["sif"].chunk({"time":1, "lat":360, "lon":720})
+    with report.stage("build graph"):
+        if args.access:
+            chunks = chunkplan.plan_dataset(ds, args.chunk_bytes, args.access)
+        ds["sif"] = ds["sif"].chunk(chunks)
+    chunkplan.report(ds)
+
+    if not (args.direct or args.verify_only):
+        # the cluster is sized for the blocks of the chunk plan, GDAL reads scale with a few threads per process
+        with report.stage("start cluster"):
+            client = cluster.start("gdal", cluster.task_memory(ds), **cli.cluster(args))
 
     sif_attrs = {
         "long_name":"solar-induced chlorophyll fluorescence (SIF)",
@@ -68,17 +86,42 @@ def main():
         "source":"https://zenodo.org/records/8242928"
     }
 
-    compressor = zarr.Blosc(cname="zstd", clevel=3, shuffle=2)
+    # only the selected variables are written, the bands of the others are never read
+    ds = subset.variables(ds, args.variables)
+    compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=2)
     encoding = {vname: {
         'compressor': compressor,
         } for vname in ds.data_vars}
+    if args.tune_codecs:
+        with report.stage("tune codecs"):
+            encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, ".codecs.json"))
+    if args.precision:
+        with report.stage("precision"):
+            ds, encoding = precision.apply(ds, encoding, args.precision)
     
-    print("Writing Zarr files...")
+    if not args.verify_only:
+        print("Writing Zarr files...")
 
-    with ProgressBar():
-        ds.to_zarr(zarr_dir, mode="w", consolidated=True, compute=True, encoding=encoding)
+        if args.direct:
+            tiffwriter.to_zarr(ds, zarr_dir, headers, selected, encoding=encoding, fill_values=fill_values,
+                               resume=args.resume, workers=args.workers, report=report,
+                               shards=cli.shards(args), overviews=cli.overviews(args), storage=cli.storage(args),
+                               window=window, aggregates=cli.aggregates(args))
+            report.measure_memory()
+        else:
+            checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=args.resume, report=report,
+                               shards=cli.shards(args), overviews=cli.overviews(args), storage=cli.storage(args),
+                               aggregates=cli.aggregates(args))
+            report.measure_memory(client)
 
-    Client.close(client)
+            cluster.stop(client)
+    verified = None
+    if args.verify or args.verify_only:
+        verified = verify.verify(ds, zarr_dir, *args.tolerance, workers=args.workers, report=report,
+                                 storage_options=args.storage_options)
+    report.write()
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The zarr store does not match the source files, see " + verify.manifest_path(zarr_dir))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
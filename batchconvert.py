@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# This script runs a batch of conversions on one
+# shared dask cluster, see zarrconverter/batch.py
+
+import os
+import sys
+import argparse
+import logging
+from dask.utils import format_bytes, parse_bytes
+from zarrconverter import batch, cluster
+
+def memory_of(client):
+    """Memory of the workers of the cluster, the usable memory of this machine without a cluster"""
+    if client is None:
+        return int(cluster.resources()['memory'] * cluster.MEMORY_FRACTION)
+    return sum(worker['memory_limit'] for worker in client.scheduler_info()['workers'].values())
+
+def main():
+    # setup the argument parser
+    parser = argparse.ArgumentParser(
+                        prog='batchconvert.py',
+                        description='This program runs the conversions of a JSON job file on one long-lived dask cluster. The jobs are started by priority within a memory budget, their tasks share the cluster, failed jobs are retried with --resume.',
+                        epilog='(c) 2024, University of Leipzig, Germany')
+
+    parser.add_argument('jobs', help='The JSON file with the list of jobs, e.g. [{"script": "CreateTcsif.py", "args": ["--packed"], "priority": 1, "memory": "4GB", "retries": 2}]')
+    parser.add_argument('--scheduler', help='Address of a running dask scheduler, \'local\' to start a local cluster sized for this machine (default) or \'synchronous\' to run every job without a cluster')
+    parser.set_defaults(scheduler='local')
+    parser.add_argument('--workload', choices=list(cluster.THREADS), help='The kind of work the local cluster is sized for (default: gdal, a few threads per worker)')
+    parser.set_defaults(workload='gdal')
+    parser.add_argument('--n-workers', type=int, help='The number of worker processes of the local cluster (default: derived from the cores and the memory)')
+    parser.add_argument('--threads-per-worker', type=int, help='The number of threads of every worker of the local cluster (default: derived from --workload)')
+    parser.add_argument('--memory-limit', help='The memory limit of every worker of the local cluster, e.g. 10GB (default: the available memory shared by the workers)')
+    parser.add_argument('--memory', help='The memory shared by the jobs running at the same time, every job needs its "memory" of it (default: the memory of the workers of the cluster)')
+    parser.add_argument('--max-jobs', type=int, help='The maximum number of jobs running at the same time (default: 4)')
+    parser.set_defaults(max_jobs=4)
+    parser.add_argument('--logs', help='The directory for the output of every job (default: the job file with .logs)')
+    parser.add_argument('--report', help='The JSON file with the state, attempts and wall time of every job (default: the job file with .report.json)')
+    parser.add_argument('--interval', type=float, help='Seconds between the progress lines of the running jobs (default: 10)')
+    parser.set_defaults(interval=10.0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output')
+
+    # parsing the arguments
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(levelname)s: %(message)s',
+                            datefmt='%H:%M:%S')
+    try:
+        jobs = batch.load(args.jobs)
+    except ValueError as e:
+        parser.error(str(e))
+    stem = os.path.splitext(args.jobs)[0]
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    # one cluster for all jobs, it is only stopped when the whole batch is finished
+    client = cluster.start(args.workload, 0, args.scheduler, args.n_workers, args.threads_per_worker, args.memory_limit)
+    address = client.scheduler.address if client is not None else 'synchronous'
+    memory = parse_bytes(args.memory) if args.memory else memory_of(client)
+    print('%d jobs, at most %d at the same time within %s' % (len(jobs), args.max_jobs, format_bytes(memory)))
+    try:
+        failed = batch.run(jobs, address, memory, root, args.logs or stem + '.logs', args.report or stem + '.report.json',
+                           args.max_jobs, args.interval)
+    finally:
+        cluster.stop(client)
+
+    if failed:
+        sys.exit('Failed jobs: ' + ', '.join(job.name for job in failed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# This script benchmarks the converters on synthetic
+# input data and writes the results as JSON, so that
+# the results of two versions can be compared
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import platform
+import subprocess
+from datetime import datetime
+import numpy as np
+import xarray as xr
+import dask
+import zarr
+from dask.distributed import LocalCluster
+from zarrconverter import benchrun, synthetic
+from zarrconverter.runreport import du
+
+# the script, its arguments, the input data it reads and the zarr group it writes,
+# {scheduler} is replaced by the address of a cluster started by the benchmark
+CASES = {
+    'netcdf2zarr': ('netcdf2zarr.py', ['era5', 'era5.zarr'], 'era5', 'era5.zarr'),
+    'netcdf2zarr-dask': ('netcdf2zarr.py', ['era5', 'era5.zarr', '-d', '-ds', '{scheduler}'], 'era5', 'era5.zarr'),
+    'fluxcom': ('CreateFluxcomGpp.py', [], 'Fluxcom-X-GPP-daily-0.25deg', 'Fluxcom-X-GPP-daily-0.25deg-100x720x1440.zarr'),
+    'gosif': ('CreateGosifV2.py', [], 'GOSIF_v2', 'GOSIF_v2_2000_2023_1x3600x7200.zarr'),
+    'gosif-direct': ('CreateGosifV2.py', ['--direct'], 'GOSIF_v2', 'GOSIF_v2_2000_2023_1x3600x7200.zarr'),
+    'gosif-packed': ('CreateGosifV2.py', ['--direct', '--packed'], 'GOSIF_v2', 'GOSIF_v2_2000_2023_1x3600x7200.zarr'),
+    'gimms': ('CreateGimmsNdviAvhrrModis.py', [], 'PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022',
+              'PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022_1x4320x2160.zarr'),
+    'gimms-direct': ('CreateGimmsNdviAvhrrModis.py', ['--direct'], 'PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022',
+                     'PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated_1982_2022_1x4320x2160.zarr'),
+}
+
+def generate(data_dir, name, width, height, steps):
+    """Create the synthetic input data of a case unless it exists from an earlier run"""
+    path = os.path.join(data_dir, name)
+    if os.path.exists(path):
+        return
+    logging.info('Generating %s with %d time steps of %dx%d', name, steps, width, height)
+    if name == 'era5':
+        synthetic.netcdf_stack(path, width, height, steps, x='longitude', y='latitude', prefix='era5')
+    elif name == 'Fluxcom-X-GPP-daily-0.25deg':
+        synthetic.netcdf_stack(path, width, height, steps)
+    elif name == 'GOSIF_v2':
+        synthetic.gosif_tiffs(os.path.join(path, '8day'), width, height, steps)
+    else:
+        synthetic.gimms_tiffs(path, width, height, steps)
+
+def git_commit():
+    """Commit of the converters, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    # setup the argument parser
+    parser = argparse.ArgumentParser(
+                        prog='benchmark.py',
+                        description='This program generates synthetic netCDF and GeoTIFF files, runs the converters on them and writes wall time, throughput, dask task count, peak memory per process and output size as JSON.',
+                        epilog='(c) 2024, University of Leipzig, Germany')
+
+    parser.add_argument('work_dir', help='The directory for the synthetic data and the zarr groups, existing synthetic data of the same size is reused')
+    parser.add_argument('-o', '--output', help='The JSON file for the results (default: benchmark.json)')
+    parser.set_defaults(output='benchmark.json')
+    parser.add_argument('-c', '--cases', nargs='+', choices=list(CASES), help='The cases to run (default: all)')
+    parser.set_defaults(cases=list(CASES))
+    parser.add_argument('-x', '--width', type=int, help='The number of columns of the synthetic grids (default: 1440)')
+    parser.set_defaults(width=1440)
+    parser.add_argument('-y', '--height', type=int, help='The number of rows of the synthetic grids (default: 720)')
+    parser.set_defaults(height=720)
+    parser.add_argument('-t', '--steps', type=int, help='The number of time steps of the synthetic data (default: 46)')
+    parser.set_defaults(steps=46)
+    parser.add_argument('-w', '--workers', type=int, help='The number of workers of the cluster for the -dask cases (default: 4)')
+    parser.set_defaults(workers=4)
+    parser.add_argument('--compare', help='The JSON file of an earlier run, the change of the wall time of every case is printed')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output')
+
+    # parsing the arguments
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(levelname)s: %(message)s',
+                            datefmt='%H:%M:%S')
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(args.work_dir, '%dx%dx%d' % (args.width, args.height, args.steps))
+    os.makedirs(data_dir, exist_ok=True)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'xarray': xr.__version__,
+                     'dask': dask.__version__, 'zarr': zarr.__version__},
+        'size': {'width': args.width, 'height': args.height, 'steps': args.steps},
+        'cases': {},
+    }
+
+    for name in args.cases:
+        script, arguments, source, target = CASES[name]
+        generate(data_dir, source, args.width, args.height, args.steps)
+        for path in (target, target + '.manifest'):
+            path = os.path.join(data_dir, path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        cluster = None
+        if '{scheduler}' in arguments:
+            cluster = LocalCluster(n_workers=args.workers, threads_per_worker=2)
+            cluster.scheduler.add_plugin(benchrun.TaskCounter())
+            arguments = [argument.replace('{scheduler}', cluster.scheduler_address) for argument in arguments]
+
+        print('Running %s ...' % name)
+        result = benchrun.run(os.path.join(root, script), arguments, data_dir, os.path.join(data_dir, name + '.log'))
+        if cluster is not None:
+            cluster.close()
+
+        input_bytes = du(os.path.join(data_dir, source))
+        output_bytes = du(os.path.join(data_dir, target))
+        result.update({
+            'script': script,
+            'arguments': arguments,
+            'input_bytes': input_bytes,
+            'output_bytes': output_bytes,
+            'in_MBps': input_bytes / 1e6 / result['wall_s'],
+            'out_MBps': output_bytes / 1e6 / result['wall_s'],
+        })
+        results['cases'][name] = result
+        if result['exit_code'] != 0:
+            logging.error('%s failed with exit code %d, see %s.log', name, result['exit_code'], name)
+        print('%s: %.1f s, %.1f MB/s in, %.1f MB/s out, %d tasks, peak memory %.0f MB (script) %.0f MB (largest worker)' % (
+            name, result['wall_s'], result['in_MBps'], result['out_MBps'], result['tasks'],
+            result['peak_rss']['main'] / 1e6, max(result['peak_rss']['workers'], default=0) / 1e6))
+
+        # written after every case, so the results of finished cases are kept if a later case crashes
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous['size'] != results['size']:
+            logging.warning('The earlier run used a different size of the synthetic data: %s', previous['size'])
+        print('Wall time compared to %s (commit %s):' % (args.compare, previous.get('commit')))
+        for name, result in results['cases'].items():
+            if name in previous['cases']:
+                before = previous['cases'][name]['wall_s']
+                print('%s: %.1f s -> %.1f s (%+.0f%%)' % (name, before, result['wall_s'], 100 * (result['wall_s'] / before - 1)))
+
+    failed = [name for name, result in results['cases'].items() if result['exit_code'] != 0]
+    if failed:
+        sys.exit('Failed cases: ' + ', '.join(failed))
+
+if __name__ == '__main__':
+    # the workers of the cluster for the -dask cases import this file again
+    main()
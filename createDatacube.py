@@ -1,11 +1,14 @@
-from dask.distributed import Client
 import numpy as np
-import xarray as xr
 import argparse
+from zarrconverter import cli, dryrun, runreport, subset
 
 import os
 import glob
 
+def file_year(file_path):
+    # Extract year from file name
+    return int(file_path.split('\\')[-1].split('_')[-1].split('.')[0])
+
 def main():
 
     chunk_size = {'x': 256, 'y': 256, 'time': 1}
@@ -14,26 +17,63 @@ def main():
     parser.add_argument("--input_dir", required=True, help="Path to the input directory containing NetCDF files.")
     parser.add_argument("--output_dir", required=False, help="Path to the output Zarr directory.")
     parser.add_argument("--save_zarr", required=False, help="Save the dataset to a Zarr store.", action='store_true')
+    parser.add_argument("--access", required=False, choices=["map", "timeseries", "balanced"], help="Plan the chunks for this access pattern instead of 256x256 tiles per year.")
+    parser.add_argument("--chunk_bytes", required=False, default="64MB", help="Target size of a chunk for --access (default: 64MB).")
+    parser.add_argument("--shards", required=False, nargs=3, type=int, help="Write Zarr v3 with shards of this size [time, x, y], the chunks become the inner chunks inside the shard files (needs zarr-python 3).")
+    parser.add_argument("--pyramid", required=False, type=int, default=0, help="Write a multiscale pyramid with this number of levels of 2x, 4x, ... lower resolution as the groups 1, 2, ... of the Zarr store (default: 0).")
+    parser.add_argument("--bbox", required=False, nargs=4, type=float, metavar=("WEST", "SOUTH", "EAST", "NORTH"), help="Only convert the cells inside this bounding box, only the chunks of the NetCDF files that intersect it are read.")
+    parser.add_argument("--bbox_crs", required=False, default="EPSG:4326", help="CRS of --bbox, e.g. EPSG:3035 (default: EPSG:4326, longitude and latitude).")
+    parser.add_argument("--time_range", required=False, nargs=2, metavar=("START", "END"), help="Only convert the years from START to END, the files of other years are not opened.")
+    parser.add_argument("--precision", required=False, nargs="+", type=cli.precision_spec, metavar="[VARIABLE=]MODE", help="Lossy compression of deadwood: float32, N mantissa bits or auto[:LEVEL] for the bits holding LEVEL (default 0.99) of the information of sampled chunks, recorded in the attributes precision and max_relative_error.")
+    parser.add_argument("--verify", required=False, help="Compare every chunk of the Zarr store with the NetCDF files after saving, hashes and statistics of the chunks are written next to the store.", action='store_true')
+    parser.add_argument("--scheduler", required=False, default="local", help="Address of a running Dask scheduler, 'local' to start a local cluster sized for this machine (default) or 'synchronous' to run without a cluster.")
+    parser.add_argument("--report", required=False, help="JSON file for the run report (default: next to the Zarr store).")
+    parser.add_argument("--progress", required=False, help="Show a live progress line while the Zarr store is written.", action='store_true')
+    parser.add_argument("--plan", required=False, help="Only print the plan of the Zarr store (inputs, variables, chunks, files, estimated size and tasks) without opening the files with xarray, starting a cluster or asking to save.", action='store_true')
     args = parser.parse_args()
+    report = runreport.RunReport(os.path.basename(__file__), args.report, progress=args.progress)
 
     # Use glob to list all .nc files in the input directory
-    input_files = glob.glob(os.path.join(args.input_dir, '*.nc'))
+    with report.stage("discover files"):
+        input_files = glob.glob(os.path.join(args.input_dir, '*.nc'))
+        # the year is in the file name, files outside of --time_range are never opened
+        input_files = subset.files_in_time(input_files, file_year, args.time_range)
+    report.read_files(input_files)
+
+    if args.plan:
+        # only the headers of the files are read, every file becomes one time step of deadwood with x before y
+        inputs = dryrun.netcdfs(input_files, dim='time', new_dim=True, bbox=args.bbox, bbox_crs=args.bbox_crs, y='y', x='x')
+        inputs["times"] = [file_year(file_path) for file_path in inputs["files"]]
+        inputs["layout"]['deadwood'] = dryrun.transpose(inputs["layout"].pop('Band1'), ('time', 'x', 'y'))
+        dryrun.show(inputs, chunk_size, args.access, args.chunk_bytes, shards=cli.shards(args, ("time", "x", "y")),
+                    levels=args.pyramid, level_dims=("y", "x"), zarr_dir=args.output_dir,
+                    precisions=args.precision)
+        return
 
-    client = Client()  # Starts a local Dask client
-    # print dashboard link
-    print("Dashboard available under: " + str(client.dashboard_link))
+    # the converters need xarray, dask and zarr, their import takes seconds and is not needed for --plan
+    import xarray as xr
+    from zarrconverter import checkpoint, chunkplan, cluster, objectstore, precision, verify
 
     # Open multiple datasets and add a new coordinate for year based on file names
     datasets = []
-    for file_path in input_files:
-        time = int(file_path.split('\\')[-1].split('_')[-1].split('.')[0])  # Extract year from file name
-        ds = xr.open_dataset(file_path, chunks=chunk_size, decode_coords="all").drop_vars('lambert_azimuthal_equal_area').rename({'Band1': 'deadwood'})
-        ds = ds.assign_coords(time=np.array(time))
-        datasets.append(ds)
+    with report.stage("open files"):
+        for file_path in input_files:
+            time = file_year(file_path)
+            ds = xr.open_dataset(file_path, chunks=chunk_size, decode_coords="all")
+            if args.bbox:
+                # the box is cut in the grid of the grid mapping before it is dropped, then the tiles start at the box again
+                ds = subset.select(ds, args.bbox, args.bbox_crs, y='y', x='x')
+                ds = ds.chunk({dim: chunk_size[dim] for dim in ('x', 'y')})
+            ds = ds.drop_vars('lambert_azimuthal_equal_area').rename({'Band1': 'deadwood'})
+            ds = ds.assign_coords(time=np.array(time))
+            datasets.append(ds)
 
-    # Concatenate along the new 'year' dimension
-    combined_ds = xr.concat(datasets, dim='time')
-    combined_ds = combined_ds.transpose('time', 'x', 'y')
+        # Concatenate along the new 'year' dimension
+        combined_ds = xr.concat(datasets, dim='time')
+    with report.stage("build graph"):
+        combined_ds = combined_ds.transpose('time', 'x', 'y')
+        if args.access:
+            combined_ds = combined_ds.chunk(chunkplan.plan_dataset(combined_ds, args.chunk_bytes, args.access))
 
     # clean the attributes
     # List of attributes to remove
@@ -43,9 +83,16 @@ def main():
     for attr in attrs_to_remove:
         if attr in ds.attrs:
             del combined_ds.attrs[attr]
+
+    # the rounding is a filter of the encoding, the dataset keeps its values
+    encoding = None
+    if args.precision:
+        with report.stage("precision"):
+            combined_ds, encoding = precision.apply(combined_ds, encoding, args.precision)
             
     # Print the combined dataset
     print(combined_ds)
+    chunkplan.report(combined_ds)
     print('Dataset created successfully.')
 
     if not args.save_zarr:
@@ -53,7 +100,6 @@ def main():
         save_zarr = input('Do you want to save the dataset to a Zarr store? (y/n): ')
         if save_zarr.lower() != 'y':
             print('Exiting without saving.')
-            client.close()
             exit()
         
     # ask for the output zarr file name if not provided
@@ -62,7 +108,6 @@ def main():
         # Check if the user entered a file name
         if not output_zarr:
             print('No file name entered. Exiting without saving.')
-            client.close()
             exit()
     else:
         output_zarr = args.output_dir
@@ -71,12 +116,24 @@ def main():
     if not output_zarr.endswith('.zarr'):
         output_zarr += '.zarr'
 
-    # Save to Zarr
-    combined_ds.to_zarr(output_zarr, mode='w')
+    # Save to Zarr, the same as combined_ds.to_zarr(output_zarr, mode='w') with the stages recorded in the report
+    report.path = report.path or objectstore.local_path(output_zarr, '.report.json')
+    with report.stage("start cluster"):
+        # sized for the chunks of the dataset, netCDF reads only scale with processes
+        client = cluster.start("hdf5", cluster.task_memory(combined_ds), args.scheduler)
+    checkpoint.to_zarr(combined_ds, output_zarr, encoding=encoding, report=report, shards=cli.shards(args, ("time", "x", "y")),
+                       overviews=cli.overviews(args, ("y", "x")))
+    report.measure_memory(client)
+    verified = None
+    if args.verify:
+        verified = verify.verify(combined_ds, output_zarr, report=report)
 
-    client.close()
+    cluster.stop(client)
+    report.write()
     
     print('Data saved to Zarr store.')
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The Zarr store does not match the NetCDF files, see " + verify.manifest_path(output_zarr))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
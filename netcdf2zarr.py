@@ -3,15 +3,45 @@
 # This script converts a set of netCDF
 # files to a zarr group using xarray and dask
 
-import xarray as xr
-import zarr
+import numpy as np
 import os
+import sys
 import glob
 import datetime
+import json
 import argparse
 import logging
 from datetime import datetime
-from dask.distributed import Client
+from zarrconverter import aggregate, dryrun, precision, runreport, subset
+
+def file_times(filelist, index=None):
+    """Read only the time coordinate of every netCDF file, from the file index if there is one"""
+    import xarray as xr
+    times = {}
+    for file in filelist:
+        with (index.open_dataset(file) if index is not None else xr.open_dataset(file)) as nc:
+            times[file] = nc['time'].values
+    return times
+
+def aligned_chunks(start, length, chunk):
+    """Split length time steps starting at index start into pieces aligned to the zarr chunks"""
+    first = min(length, chunk - start % chunk)
+    rest = length - first
+    chunks = (first,) + (chunk,) * (rest // chunk)
+    if rest % chunk:
+        chunks += (rest % chunk,)
+    return chunks
+
+def store_chunks(store, ds, start):
+    """Chunking of ds that matches the chunks of the existing zarr store, beginning at time index start"""
+    chunks = {}
+    for vname in ds.data_vars:
+        # every dask chunk has to cover whole shards of a sharded zarr group
+        encoding = store[vname].encoding
+        for dim, size in zip(store[vname].dims, encoding.get('shards') or encoding['chunks']):
+            chunks[dim] = size
+    chunks['time'] = aligned_chunks(start, ds.sizes['time'], chunks['time'])
+    return chunks
 
 #setup the argument parser
 parser = argparse.ArgumentParser(
@@ -20,61 +50,329 @@ parser = argparse.ArgumentParser(
                     epilog='(c) 2024, University of Leipzig, Germany')
 
 parser.add_argument('netcdf_dir', help='The directory containing the netCDF files')
-parser.add_argument('zarr_dir', help='The directory where the zarr group will be stored. This will be overwritten if it exists')
+parser.add_argument('zarr_dir', help='The directory (or fsspec URL like s3://bucket/name.zarr) where the zarr group will be stored. This will be overwritten if it exists')
 parser.add_argument('-d', '--dask', action='store_true', help='Use dask to parallelize the conversion')
 parser.set_defaults(dask=False)
-parser.add_argument('-ds', '--dask-scheduler', help='The address of the dask scheduler to use, if not tcp//localhost:8786')
+parser.add_argument('-ds', '--dask-scheduler', help='The address of the dask scheduler to use, if not tcp//localhost:8786. If it can not be reached a local cluster sized for this machine is started, \'local\' starts it right away and \'synchronous\' runs without a cluster')
 parser.set_defaults(dask_scheduler='tcp://localhost:8786')
+parser.add_argument('--n-workers', type=int, help='The number of worker processes of a local cluster (default: derived from the cores, the memory and the chunks)')
+parser.add_argument('--threads-per-worker', type=int, help='The number of threads of every worker of a local cluster (default: 1, netCDF reads are serialized by HDF5 within a process)')
+parser.add_argument('--memory-limit', help='The memory limit of every worker of a local cluster, e.g. 10GB (default: the available memory shared by the workers)')
+parser.add_argument('--index', help='The JSON file index of the netCDF files, which is updated for new and changed files and replaces opening every file (default: netcdf_dir/.fileindex.json)')
+parser.add_argument('--no-index', action='store_true', help='Open every netCDF file instead of using the file index')
+parser.add_argument('--readers', type=int, metavar='PROCESSES', help='Decode the netCDF files in a pool of PROCESSES processes (0: one per core) and compress and write in threads of this process, instead of a dask cluster (-d) whose threads wait for the HDF5 lock, needs the file index')
 parser.add_argument('-c', '--chunk-size', nargs=3, type=int, help='The size of the chunks [time, longitude, latitude] to use for the zarr group (default: 1 1080 1080)')
 parser.set_defaults(chunk_size=[1, 1080, 1080])
+parser.add_argument('--access', choices=['map', 'timeseries', 'balanced'], help='Plan the chunks for this access pattern from the chunking of the netCDF files instead of using --chunk-size')
+parser.add_argument('--chunk-bytes', help='Target size of a chunk for --access (default: 64MB)')
+parser.set_defaults(chunk_bytes='64MB')
+parser.add_argument('--shards', nargs=3, type=int, help='Write zarr v3 with shards of this size [time, longitude, latitude], the chunks become the inner chunks inside the shard files (needs zarr-python 3)')
+parser.add_argument('-p', '--pyramid', type=int, help='Write a multiscale pyramid with this number of levels of 2x, 4x, ... lower resolution as the groups 1, 2, ... of the zarr group, --append and --region update the levels of an existing pyramid (default: 0)')
+parser.set_defaults(pyramid=0)
+parser.add_argument('--aggregate', nargs='+', metavar='PERIOD:REDUCTION', help='Also write temporal aggregates computed from the same blocks in the same pass, each into its own group of the zarr group, e.g. monthly:mean annual:max monthly:count (PERIOD: %s, REDUCTION: %s)' % (', '.join(aggregate.PERIODS), ', '.join(aggregate.REDUCTIONS)))
+parser.add_argument('--reference', action='store_true', help='Write a kerchunk style reference store (zarr_dir has to end with .json) that points to the chunks in the netCDF4 files instead of copying them (needs h5py)')
+parser.add_argument('-a', '--append', action='store_true', help='Append only the time steps which are not yet in the zarr group instead of overwriting it')
+parser.add_argument('-r', '--region', nargs=2, metavar=('START', 'END'), help='Rewrite the time range START to END (e.g. 2020-01-01 2020-12-31) of an existing zarr group in place')
+parser.add_argument('--bbox', nargs=4, type=float, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'), help='Only convert the cells inside this bounding box, only the chunks of the netCDF files that intersect it are decoded')
+parser.add_argument('--bbox-crs', help='The CRS of --bbox, e.g. EPSG:3035 (default: EPSG:4326, longitude and latitude, the grid of the files comes from their grid mapping)')
+parser.set_defaults(bbox_crs='EPSG:4326')
+parser.add_argument('--time-range', nargs=2, metavar=('START', 'END'), help='Only convert the time steps from START to END, e.g. 2010 2015 or 2010-03-01 2010-05-31 (END includes the whole year or month), files outside are not opened')
+parser.add_argument('--variables', nargs='+', metavar='NAME', help='Only convert these data variables (default: all)')
+parser.add_argument('--storage-options', type=json.loads, metavar='JSON', help='fsspec options if zarr_dir is a URL, e.g. \'{"client_kwargs": {"endpoint_url": "https://s3.example.org"}}\'')
+parser.add_argument('--upload-concurrency', type=int, help='The number of chunks uploaded at the same time by every task if zarr_dir is a URL (default: 16)')
+parser.set_defaults(upload_concurrency=16)
+parser.add_argument('--resume', action='store_true', help='Continue an interrupted conversion, only blocks missing in the manifest next to the zarr group are written')
+parser.add_argument('--tune-codecs', action='store_true', help='Choose the compressor of every variable from measurements on sampled chunks, the report is written next to the zarr group')
+parser.add_argument('--min-ratio', type=float, help='Minimum compression ratio for --tune-codecs, the fastest codec to read with this ratio is chosen (default: 2.0)')
+parser.set_defaults(min_ratio=2.0)
+parser.add_argument('--precision', nargs='+', metavar='[VARIABLE=]MODE', help='Lossy compression of float variables: float32 stores float64 as float32, N keeps N mantissa bits (rounded by a BitRound filter), auto[:LEVEL] keeps the bits holding LEVEL (default 0.99) of the information of sampled chunks, e.g. float32 or auto t2m=7; precision and max_relative_error are recorded in the attributes')
+parser.add_argument('-ts', '--timeseries', metavar='TIMESERIES_DIR', help='Write a second zarr group chunked for time series analysis in the same run')
+parser.add_argument('-tc', '--timeseries-chunk-size', nargs=3, type=int, help='The size of the chunks [time, longitude, latitude] of the time series zarr group (default: 256 30 30)')
+parser.set_defaults(timeseries_chunk_size=[256, 30, 30])
+parser.add_argument('-m', '--max-memory', help='The maximum memory of a single rechunking task (default: 2GB)')
+parser.set_defaults(max_memory='2GB')
+parser.add_argument('--verify', action='store_true', help='Compare every chunk of the zarr group with the netCDF files after writing, hashes and statistics of the chunks are written to zarr_dir.verify.jsonl')
+parser.add_argument('--verify-only', action='store_true', help='Only verify an existing zarr group (or the time range of --region) against the netCDF files, nothing is written')
+parser.add_argument('--tolerance', nargs=2, type=float, metavar=('RTOL', 'ATOL'), help='Relative and absolute tolerance of --verify (default: 0 0, exact)')
+parser.set_defaults(tolerance=[0.0, 0.0])
+parser.add_argument('--report', help='The JSON file for the run report with the time of every stage, bytes and chunks written and peak memory (default: zarr_dir.report.json)')
+parser.add_argument('--progress', action='store_true', help='Show a live progress line while the blocks are written and the chunks verified')
+parser.add_argument('--plan', action='store_true', help='Only print the plan of the conversion (inputs, variables, chunks, files, estimated size and tasks) from the file index or the headers of the files, without importing the converters or starting a cluster')
 parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output')
 
-# parsing the arguments
-args = parser.parse_args()
-netcdf_dir = args.netcdf_dir
-zarr_dir = args.zarr_dir
-usedask = args.dask
-dask_scheduler = args.dask_scheduler
-chunk_size = args.chunk_size
-verbose = args.verbose
-if verbose:
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s %(levelname)s: %(message)s',
-                        datefmt='%H:%M:%S')
-
-logging.info('Start of script')
-
-# setup dask client
-if usedask:
-    try:
-        client = Client(dask_scheduler)
-    except Exception as e:
-        logging.error('Error creating dask client: %s', e)
+def main():
+    # parsing the arguments
+    args = parser.parse_args()
+    netcdf_dir = args.netcdf_dir
+    zarr_dir = args.zarr_dir
+    usedask = args.dask
+    dask_scheduler = args.dask_scheduler
+    chunk_size = args.chunk_size
+    verbose = args.verbose
+    append = args.append
+    region = args.region
+    resume = args.resume
+    if append and region:
+        parser.error('--append and --region can not be used together')
+    if args.reference and (append or region or resume or args.shards or args.pyramid or args.timeseries or args.tune_codecs):
+        parser.error('--reference can not be combined with --append, --region, --resume, --shards, --pyramid, -ts or --tune-codecs')
+    if args.time_range and (append or region):
+        parser.error('--time-range selects the time steps of a full conversion, --append and --region choose their own')
+    if args.aggregate and (append or region or args.reference):
+        parser.error('--aggregate is computed in a full conversion, it can not be combined with --append, --region or --reference')
+    if args.aggregate:
+        for spec in args.aggregate:
+            try:
+                aggregate.parse(spec)
+            except ValueError as error:
+                parser.error(str(error))
+    if args.precision and (append or region or args.reference):
+        parser.error('--precision sets the encoding of a full conversion, --append and --region keep the precision of the zarr group, --reference copies nothing')
+    for spec in args.precision or []:
+        try:
+            precision.parse(spec)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.reference and (args.bbox or args.time_range or args.variables):
+        parser.error('--reference points to whole chunks of the netCDF files, it can not be combined with --bbox, --time-range or --variables')
+    if append and args.verify_only:
+        parser.error('--append can not be verified without writing, use --region for the appended time range instead')
+    if args.readers is not None and (args.no_index or usedask):
+        parser.error('--readers needs the file index and replaces the dask cluster, it can not be combined with --no-index or -d')
+    if args.plan and (append or region or args.reference):
+        parser.error('--plan describes a full conversion, it can not be combined with --append, --region or --reference')
+    if verbose:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(levelname)s: %(message)s',
+                            datefmt='%H:%M:%S')
+
+    logging.info('Start of script')
+    if args.plan:
+        # only the file names and the index (or the headers) of the files are read, nothing is converted
+        filelist = sorted(glob.glob(os.path.join(netcdf_dir, "*.nc")))
+        index = None if args.no_index else args.index or os.path.join(netcdf_dir, dryrun.INDEX_NAME)
+        chunks = {'time': chunk_size[0], 'longitude': chunk_size[1], 'latitude': chunk_size[2]}
+        shards = dict(zip(['time', 'longitude', 'latitude'], args.shards)) if args.shards else None
+        inputs = dryrun.netcdfs(filelist, index, time_range=args.time_range, variables=args.variables,
+                                bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, chunks, args.access, args.chunk_bytes, shards=shards,
+                    levels=args.pyramid, level_dims=('latitude', 'longitude'), zarr_dir=zarr_dir, aggregates=args.aggregate,
+                    precisions=args.precision)
+        return
+
+    # the converters need xarray, dask and zarr, their import takes seconds and is not needed for --plan
+    import xarray as xr
+    import zarr
+    import numcodecs
+    import dask
+    from zarrconverter import checkpoint, chunkplan, chunkstats, cluster, codectuning, fileindex, objectstore, pyramid, readerpool, rechunk, references, verify
+    if args.reference and not objectstore.is_reference(zarr_dir):
+        parser.error('the reference store of --reference is a JSON file, zarr_dir has to end with .json')
+    report = runreport.RunReport(os.path.basename(__file__), args.report or objectstore.local_path(zarr_dir, '.report.json'),
+                                 progress=args.progress)
+
+    # setup dask client
+    client = None
+    if usedask:
+        with report.stage('start cluster'):
+            # falls back to a local cluster and then to the synchronous scheduler, a local cluster is sized for the chunks
+            task_bytes = cluster.chunk_memory(dict(zip(['time', 'longitude', 'latitude'], chunk_size)))
+            client = cluster.start('hdf5', task_bytes, dask_scheduler, args.n_workers, args.threads_per_worker,
+                                   args.memory_limit)
+
+    # open the netCDF files
+    with report.stage('discover files'):
+        filelist = sorted(glob.glob(os.path.join(netcdf_dir,"*.nc")))
+    index = None
+    if not args.no_index:
+        # coordinates, variables and chunking of unchanged files come from the index instead of the files
+        with report.stage('index files'):
+            index = fileindex.load(filelist, args.index or os.path.join(netcdf_dir, fileindex.INDEX_NAME))
+    readers = None
+    if args.readers is not None:
+        # the data variables are decoded by the reader processes, the tasks compress and write in threads of this script
+        with report.stage('start readers'):
+            readers = readerpool.start(args.readers or None)
+        index.reader = readers
+    chunks = {'time': chunk_size[0], 'longitude' : chunk_size[1], 'latitude': chunk_size[2]}
+    if args.reference:
+        # the references keep the chunks of the netCDF files
+        chunks = {}
+    if append or region:
+        # only open the files needed for the update, everything else is already in the zarr group
+        # local folder or the key-value mapping of a URL
+        target = objectstore.mapper(zarr_dir, args.storage_options)
+        store = xr.open_zarr(target, consolidated=True)
+        stored_times = store['time'].values
+        with report.stage('discover files'):
+            times = file_times(filelist, index)
+        if append:
+            filelist = [file for file in filelist if not np.isin(times[file], stored_times).all()]
+            if not filelist:
+                logging.info('No new time steps found, zarr group is up to date')
+                # nothing to write, but the cluster and the readers are stopped and the run is reported
+                cluster.stop(client)
+                readerpool.stop(readers)
+                report.write()
+                return
+            if min(times[file].min() for file in filelist) <= stored_times[-1]:
+                parser.error('new time steps are not after the end of the zarr group, use --region instead')
+            logging.info('%d new files found for appending', len(filelist))
+        else:
+            start, end = np.datetime64(region[0]), np.datetime64(region[1])
+            filelist = [file for file in filelist
+                        if ((times[file] >= start) & (times[file] <= end)).any()]
+            logging.info('%d files found for the region %s to %s', len(filelist), region[0], region[1])
+    if args.time_range:
+        # files outside of the time range are never opened for their data
+        with report.stage('discover files'):
+            filelist = subset.netcdf_files(filelist, args.time_range, index)
+        logging.info('%d files found for the time range %s to %s', len(filelist), *args.time_range)
+    report.read_files(filelist)
+    with report.stage('open files'):
+        if index is not None:
+            ds = index.open_mfdataset(filelist, combine='by_coords', chunks=chunks)
+        else:
+            ds = xr.open_mfdataset(filelist, combine='by_coords',
+                                   chunks=chunks,
+                                   parallel=usedask)
+    logging.info('Files are opened and combined to xarray dataset')
+    if args.bbox or args.time_range or args.variables:
+        # the lazy variables are sliced before they are chunked, so only the HDF5 chunks inside the subset are decoded
+        ds = subset.select(ds, args.bbox, args.bbox_crs, args.time_range, args.variables)
+        ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+        logging.info('Dataset is reduced to the subset %s', dict(ds.sizes))
+
+    if append or region:
+        # variables without time are already stored and are not touched
+        ds = ds.drop_vars([vname for vname in ds.variables if 'time' not in ds[vname].dims])
+        if append:
+            start_index = len(stored_times)
+        else:
+            ds = ds.sel(time=slice(start, end))
+            positions = np.searchsorted(stored_times, ds['time'].values)
+            if (positions >= len(stored_times)).any() or (stored_times[positions] != ds['time'].values).any():
+                parser.error('the time steps of the region are not in the zarr group, use --append instead')
+            if (np.diff(positions) != 1).any():
+                parser.error('the time steps of the region are not contiguous in the zarr group')
+            start_index = int(positions[0])
+        offset = start_index
+        # dask chunks have to match the zarr chunks, otherwise partial chunks are written concurrently
+        ds = ds.chunk(store_chunks(store, ds, start_index))
+        # keep the attributes and encoding of the zarr group, otherwise they are overwritten by the new files
+        ds.attrs = store.attrs
+        for vname in ds.variables:
+            ds[vname].attrs = store[vname].attrs
+            ds[vname].encoding = {}
+        # the levels of a multiscale pyramid are reduced from the same dask chunks as the new time steps
+        levels = []
+        if 'multiscales' in store.attrs:
+            multiscales = store.attrs['multiscales'][0]
+            dims = [axis['name'] for axis in multiscales['axes'] if axis['type'] == 'space']
+            _, levels = pyramid.build(ds, None, len(multiscales['datasets']) - 1, dims)
+            logging.info('%d levels of the multiscale pyramid are updated as well', len(levels))
+
+        if not args.verify_only:
+            logging.info('Start of incremental update of the zarr group')
+            print('Start of processing: ', datetime.now().strftime("%H:%M:%S"))
+            stored = runreport.du(zarr_dir, args.storage_options)
+            with report.stage('compute and write'):
+                writes = []
+                for group, level_ds in [(None, ds)] + [(str(level), level_ds) for level, (level_ds, _) in enumerate(levels, 1)]:
+                    # chunks that only hold fill values are not written, like in a full conversion
+                    if append:
+                        writes.append(level_ds.to_zarr(target, group=group, append_dim='time', consolidated=False, compute=False,
+                                                       write_empty_chunks=False))
+                    else:
+                        # partial chunks at the borders of the region are written by exactly one dask chunk,
+                        # so the conservative chunk check of xarray can be switched off
+                        writes.append(level_ds.to_zarr(target, group=group, region={'time': slice(start_index, start_index + ds.sizes['time'])},
+                                                       mode='r+', consolidated=False, compute=False, safe_chunks=False,
+                                                       write_empty_chunks=False))
+                # one compute for all levels, the netCDF files are read only once
+                dask.compute(*writes, priority=cluster.priority())
+            # the statistics of the chunks of the written time steps are read back from the zarr group
+            with report.stage('index chunks'):
+                chunks_empty = chunkstats.refresh(target, start_index, start_index + ds.sizes['time'])
+            # encoding and attributes of the group stay untouched, only the metadata is refreshed
+            with report.stage('consolidate metadata'):
+                zarr.consolidate_metadata(target)
+            # the dask chunks are aligned to the zarr chunks, every dask chunk is one zarr chunk
+            report.count('chunks_written', sum(level_ds[vname].data.npartitions for level_ds in [ds] + [level_ds for level_ds, _ in levels]
+                                               for vname in level_ds.data_vars))
+            report.count('chunks_empty', chunks_empty)
+            report.count('bytes_written', runreport.du(zarr_dir, args.storage_options) - stored)
+            logging.info('Zarr group is updated: ' + zarr_dir)
+    elif args.reference:
+        offset = 0
+        if not args.verify_only:
+            logging.info('Start of referencing the chunks of the netCDF files')
+            # the chunks stay in the netCDF files, only metadata, coordinates and byte ranges are written
+            with report.stage('write references'):
+                chunks_referenced = references.write(ds, filelist, zarr_dir, index=index,
+                                                     storage_options=args.storage_options)
+            report.count('chunks_referenced', chunks_referenced)
+            logging.info('Reference store is written: ' + zarr_dir)
     else:
-        logging.info('Dask client is connected successfully')
-
-# open the netCDF files
-filelist = glob.glob(os.path.join(netcdf_dir,"*.nc"))
-ds = xr.open_mfdataset(filelist, combine='by_coords',
-                       chunks={'time': chunk_size[0], 'longitude' : chunk_size[1], 'latitude': chunk_size[2]},
-                       parallel=usedask)
-logging.info('Files are opened and combined to xarray dataset')
-
-# setup of encoding and reprocessing attribute
-encoding = {vname: {
-    'compressor': zarr.Blosc(cname='zstd', clevel=5)
-    } for vname in ds.data_vars}
-ds.attrs['reprocessing'] = "rechunked and compressed with zarr using zarrconverter.py script."
-logging.info('Encoding is set to Blosc compressor with zstd level 5 and reprocessing attribute is added to the dataset.')
-
-logging.info('Start of chunking and compression to zarr')
-print('Start of processing: ', datetime.now().strftime("%H:%M:%S"))
-# save the dataset to zarr
-ds.to_zarr(zarr_dir, encoding=encoding, consolidated=True, mode='w', compute=True)
-logging.info('Dataset is saved to zarr group: ' + zarr_dir)
-
-if usedask:
-    client.close()
-logging.info('Dask client is closed')
-
-logging.info('End of script')
\ No newline at end of file
+        offset = 0
+        if args.access:
+            with report.stage('build graph'):
+                ds = ds.chunk(chunkplan.plan_dataset(ds, args.chunk_bytes, args.access))
+            logging.info('Chunks are planned for %s access', args.access)
+        chunkplan.report(ds)
+
+        # setup of encoding and reprocessing attribute
+        encoding = {vname: {
+            'compressor': numcodecs.Blosc(cname='zstd', clevel=5)
+            } for vname in ds.data_vars}
+        ds.attrs['reprocessing'] = "rechunked and compressed with zarr using zarrconverter.py script."
+        logging.info('Encoding is set to Blosc compressor with zstd level 5 and reprocessing attribute is added to the dataset.')
+        if args.tune_codecs:
+            with report.stage('tune codecs'):
+                encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, '.codecs.json'))
+            logging.info('Encoding is replaced by the codecs chosen from measurements')
+        if args.precision:
+            with report.stage('precision'):
+                ds, encoding = precision.apply(ds, encoding, args.precision)
+            logging.info('Encoding rounds the float variables to the precision of --precision')
+
+        if not args.verify_only:
+            logging.info('Start of chunking and compression to zarr')
+            print('Start of processing: ', datetime.now().strftime("%H:%M:%S"))
+            # save the dataset to zarr, finished blocks are recorded so that a crashed run can be resumed
+            shards = dict(zip(['time', 'longitude', 'latitude'], args.shards)) if args.shards else None
+            overviews = {'levels': args.pyramid, 'dims': ('latitude', 'longitude')} if args.pyramid else None
+            storage = {'storage_options': args.storage_options, 'concurrency': args.upload_concurrency}
+            aggregates = {'specs': args.aggregate} if args.aggregate else None
+            checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=resume, report=report, shards=shards, overviews=overviews,
+                               storage=storage, aggregates=aggregates)
+            logging.info('Dataset is saved to zarr group: ' + zarr_dir)
+
+            if args.timeseries:
+                # the time series layout is built from the new zarr group with bounded memory, not from the netCDF files
+                timeseries_chunks = args.timeseries_chunk_size
+                with report.stage('rechunk'):
+                    rechunk.rechunk(zarr_dir, args.timeseries,
+                                    {'time': timeseries_chunks[0], 'longitude': timeseries_chunks[1], 'latitude': timeseries_chunks[2]},
+                                    max_mem=args.max_memory)
+                logging.info('Dataset is rechunked to zarr group: ' + args.timeseries)
+
+    verified = None
+    if args.verify or args.verify_only:
+        # the written time steps are compared with the netCDF files they were read from
+        verified = verify.verify(ds, zarr_dir, *args.tolerance, offset=offset, report=report,
+                                 storage_options=args.storage_options)
+
+    report.measure_memory(client)
+    cluster.stop(client)
+    readerpool.stop(readers)
+    logging.info('Dask client is closed')
+    report.write()
+    if verified is not None and not verified['ok']:
+        logging.error('The zarr group does not match the netCDF files, see ' + verify.manifest_path(zarr_dir))
+        sys.exit(1)
+
+    logging.info('End of script')
+
+if __name__ == '__main__':
+    main()
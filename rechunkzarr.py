@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# This script copies a zarr group to a new zarr group
+# with a different chunking, e.g. from spatial chunks
+# to chunks for time series analysis, with bounded memory
+
+import argparse
+import logging
+from datetime import datetime
+from dask.utils import parse_bytes
+from zarrconverter import cluster, rechunk
+
+#setup the argument parser
+parser = argparse.ArgumentParser(
+                    prog='rechunkzarr.py',
+                    description='This program copies a zarr group to a new zarr group with a different chunking. Each task uses at most the given memory, if needed the data goes through an intermediate zarr group.',
+                    epilog='(c) 2024, University of Leipzig, Germany')
+
+parser.add_argument('source_dir', help='The zarr group to rechunk')
+parser.add_argument('target_dir', help='The directory where the rechunked zarr group will be stored. This will be overwritten if it exists')
+parser.add_argument('-c', '--chunk-size', nargs=3, type=int, help='The size of the chunks [time, longitude, latitude] of the new zarr group (default: 256 30 30)')
+parser.set_defaults(chunk_size=[256, 30, 30])
+parser.add_argument('-dims', '--dimensions', nargs=3, help='The names of the dimensions for the chunk sizes (default: time longitude latitude)')
+parser.set_defaults(dimensions=['time', 'longitude', 'latitude'])
+parser.add_argument('-m', '--max-memory', help='The maximum memory of a single task (default: 2GB)')
+parser.set_defaults(max_memory='2GB')
+parser.add_argument('-t', '--temp-dir', help='The directory of the intermediate zarr group (default: target_dir.intermediate)')
+parser.add_argument('-d', '--dask', action='store_true', help='Use a dask scheduler to parallelize the rechunking')
+parser.set_defaults(dask=False)
+parser.add_argument('-ds', '--dask-scheduler', help='The address of the dask scheduler to use, if not tcp//localhost:8786. If it can not be reached a local cluster sized for this machine is started, \'local\' starts it right away and \'synchronous\' runs without a cluster')
+parser.set_defaults(dask_scheduler='tcp://localhost:8786')
+parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output')
+
+def main():
+    # parsing the arguments
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(levelname)s: %(message)s',
+                            datefmt='%H:%M:%S')
+
+    logging.info('Start of script')
+
+    # setup dask client, a local cluster runs as many tasks of --max-memory as fit into memory
+    client = None
+    if args.dask:
+        client = cluster.start('compress', parse_bytes(args.max_memory), args.dask_scheduler)
+
+    print('Start of processing: ', datetime.now().strftime("%H:%M:%S"))
+    chunks = dict(zip(args.dimensions, args.chunk_size))
+    rechunk.rechunk(args.source_dir, args.target_dir, chunks, max_mem=args.max_memory, temp_dir=args.temp_dir)
+    logging.info('Dataset is rechunked to zarr group: ' + args.target_dir)
+
+    cluster.stop(client)
+    logging.info('Dask client is closed')
+
+    logging.info('End of script')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import pytest
+from zarrconverter import aggregate
+
+QUALITY = {"NDVI": aggregate.QualityFlag("QC", digit=2, good=(0, 1))}
+
+def test_check_quality_needs_the_quality_variable():
+    aggregate.check_quality(QUALITY, ["NDVI", "QC"])
+    aggregate.check_quality(QUALITY, ["QC"])
+    with pytest.raises(ValueError, match="add QC to --variables"):
+        aggregate.check_quality(QUALITY, ["NDVI"])
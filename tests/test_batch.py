@@ -0,0 +1,16 @@
+import json
+import pytest
+from zarrconverter import batch
+
+def job_file(tmp_path, jobs):
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(jobs))
+    return str(path)
+
+def test_load_jobs(tmp_path):
+    jobs = batch.load(job_file(tmp_path, [{"script": "CreateTcsif.py", "args": ["--packed"], "memory": "4GB"}]))
+    assert [(job.name, job.args, job.memory) for job in jobs] == [("1-CreateTcsif", ["--packed"], 4 * 10 ** 9)]
+
+def test_direct_jobs_are_refused(tmp_path):
+    with pytest.raises(ValueError, match="--direct"):
+        batch.load(job_file(tmp_path, [{"script": "CreateTcsif.py", "args": ["--direct"]}]))
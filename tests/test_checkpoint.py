@@ -0,0 +1,51 @@
+import numcodecs
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from zarrconverter import checkpoint
+
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3
+
+def dataset():
+    values = np.arange(4 * 4 * 8, dtype="float32").reshape(4, 4, 8)
+    return xr.Dataset({"gpp": (("time", "lat", "lon"), values)},
+                      coords={"time": np.arange(4), "lat": np.arange(4), "lon": np.arange(8)}).chunk(
+                          {"time": 1, "lat": 2, "lon": 4})
+
+# the scripts give the compressor of the encoding in the form of zarr v2
+ENCODING = {"gpp": {"compressor": numcodecs.Blosc(cname="zstd", clevel=5), "chunks": (1, 2, 4)}}
+
+@pytest.mark.parametrize("shards", [None, pytest.param({"time": 2, "lat": 4, "lon": 8}, marks=pytest.mark.skipif(
+    not ZARR_V3, reason="sharding needs zarr-python 3"))])
+def test_to_zarr(tmp_path, shards):
+    path = str(tmp_path / "out.zarr")
+    ds = dataset()
+    checkpoint.to_zarr(ds, path, encoding=ENCODING, shards=shards)
+    array = zarr.open_group(path)["gpp"]
+    if ZARR_V3:
+        assert array.metadata.zarr_format == (3 if shards else 2)
+    else:
+        assert array.compressor.cname == "zstd"
+    xr.testing.assert_identical(xr.open_zarr(path).load(), ds.load())
+
+def test_resume_skips_finished_blocks(tmp_path):
+    path = str(tmp_path / "out.zarr")
+    ds = dataset()
+    # an interrupted conversion: the store is created and the first block is in the manifest
+    manifest, _, _ = checkpoint.prepare(ds, path, ENCODING)
+    checkpoint.record(None, manifest, "0:1")
+    checkpoint.to_zarr(ds, path, encoding=ENCODING, resume=True)
+    stored = xr.open_zarr(path).load()
+    assert stored["gpp"].isel(time=0).isnull().all()
+    xr.testing.assert_identical(stored.isel(time=slice(1, None)), ds.isel(time=slice(1, None)).load())
+
+def test_pyramid_levels(tmp_path):
+    path = str(tmp_path / "out.zarr")
+    ds = dataset()
+    checkpoint.to_zarr(ds, path, encoding=ENCODING, overviews={"levels": 1, "dims": ("lat", "lon")})
+    level = xr.open_zarr(path, group="1").load()
+    assert dict(level.sizes) == {"time": 4, "lat": 2, "lon": 4}
+    expected = ds["gpp"].coarsen(lat=2, lon=2).mean().load()
+    np.testing.assert_allclose(level["gpp"].values, expected.values)
+    assert "multiscales" in xr.open_zarr(path).attrs
@@ -0,0 +1,32 @@
+import numpy as np
+import xarray as xr
+import zarr
+from zarrconverter import checkpoint, chunkstats
+
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3
+
+def dataset(steps=6):
+    values = np.arange(steps * 4 * 8, dtype="float32").reshape(steps, 4, 8)
+    values[:, :2, :4] = np.nan
+    return xr.Dataset({"gpp": (("time", "lat", "lon"), values)},
+                      coords={"time": np.arange(steps), "lat": np.arange(4), "lon": np.arange(8)}).chunk(
+                          {"time": 1, "lat": 2, "lon": 4})
+
+def test_refresh_after_append(tmp_path):
+    # zarr v3 with shards under zarr-python 3, where xarray stores the float _FillValue base64 encoded
+    path = str(tmp_path / "out.zarr")
+    ds = dataset()
+    checkpoint.to_zarr(ds.isel(time=slice(0, 4)), path, shards={"time": 2, "lat": 4, "lon": 8} if ZARR_V3 else None)
+    # every appended shard is written by one dask chunk, like store_chunks of netcdf2zarr.py does
+    appended = ds.isel(time=slice(4, 6)).chunk({"time": 2, "lat": 4, "lon": 8} if ZARR_V3 else {})
+    appended.to_zarr(path, append_dim="time", consolidated=False, write_empty_chunks=False)
+    empty = chunkstats.refresh(path, 4, 6)
+    zarr.consolidate_metadata(path)
+    assert empty == 2
+    assert chunkstats.array_decoding(zarr.open_group(path)["gpp"])["fill_values"] == []
+    stats = zarr.open_group(path)[chunkstats.GROUP + "/gpp"][...]
+    assert stats.shape == (6, 2, 2, len(chunkstats.STATISTICS))
+    valid = stats[..., chunkstats.STATISTICS.index("valid")]
+    assert valid[5].tolist() == [[0, 8], [8, 8]]
+    assert stats[5, 1, 1, chunkstats.STATISTICS.index("max")] == ds["gpp"][5, 2:, 4:].max()
+    xr.testing.assert_identical(xr.open_zarr(path).load(), ds.load())
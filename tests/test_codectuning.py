@@ -0,0 +1,22 @@
+import numpy as np
+import dask.array as da
+from zarrconverter import codectuning
+
+class Source:
+    """Array of zeros that records the requested slices"""
+    def __init__(self, shape):
+        self.shape, self.dtype, self.ndim = shape, np.dtype("float32"), len(shape)
+        self.requests = []
+
+    def __getitem__(self, key):
+        self.requests.append(key)
+        return np.zeros(self.shape, self.dtype)[key]
+
+def test_sample_chunks_reads_a_bounded_window():
+    source = Source((4, 600, 800))
+    data = da.from_array(source, chunks=(2, 600, 800))
+    chunks = codectuning.sample_chunks(data, samples=2, max_bytes=100 * 800 * 4)
+    # whole rows of the last axis from the middle of every chunk
+    assert [chunk.shape for chunk in chunks] == [(1, 100, 800)] * 2
+    read = [key for key in source.requests if key[0].stop]
+    assert [key[1] for key in read] == [slice(250, 350)] * 2
@@ -0,0 +1,63 @@
+import uuid
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from zarrconverter import objectstore
+
+pytestmark = pytest.mark.skipif(int(zarr.__version__.split(".")[0]) >= 3,
+                                reason="UploadStore is a zarr-python 2 store")
+
+def dataset():
+    values = np.arange(4 * 6 * 8, dtype="float32").reshape(4, 6, 8)
+    return xr.Dataset({"gpp": (("time", "lat", "lon"), values)},
+                      coords={"time": np.arange(4), "lat": np.arange(6), "lon": np.arange(8)})
+
+def write(url, store):
+    ds = dataset()
+    ds.to_zarr(store, mode="w", encoding={"gpp": {"chunks": (1, 3, 4)}}, consolidated=False, compute=True)
+    objectstore.commit(store)
+    return ds
+
+def test_memory_round_trip():
+    url = "memory://test-%s/out.zarr" % uuid.uuid4().hex
+    store = objectstore.open_store(url, concurrency=4)
+    assert isinstance(store, objectstore.UploadStore)
+    ds = write(url, store)
+    # the metadata is only uploaded by commit, the root group last
+    assert store.fs.exists(store.path(".zmetadata"))
+    xr.testing.assert_identical(xr.open_zarr(objectstore.mapper(url), consolidated=True).load(), ds)
+
+def test_failed_upload_is_retried(monkeypatch):
+    url = "memory://test-%s/out.zarr" % uuid.uuid4().hex
+    store = objectstore.open_store(url, concurrency=4, retries=2)
+    pipe_file = store.fs.pipe_file
+    failed = set()
+
+    def flaky(path, value):
+        # the first upload of every chunk fails like a dropped connection
+        if not objectstore.is_metadata(path) and "/gpp/" in path and path not in failed:
+            failed.add(path)
+            raise OSError("connection reset")
+        return pipe_file(path, value)
+
+    monkeypatch.setattr(store.fs, "pipe_file", flaky)
+    monkeypatch.setattr(objectstore.time, "sleep", lambda seconds: None)
+    ds = write(url, store)
+    assert len(failed) == 16
+    xr.testing.assert_identical(xr.open_zarr(objectstore.mapper(url), consolidated=True).load(), ds)
+
+def test_upload_fails_after_the_retries(monkeypatch):
+    url = "memory://test-%s/out.zarr" % uuid.uuid4().hex
+    store = objectstore.open_store(url, concurrency=4, retries=1)
+    attempts = []
+
+    def broken(path, value):
+        attempts.append(path)
+        raise OSError("service unavailable")
+
+    monkeypatch.setattr(store.fs, "pipe_file", broken)
+    monkeypatch.setattr(objectstore.time, "sleep", lambda seconds: None)
+    with pytest.raises(OSError):
+        store["gpp/0.0.0"] = b"chunk"
+    assert attempts == [store.path("gpp/0.0.0")] * 2
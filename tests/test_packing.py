@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from zarrconverter import chunkstats, packing, pyramid
+
+def packed(fill_values=(65535, 65534)):
+    """A packed uint16 variable with a _FillValue and a missing_value like the packed GOSIF bands"""
+    data = np.array([[1, 2, 65535, 4], [65534, 6, 7, 8]], dtype="uint16")
+    return packing.pack(xr.DataArray(data, dims=("lat", "lon"), name="sif"), list(fill_values), scale_factor=0.0001)
+
+def test_fill_values_of_scalars_and_lists():
+    assert packing.fill_values(np.uint16(65535), [np.uint16(65534)], None) == [65535, 65534]
+    assert packing.fill_values(np.float32(np.nan), [-9999.0]) == [-9999.0]
+    assert packing.fill_values() == []
+
+def test_pyramid_of_packed_variable_with_two_fill_values():
+    var = packed()
+    assert pyramid.fill_values(var) == [65535, 65534]
+    mean = pyramid.masked_mean(var.values.reshape(1, 2, 2, 2), axis=(1, 3), fills=pyramid.fill_values(var))
+    assert mean.tolist() == [[3, 6]]
+
+def test_chunk_statistics_of_packed_variable_with_two_fill_values():
+    var = packed().variable
+    decoding = chunkstats.decoding(var)
+    assert decoding["fill_values"] == [65535.0, 65534.0]
+    low, high, mean, valid, missing = chunkstats.statistics(var.values, **decoding)
+    assert (low, high, valid, missing) == (pytest.approx(0.0001), pytest.approx(0.0008), 6, 0.25)
+
+def test_array_decoding_of_stored_packed_variable_with_two_fill_values():
+    array = zarr.array(packed().values, fill_value=65535)
+    array.attrs.update({"missing_value": [65534], "scale_factor": 0.0001})
+    assert sorted(set(chunkstats.array_decoding(array)["fill_values"])) == [65534.0, 65535.0]
+
+def test_packed_variable_decodes_to_float32():
+    var = packed()
+    assert var.attrs["scale_factor"].dtype == np.float32
+    with pytest.warns(xr.SerializationWarning, match="multiple fill values"):
+        decoded = xr.decode_cf(var.to_dataset())["sif"]
+    assert decoded.dtype == np.float32
+    assert np.isnan(decoded.values).sum() == 2
+
+def test_packed_variable_in_zarr_store(tmp_path):
+    path = str(tmp_path / "packed.zarr")
+    packed().to_dataset().to_zarr(path, mode="w", consolidated=True)
+    with pytest.warns(xr.SerializationWarning, match="multiple fill values"):
+        stored = xr.open_zarr(path)["sif"]
+    assert np.isnan(stored.values).sum() == 2
+    assert stored.values[0, 0] == pytest.approx(0.0001)
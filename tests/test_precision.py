@@ -0,0 +1,23 @@
+import numpy as np
+import xarray as xr
+from zarrconverter import precision
+
+def test_stored_dtype():
+    assert precision.stored_dtype("float64", ("float32", None)) == np.float32
+    assert precision.stored_dtype("float64", ("bits", 23)) == np.float32
+    assert precision.stored_dtype("float64", ("bits", 24)) == np.float64
+    # auto is only known after sampling, the plan keeps the dtype
+    assert precision.stored_dtype("float64", ("auto", 0.99)) == np.float64
+    assert precision.stored_dtype("float64", ("auto", 0.99), bits=7) == np.float32
+    assert precision.stored_dtype("float32", ("float32", None)) == np.float32
+
+def test_auto_keeps_float64_of_data_without_information():
+    rng = np.random.default_rng(0)
+    grid = np.add.outer(np.linspace(0, 3, 256), np.linspace(0, 3, 256))
+    ds = xr.Dataset({"noise": (("y", "x"), rng.random((256, 256))),
+                     "smooth": (("y", "x"), np.sin(grid) * 20 + 280)})
+    ds, encoding = precision.apply(ds, {}, ["auto"])
+    # random bits carry no real information, nothing is rounded and the dtype stays
+    assert "dtype" not in encoding["noise"] and "filters" not in encoding["noise"]
+    assert encoding["smooth"]["dtype"] == "float32"
+    assert ds["noise"].attrs["max_relative_error"] == 0
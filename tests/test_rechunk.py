@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from zarrconverter import checkpoint, rechunk
+
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3
+
+@pytest.mark.parametrize("shards", [None, pytest.param({"time": 2, "lat": 32, "lon": 32}, marks=pytest.mark.skipif(
+    not ZARR_V3, reason="sharding needs zarr-python 3"))])
+def test_rechunk_through_intermediate(tmp_path, shards):
+    source, target = str(tmp_path / "source.zarr"), str(tmp_path / "target.zarr")
+    values = np.arange(16 * 32 * 32, dtype="float32").reshape(16, 32, 32)
+    ds = xr.Dataset({"gpp": (("time", "lat", "lon"), values)},
+                    coords={"time": np.arange(16), "lat": np.arange(32), "lon": np.arange(32)}).chunk(
+                        {"time": 1, "lat": 32, "lon": 32})
+    checkpoint.to_zarr(ds, source, shards=shards)
+    zarr.consolidate_metadata(source)
+    assert len(rechunk.plan((16, 32, 32), (1, 32, 32), (16, 4, 4), 4, 40000)) == 2
+    rechunk.rechunk(source, target, {"time": 16, "lat": 4, "lon": 4}, max_mem=40000)
+    assert zarr.open_group(target)["gpp"].chunks == (16, 4, 4)
+    xr.testing.assert_identical(xr.open_zarr(target).load(), ds.load())
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import xarray as xr
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from zarrconverter import subset
+
+def grid(west):
+    """A global grid of 10 degree cells from longitude west, with its grid mapping"""
+    lon = np.arange(west + 5, west + 360, 10.0)
+    lat = np.arange(85, -90, -10.0)
+    values = np.arange(len(lat) * len(lon), dtype="float32").reshape(len(lat), len(lon))
+    transform = from_origin(west, 90, 10, 10)
+    return xr.Dataset({"gpp": (("lat", "lon"), values),
+                       "crs": ((), 0, {"crs_wkt": CRS.from_epsg(4326).to_wkt(),
+                                       "GeoTransform": " ".join(str(value) for value in transform.to_gdal())})},
+                      coords={"lat": lat, "lon": lon})
+
+def test_box_in_negative_longitudes_on_grid_from_0_to_360():
+    ds = subset.select(grid(0), bbox=(-20, -10, 20, 10))
+    assert ds["lon"].values.tolist() == [345, 355, 365, 375]
+    assert ds["gpp"].values[0].tolist() == grid(0)["gpp"].sel(lat=5, lon=[345, 355, 5, 15]).values.tolist()
+    assert ds["crs"].attrs["GeoTransform"].split()[0] == "340.0"
+
+def test_box_across_the_antimeridian():
+    ds = subset.select(grid(-180), bbox=(160, -10, -160, 10))
+    assert ds["lon"].values.tolist() == [165, 175, 185, 195]
+    assert subset.select(grid(-180), bbox=(190, -10, 210, 10))["lon"].values.tolist() == [-165, -155]
+
+def test_box_across_the_edge_of_a_regional_grid():
+    with pytest.raises(ValueError, match="does not go around the globe"):
+        subset.longitude_columns(np.arange(-165, 170, 10.0), 160, -160)
+
+def test_tiff_window_cannot_wrap_around():
+    transform = from_origin(0, 90, 10, 10)
+    assert subset.window(transform, 36, 18, (-30, -10, -10, 10), geographic=True).col_off == 33
+    with pytest.raises(ValueError, match="cannot wrap around"):
+        subset.window(transform, 36, 18, (-20, -10, 20, 10), geographic=True)
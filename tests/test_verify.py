@@ -0,0 +1,34 @@
+import numpy as np
+import xarray as xr
+from zarrconverter import packing, verify
+
+FILL_VALUES = [65535, 65534]
+
+def raw():
+    """Raw uint16 values of a TIFF band with two fill values"""
+    data = np.array([[[1, 2, 65535, 4], [65534, 6, 7, 8]]], dtype="uint16")
+    return xr.Dataset({"sif": (("time", "lat", "lon"), data)},
+                      coords={"time": [0], "lat": [0.5, -0.5], "lon": [0.5, 1.5, 2.5, 3.5]})
+
+def masked(fill_values):
+    ds = raw()
+    ds["sif"] = ds["sif"].where(~ds["sif"].isin(fill_values)).astype("float32")
+    return ds
+
+def test_verify_masks_the_raw_source(tmp_path):
+    path = str(tmp_path / "masked.zarr")
+    masked(FILL_VALUES).to_zarr(path, mode="w")
+    assert verify.verify(raw(), path, workers=1, fill_values=FILL_VALUES)["ok"]
+
+def test_verify_finds_a_wrong_mask_of_the_writer(tmp_path):
+    path = str(tmp_path / "masked.zarr")
+    masked(FILL_VALUES[:1]).to_zarr(path, mode="w")
+    summary = verify.verify(raw(), path, workers=1, fill_values=FILL_VALUES)
+    assert not summary["ok"] and summary["mismatches"] == 1
+
+def test_verify_scales_packed_integers(tmp_path):
+    path = str(tmp_path / "packed.zarr")
+    ds = raw()
+    ds["sif"] = packing.pack(ds["sif"], FILL_VALUES, scale_factor=0.0001)
+    ds.to_zarr(path, mode="w")
+    assert verify.verify(raw(), path, workers=1, fill_values=FILL_VALUES)["ok"]
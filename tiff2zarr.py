@@ -0,0 +1,165 @@
+import numpy as np
+import os
+import re
+import glob
+import datetime
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from zarrconverter import cli, dryrun, runreport, subset
+
+def main():
+
+    parser = cli.converter_parser("Convert a folder of GeoTIFF files (one file per time step) to Zarr format, optionally reprojected.", tiff=True)
+    parser.add_argument("tiff_dir", help="Folder with the GeoTIFF files")
+    parser.add_argument("zarr_dir", nargs="?", default=None,
+                        help="Path of the zarr store (default: the name of the folder with .zarr)")
+    parser.add_argument("--pattern", default="*.tif", help="File name pattern of the GeoTIFF files (default: *.tif)")
+    parser.add_argument("--date-regex", default=r"(\d{8})",
+                        help=r"Regular expression whose first group is the date in the file name (default: (\d{8}))")
+    parser.add_argument("--date-format", default="%Y%m%d",
+                        help="strptime format of the date, e.g. %%Y%%j for year and day of year (default: %%Y%%m%%d)")
+    parser.add_argument("--names", nargs="+", default=None,
+                        help="Names of the variables for the bands of the files (default: band_1, band_2, ...)")
+    parser.add_argument("--nodata", nargs="+", type=float, default=None,
+                        help="Fill values replaced by NaN (default: the nodata value of the files)")
+    parser.add_argument("--t-srs", default=None,
+                        help="Reproject the files to this CRS while they are read, e.g. EPSG:3035 (like gdalwarp -t_srs)")
+    parser.add_argument("--resolution", nargs="+", type=float, default=None,
+                        help="Resolution of the reprojected grid in units of the target CRS, one value or x and y (default: chosen like gdalwarp)")
+    parser.add_argument("--resampling", default="nearest", choices=[method.name for method in Resampling],
+                        help="GDAL resampling method for the reprojection (default: nearest)")
+    args = parser.parse_args()
+    report = runreport.RunReport(os.path.basename(__file__), progress=args.progress)
+
+    tiff_dir = args.tiff_dir.rstrip("/")
+    zarr_dir = args.output or args.zarr_dir or tiff_dir + ".zarr"
+
+    def FileDate(file):
+        # extract date from filename
+        match = re.search(args.date_regex, os.path.basename(file))
+        if match is None:
+            raise ValueError("No date matching %s in %s" % (args.date_regex, file))
+        return np.datetime64(datetime.datetime.strptime(match.group(1), args.date_format))
+
+    print("Reading TIFF headers...")
+
+    with report.stage("discover files"):
+        files = glob.glob(os.path.join(tiff_dir, args.pattern))
+        files.sort()
+    if not files:
+        raise SystemExit("No files matching %s in %s" % (args.pattern, tiff_dir))
+    # files outside of --time-range are never opened
+    files = subset.files_in_time(files, FileDate, args.time_range)
+    report.read_files(files)
+    # bands, nodata and CRS of the first file, the grids of all files are checked when the headers are read
+    with rasterio.open(files[0]) as first:
+        count, nodata, crs = first.count, first.nodata, first.crs
+    fill_values = args.nodata or ([nodata] if nodata is not None else None)
+    resolution = tuple(args.resolution) if args.resolution else None
+    if args.t_srs:
+        crs = CRS.from_user_input(args.t_srs)
+    # geographic grids get the dimension names of the other converters
+    y, x = ("lat", "lon") if crs is None or crs.is_geographic else ("y", "x")
+    names = args.names or ["band_%d" % band for band in range(1, count + 1)]
+    if len(names) != count:
+        raise SystemExit("%d names given for %d bands" % (len(names), count))
+    bands = dict(zip(range(1, count + 1), names))
+    selected = subset.bands(bands, args.variables)
+    if args.plan:
+        # only the file names and the header of the first file are read, nothing is converted
+        inputs = dryrun.tiffs(files, FileDate, selected, masked=fill_values is not None, y=y, x=x,
+                              crs=crs if args.t_srs or resolution else None, resolution=resolution,
+                              bbox=args.bbox, bbox_crs=args.bbox_crs)
+        dryrun.show(inputs, {"time": 1}, args.access, args.chunk_bytes, args.direct, cli.shards(args, ("time", y, x)),
+                    args.pyramid, (y, x), zarr_dir=zarr_dir, aggregates=args.aggregate, precisions=args.precision)
+        return
+
+    # the converters need xarray, dask and zarr, their import takes seconds and is not needed for --plan
+    import numcodecs
+    from zarrconverter import checkpoint, chunkplan, cluster, codectuning, objectstore, precision, tiffscan, tiffwriter, verify, warp
+    report.path = args.report or objectstore.local_path(zarr_dir, ".report.json")
+    with report.stage("open files"):
+        headers = tiffscan.scan(files, FileDate)
+        ref = tiffscan.check_grid(headers)
+        # the reprojection replaces the gdalwarp round trip over intermediate netCDF files,
+        # every block of the cube warps only its own window of the target grid
+        reprojection = None
+        if args.t_srs or resolution:
+            reprojection = warp.options(headers, crs, resolution, args.resampling,
+                                        fill_values[0] if fill_values else None)
+            ref = warp.warp_headers([ref], reprojection)[0]
+        # only the tiles inside --bbox are read (and warped), the box is a window of the target grid
+        window = subset.tiff_window(ref, args.bbox, args.bbox_crs)
+
+        def open_dataset(chunks=None, masked=True):
+            mask = fill_values if masked else None
+            if reprojection:
+                cube = warp.open_cube(headers, reprojection, mask, chunks, y, x, window)
+            else:
+                cube = tiffscan.open_cube(headers, mask, chunks, y, x, window=window)
+            return subset.variables(cube.to_dataset(dim="band").rename_vars(bands), args.variables)
+        ds = open_dataset()
+
+    # set chunking
+    with report.stage("build graph"):
+        chunks = {"time":1, y:ds.sizes[y], x:ds.sizes[x]}
+        if args.access:
+            chunks = chunkplan.plan_dataset(ds, args.chunk_bytes, args.access)
+        # one block of the cube per chunk of the store, so a task reads (and warps) a single window
+        ds = open_dataset({y: chunks[y], x: chunks[x]}).chunk(chunks)
+    chunkplan.report(ds)
+
+    if not (args.direct or args.verify_only):
+        # the cluster is sized for the blocks of the chunk plan, GDAL reads scale with a few threads per process
+        with report.stage("start cluster"):
+            client = cluster.start("gdal", cluster.task_memory(ds), **cli.cluster(args))
+
+    for vname in ds.data_vars:
+        if fill_values:
+            ds[vname].attrs["_FillValue"] = np.nan
+    ds.attrs = {
+        "source":os.path.abspath(tiff_dir),
+        "history":"converted to zarr by tiff2zarr.py" + (" (reprojected to %s)" % ref.crs.to_string() if reprojection else ""),
+    }
+
+    compressor = numcodecs.Blosc(cname="zstd", clevel=3, shuffle=2)
+    encoding = {vname: {
+        'compressor': compressor,
+        } for vname in ds.data_vars}
+    if args.tune_codecs:
+        with report.stage("tune codecs"):
+            encoding = codectuning.tune(ds, encoding, min_ratio=args.min_ratio, report=objectstore.local_path(zarr_dir, ".codecs.json"))
+    if args.precision:
+        with report.stage("precision"):
+            ds, encoding = precision.apply(ds, encoding, args.precision)
+
+    if not args.verify_only:
+        print("Writing Zarr files...")
+
+        if args.direct:
+            tiffwriter.to_zarr(ds, zarr_dir, headers, selected, encoding=encoding, fill_values=fill_values,
+                               resume=args.resume, workers=args.workers, report=report,
+                               shards=cli.shards(args, ("time", y, x)), overviews=cli.overviews(args, (y, x)),
+                               storage=cli.storage(args), warp=reprojection, window=window,
+                               aggregates=cli.aggregates(args))
+            report.measure_memory()
+        else:
+            checkpoint.to_zarr(ds, zarr_dir, encoding=encoding, resume=args.resume, report=report,
+                               shards=cli.shards(args, ("time", y, x)), overviews=cli.overviews(args, (y, x)),
+                               storage=cli.storage(args), aggregates=cli.aggregates(args))
+            report.measure_memory(client)
+
+            cluster.stop(client)
+    verified = None
+    if args.verify or args.verify_only:
+        # the files are read again without the mask of the writer, verify masks the fill values itself
+        source = open_dataset({y: chunks[y], x: chunks[x]}, masked=False)
+        verified = verify.verify(source, zarr_dir, *args.tolerance, workers=args.workers, report=report,
+                                 storage_options=args.storage_options, fill_values=fill_values)
+    report.write()
+    if verified is not None and not verified["ok"]:
+        raise SystemExit("The zarr store does not match the source files, see " + verify.manifest_path(zarr_dir))
+
+if __name__ == '__main__':
+    main()
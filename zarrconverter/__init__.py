@@ -0,0 +1 @@
+# Shared helpers for the converter scripts (netcdf2zarr.py, createDatacube.py and Create*.py)
@@ -0,0 +1,202 @@
+# Temporal aggregates written in the same pass as the native time steps.
+#
+# Monthly or annual means, minima, maxima, sums and counts of valid observations
+# are computed while the source time slices stream through the writer instead of
+# reading the finished store again. Every aggregate is kept as a running
+# Accumulator of the count, sum, minimum and maximum of the valid cells of one
+# output period: in the task graph the accumulators of a period are reduced from
+# the same blocks that are written (so dask reads every block once and keeps about
+# one period per spatial block), the direct writer of TIFF cubes adds one file
+# after the other. Every product is written to its own group of the store, e.g.
+# "monthly_mean", with the native spatial chunks and one chunk per period.
+#
+# Missing values (NaN or the fill values of packed integers) are left out, and a
+# QualityFlag leaves out the cells whose quality band is not good enough.
+#
+# Only numpy is imported here, the specs are parsed by cli.py and dryrun.py too.
+
+import collections
+import numpy as np
+
+# numpy datetime64 unit of the periods
+PERIODS = {"monthly": "M", "annual": "Y"}
+REDUCTIONS = ("mean", "min", "max", "sum", "count")
+CELL_METHODS = {"mean": "mean", "min": "minimum", "max": "maximum", "sum": "sum"}
+# attributes of packed integers that do not apply to the aggregated floats
+PACKING = ("_FillValue", "missing_value", "scale_factor", "add_offset", "Scale_Factor")
+COUNT_DTYPE = "int16"
+
+def parse(spec):
+    """(period, reduction) of a spec like monthly:mean"""
+    period, _, reduction = spec.partition(":")
+    if period not in PERIODS or reduction not in REDUCTIONS:
+        raise ValueError("Unknown aggregate %r, use PERIOD:REDUCTION with PERIOD one of %s and REDUCTION one of %s"
+                         % (spec, ", ".join(PERIODS), ", ".join(REDUCTIONS)))
+    return period, reduction
+
+def group_name(period, reduction):
+    """Group of the store for an aggregate"""
+    return "%s_%s" % (period, reduction)
+
+def labels(times, period):
+    """Start of the period of every time stamp"""
+    return np.asarray(times, dtype="datetime64[ns]").astype("datetime64[%s]" % PERIODS[period])
+
+def runs(times, period):
+    """(start of the period, first index, stop index) of the periods of sorted time stamps"""
+    periods = labels(times, period)
+    if len(periods) > 1 and (np.diff(periods.astype("int64")) < 0).any():
+        raise ValueError("Aggregates need the time steps in ascending order")
+    bounds = [0] + [i for i in range(1, len(periods)) if periods[i] != periods[i - 1]] + [len(periods)]
+    return [(periods[start], start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def streams(times, specs):
+    """Runs of sorted time stamps that hold whole periods of all specs, for writers that add one time step after the other
+
+    Returns [(first index, stop index, {period: [(index of the period, first index, stop index)]})].
+    """
+    periods = dict.fromkeys(parse(spec)[0] for spec in specs)
+    coarsest = "annual" if "annual" in periods else "monthly"
+    numbered = {period: list(enumerate(runs(times, period))) for period in periods}
+    return [(start, stop, {period: [(index, first, last) for index, (_, first, last) in numbered[period]
+                                    if start <= first and last <= stop] for period in periods})
+            for _, start, stop in runs(times, coarsest)]
+
+class QualityFlag(collections.namedtuple("QualityFlag", ["variable", "digit", "good", "digits"])):
+    """A cell counts for the aggregates if the decimal digit at position digit (from the left of a code of digits digits) of variable is in good
+
+    Fill values of the quality variable never count.
+    """
+
+    def __new__(cls, variable, digit, good, digits=3):
+        return super().__new__(cls, variable, digit, tuple(good), digits)
+
+    def mask(self, values):
+        """True where the quality code values is good, for numpy or dask arrays"""
+        with np.errstate(invalid="ignore"):
+            digit = values // 10 ** (self.digits - self.digit) % 10
+            return np.isin(digit, self.good) & (values < 10 ** self.digits)
+
+    def describe(self):
+        return "only cells whose digit %d of %s is one of %s" % (self.digit, self.variable, list(self.good))
+
+def decode(values, fill_values=(), scale_factor=None, add_offset=None):
+    """Floats of raw values with NaN for missing cells, packed integers are unpacked (see chunkstats.decoding)"""
+    dtype = np.promote_types(values.dtype, "float32")
+    decoded = values.astype(dtype)
+    if len(fill_values):
+        decoded = np.where(np.isin(values, fill_values), np.nan, decoded).astype(dtype)
+    if scale_factor is not None:
+        decoded = decoded * dtype.type(scale_factor)
+    if add_offset is not None:
+        decoded = decoded + dtype.type(add_offset)
+    return decoded
+
+class Accumulator:
+    """Running count, sum, minimum and maximum of the valid values of one period, for numpy or dask arrays"""
+
+    def __init__(self):
+        self.count = self.sum = self.min = self.max = None
+
+    def add(self, values):
+        """Add a stack of time steps along the first axis, NaN are missing values"""
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0, dtype=COUNT_DTYPE)
+        total = np.where(valid, values, 0).sum(axis=0, dtype="float64")
+        low = np.where(valid, values, np.inf).min(axis=0)
+        high = np.where(valid, values, -np.inf).max(axis=0)
+        if self.count is None:
+            self.count, self.sum, self.min, self.max = count, total, low, high
+        else:
+            self.count = self.count + count
+            self.sum = self.sum + total
+            self.min = np.minimum(self.min, low)
+            self.max = np.maximum(self.max, high)
+        return self
+
+    def result(self, reduction, dtype):
+        """The aggregate of the period, NaN where no value was valid (counts are 0 there)"""
+        if reduction == "count":
+            return self.count
+        empty = self.count == 0
+        if reduction == "mean":
+            value = self.sum / np.where(empty, 1, self.count)
+        else:
+            value = {"sum": self.sum, "min": self.min, "max": self.max}[reduction]
+        return np.where(empty, np.nan, value).astype(dtype)
+
+def product_attrs(attrs, name, period, reduction, quality=None):
+    """Attributes of an aggregated variable"""
+    attrs = {key: value for key, value in attrs.items() if key not in PACKING}
+    if reduction == "count":
+        attrs = {"long_name": "number of valid observations of %s" % attrs.get("long_name", name), "units": "1"}
+    else:
+        attrs["cell_methods"] = "time: %s" % CELL_METHODS[reduction]
+        attrs["_FillValue"] = np.nan
+    attrs["aggregation"] = "%s %s of the valid values" % (period, reduction)
+    if quality is not None:
+        attrs["quality"] = quality.describe()
+    return attrs
+
+def product_encoding(encoding, names):
+    """Encoding of the aggregated variables names, the compressor of the source without its chunks, filters and packing"""
+    return {vname: {key: value for key, value in settings.items() if key in ("compressor", "compressors")}
+            for vname, settings in (encoding or {}).items() if vname in names}
+
+def variables(ds, categorical=(), dim="time"):
+    """Names of the data variables that are aggregated, numeric ones along dim without the categorical ones"""
+    return [vname for vname, var in ds.data_vars.items()
+            if dim in var.dims and var.dtype.kind in "fiu" and vname not in categorical]
+
+def check_quality(quality, selected):
+    """Raise a ValueError if the aggregates of a selected variable need a quality variable that is not selected
+
+    quality maps variables to a QualityFlag, selected are the names of the
+    variables that are converted.
+    """
+    selected = list(selected)
+    for vname, flag in (quality or {}).items():
+        if vname in selected and flag.variable not in selected:
+            raise ValueError("--aggregate: the aggregates of %s only use the cells whose %s is good, add %s to --variables"
+                             % (vname, flag.variable, flag.variable))
+
+def build(ds, encoding, specs, quality=None, categorical=(), dim="time"):
+    """List of (group, dataset, encoding) of the aggregates specs (e.g. ["monthly:mean"]) of the data variables of ds
+
+    The data of the aggregates is reduced lazily from the dask arrays of ds,
+    so they are computed from the blocks that the writer reads anyway.
+    quality maps variables to a QualityFlag, categorical variables such as
+    quality bands are not aggregated.
+    """
+    import dask.array as da
+    import xarray as xr
+    from zarrconverter import chunkstats
+    quality = quality or {}
+    names = variables(ds, categorical, dim)
+    specs = [parse(spec) for spec in specs]
+    for vname, flag in quality.items():
+        if vname in names and flag.variable not in ds:
+            raise ValueError("The aggregates of %s need the quality variable %s" % (vname, flag.variable))
+    coords = {name: coord for name, coord in ds.coords.items() if dim not in coord.dims}
+    attrs = {key: value for key, value in ds.attrs.items() if key != "multiscales"}
+    products = []
+    for period in dict.fromkeys(period for period, _ in specs):
+        periods = runs(ds[dim].values, period)
+        accumulators = {}
+        for vname in names:
+            var = ds[vname].transpose(dim, ...)
+            values = decode(var.data, **chunkstats.decoding(var.variable))
+            if vname in quality:
+                values = np.where(quality[vname].mask(ds[quality[vname].variable].transpose(dim, ...).data), values, np.nan)
+            accumulators[vname] = (var, values.dtype, [Accumulator().add(values[start:stop]) for _, start, stop in periods])
+        for reduction in [reduction for p, reduction in specs if p == period]:
+            data_vars = {}
+            for vname, (var, dtype, accs) in accumulators.items():
+                dtype = COUNT_DTYPE if reduction == "count" else dtype
+                data = da.stack([acc.result(reduction, dtype) for acc in accs])
+                data_vars[vname] = xr.Variable(var.dims, data, product_attrs(var.attrs, vname, period, reduction, quality.get(vname)))
+            times = np.array([label for label, _, _ in periods], dtype="datetime64[ns]")
+            product = xr.Dataset(data_vars, coords={**coords, dim: (dim, times, ds[dim].attrs)},
+                                 attrs={**attrs, "aggregation": "%s %s" % (period, reduction)})
+            products.append((group_name(period, reduction), product, product_encoding(encoding, names)))
+    return products
@@ -0,0 +1,221 @@
+# Batch conversions of many datasets on one shared dask cluster.
+#
+# The converter scripts run as child processes (like in benchmark.py) that all
+# connect to the same long-lived cluster instead of starting and stopping their
+# own. Their tasks meet in the task queue of the dask scheduler, the priority of
+# a job is passed on to all of its tasks (see cluster.priority), so a big job
+# does not starve an urgent one and small jobs fill the gaps of the big ones.
+# Jobs are started by priority as long as the sum of their memory budgets fits
+# into the memory of the batch, a smaller job may start before a bigger one that
+# has to wait for memory. A failed job is started again up to its number of
+# retries, with --resume so that it continues from its manifest. The output of
+# every job goes to its own log file, from which the progress is read.
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import subprocess
+from datetime import datetime
+from dask.utils import format_bytes, parse_bytes
+
+# keys of a job in the job file and their defaults
+DEFAULTS = {"name": None, "script": None, "args": [], "cwd": None, "priority": 0, "memory": "2GB", "retries": 0,
+            "resume": True}
+# options of the scripts that write without the cluster, outside of the memory budget of the batch
+OWN_WORKERS = ("--direct",)
+# option of a script for the address of the cluster, netcdf2zarr.py only uses a cluster with -d, its
+# jobs give "-d", "-ds", "{scheduler}" in their arguments
+SCHEDULER_OPTIONS = {"netcdf2zarr.py": None}
+# progress lines of the converters: runreport.watch, tiffwriter and verify
+PROGRESS = re.compile(r"(\d+) of (\d+) (blocks|files|chunks)")
+# bytes at the end of a log searched for the progress
+TAIL = 4096
+
+class Job:
+    """One conversion of the batch: a converter script with its arguments, priority, memory budget and retries"""
+
+    def __init__(self, name, script, args=(), cwd=None, priority=0, memory="2GB", retries=0, resume=True):
+        self.name = name
+        self.script = script
+        self.args = list(args)
+        self.cwd = cwd
+        self.priority = priority
+        self.memory = parse_bytes(memory) if isinstance(memory, str) else int(memory)
+        self.retries = retries
+        self.resume = resume
+        self.state = "queued"
+        self.attempts = 0
+        self.exit_codes = []
+        self.wall_s = 0.0
+        self.log = None
+        self.proc = None
+        self.started = None
+
+    def command(self, address, root):
+        """Command line of the current attempt, {scheduler} in the arguments is replaced by address"""
+        args = [arg.replace("{scheduler}", address) for arg in self.args]
+        option = SCHEDULER_OPTIONS.get(os.path.basename(self.script), "--scheduler")
+        if option and not any("{scheduler}" in arg for arg in self.args):
+            args += [option, address]
+        if "--progress" not in args:
+            args.append("--progress")
+        # a retry continues where the failed attempt stopped
+        if self.attempts > 1 and self.resume and "--resume" not in args:
+            args.append("--resume")
+        return [sys.executable, os.path.join(root, self.script)] + args
+
+    def progress(self):
+        """(done, total, unit) of the last progress line in the log, None before the first one"""
+        if not self.log or not os.path.exists(self.log):
+            return None
+        with open(self.log, "rb") as f:
+            f.seek(max(0, os.path.getsize(self.log) - TAIL))
+            tail = f.read().decode(errors="replace")
+        matches = PROGRESS.findall(tail)
+        return (int(matches[-1][0]), int(matches[-1][1]), matches[-1][2]) if matches else None
+
+    def status(self):
+        """Short description of the state and the progress"""
+        progress = self.progress() if self.state == "running" else None
+        text = self.state + (" (attempt %d)" % self.attempts if self.attempts > 1 else "")
+        if progress:
+            done, total, unit = progress
+            text += ", %d of %d %s (%.0f%%)" % (done, total, unit, 100 * done / max(1, total))
+        if self.started is not None:
+            text += ", %.0f s" % (self.wall_s + (time.perf_counter() - self.started if self.state == "running" else 0))
+        return text
+
+    def summary(self):
+        """Entry of the job in the batch report"""
+        return {"script": self.script, "args": self.args, "cwd": self.cwd, "priority": self.priority,
+                "memory": self.memory, "state": self.state, "attempts": self.attempts, "exit_codes": self.exit_codes,
+                "wall_s": self.wall_s, "log": self.log}
+
+def load(path):
+    """Jobs of a JSON job file, a list of {"script": ..., "args": [...], "priority": ..., "memory": ..., ...}
+
+    Relative working directories are relative to the job file, which is the
+    working directory of jobs without one. Jobs with --direct are refused,
+    they would not run on the cluster.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for number, entry in enumerate(entries, 1):
+        unknown = set(entry) - set(DEFAULTS)
+        if unknown or "script" not in entry:
+            raise ValueError("Job %d of %s needs a script and knows only the keys %s, not %s"
+                             % (number, path, ", ".join(DEFAULTS), ", ".join(sorted(unknown)) or "-"))
+        settings = {**DEFAULTS, **entry}
+        own = [arg for arg in settings["args"] if arg in OWN_WORKERS]
+        if own:
+            raise ValueError("Job %d of %s: %s writes with a process pool of its own instead of the shared cluster, "
+                             "its memory is not bounded by the batch, run it on its own" % (number, path, own[0]))
+        settings["name"] = settings["name"] or "%d-%s" % (number, os.path.splitext(os.path.basename(entry["script"]))[0])
+        settings["cwd"] = os.path.join(base, settings["cwd"] or "")
+        jobs.append(Job(**settings))
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("The names of the jobs in %s are not unique" % path)
+    return jobs
+
+def start(job, address, root, log_dir):
+    """Start the next attempt of job as a child process connected to the cluster at address"""
+    job.attempts += 1
+    job.state = "running"
+    job.log = os.path.join(log_dir, job.name + ".log")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    # read by cluster.priority through the dask configuration of the child
+    env["DASK_ZARRCONVERTER__PRIORITY"] = str(job.priority)
+    command = job.command(address, root)
+    with open(job.log, "a") as output:
+        output.write("=== attempt %d, %s: %s\n" % (job.attempts, datetime.now().isoformat(timespec="seconds"),
+                                                   " ".join(command)))
+        output.flush()
+        job.proc = subprocess.Popen(command, cwd=job.cwd, env=env, stdin=subprocess.DEVNULL, stdout=output,
+                                    stderr=subprocess.STDOUT)
+    job.started = time.perf_counter()
+    print("%s: started attempt %d (priority %d, %s)" % (job.name, job.attempts, job.priority, format_bytes(job.memory)))
+
+def finish(job, code):
+    """Record the end of the running attempt of job, True if it is queued again for a retry"""
+    job.wall_s += time.perf_counter() - job.started
+    job.exit_codes.append(code)
+    job.proc = None
+    if code == 0:
+        job.state = "done"
+        print("%s: done after %.0f s" % (job.name, job.wall_s))
+        return False
+    if job.attempts <= job.retries:
+        job.state = "queued"
+        print("%s: failed with exit code %d, retry %d of %d, see %s" % (job.name, code, job.attempts, job.retries, job.log))
+        return True
+    job.state = "failed"
+    print("%s: failed with exit code %d, see %s" % (job.name, code, job.log))
+    return False
+
+def write(report, jobs, address, started):
+    """Write the batch report with the state of every job"""
+    with open(report, "w") as f:
+        json.dump({"started": started.isoformat(timespec="seconds"), "scheduler": address,
+                   "jobs": {job.name: job.summary() for job in jobs}}, f, indent=2)
+
+def run(jobs, address, memory, root, log_dir, report, max_jobs=4, interval=10.0, poll=0.5):
+    """Run jobs on the cluster at address, at most max_jobs at a time within memory bytes, returns the failed jobs
+
+    The progress of the running jobs is printed every interval seconds and
+    the report is written after every change.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    started = datetime.now()
+    queue = sorted(jobs, key=lambda job: -job.priority)
+    running = []
+    shown = time.perf_counter()
+    for job in jobs:
+        if job.memory > memory:
+            logging.warning("%s needs %s, more than the %s of the batch, it runs alone", job.name,
+                            format_bytes(job.memory), format_bytes(memory))
+    write(report, jobs, address, started)
+    try:
+        while queue or running:
+            changed = False
+            for job in list(running):
+                code = job.proc.poll()
+                if code is None:
+                    continue
+                running.remove(job)
+                if finish(job, code):
+                    # a retry keeps its place by priority, behind the queued jobs of the same priority
+                    queue.append(job)
+                    queue.sort(key=lambda job: -job.priority)
+                changed = True
+            free = memory - sum(job.memory for job in running)
+            for job in list(queue):
+                if len(running) >= max_jobs:
+                    break
+                # smaller jobs further down the queue fill the memory a bigger one is waiting for
+                if job.memory <= free or not running:
+                    start(job, address, root, log_dir)
+                    queue.remove(job)
+                    running.append(job)
+                    free -= job.memory
+                    changed = True
+            if changed:
+                write(report, jobs, address, started)
+            if running and time.perf_counter() - shown >= interval:
+                shown = time.perf_counter()
+                for job in running:
+                    print("  %s: %s" % (job.name, job.status()))
+            time.sleep(poll)
+    finally:
+        # an interrupted batch stops its running jobs, they can be resumed by the next batch
+        for job in running:
+            job.proc.terminate()
+            finish(job, job.proc.wait())
+        write(report, jobs, address, started)
+    return [job for job in jobs if job.state == "failed"]
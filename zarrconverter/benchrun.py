@@ -0,0 +1,119 @@
+# Running and measuring a converter script for benchmark.py.
+#
+# The script runs in a child process (see main), which counts the dask tasks it
+# computes: tasks of the local schedulers with a dask callback, tasks of a
+# distributed cluster started by the script with a scheduler plugin that is loaded
+# as a preload module of the scheduler. The benchmark process samples the
+# resident memory of all processes it started, the child and its dask workers.
+
+import os
+import sys
+import json
+import time
+import runpy
+import tempfile
+import threading
+import subprocess
+import psutil
+import dask
+from dask.callbacks import Callback
+from distributed.diagnostics.plugin import SchedulerPlugin
+from zarrconverter.runreport import du
+
+counts = {"tasks": 0}
+
+class LocalTaskCounter(Callback):
+    """Counts the tasks run by the threaded and the synchronous scheduler"""
+    def _posttask(self, key, result, dsk, state, id):
+        counts["tasks"] += 1
+
+class TaskCounter(SchedulerPlugin):
+    """Counts the tasks finished on a distributed cluster"""
+    name = "benchmark-task-counter"
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if finish == "memory":
+            counts["tasks"] += 1
+
+def dask_setup(scheduler):
+    """Entry point of the scheduler preload"""
+    scheduler.add_plugin(TaskCounter())
+
+def main():
+    """Run a script as __main__, called as: python -c "..." stats.json script.py [arguments]"""
+    stats, script, arguments = sys.argv[1], sys.argv[2], sys.argv[3:]
+    LocalTaskCounter().register()
+    dask.config.set({"distributed.scheduler.preload": [__name__]})
+    sys.argv = [script] + arguments
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        with open(stats, "w") as f:
+            json.dump(counts, f)
+
+class Monitor(threading.Thread):
+    """Peak resident memory of every process started by this process, sampled in the background"""
+    ignore = ("resource_tracker", "forkserver")
+
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.main = None
+        self.peaks = {}
+        self.ignored = set()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for proc in psutil.Process().children(recursive=True):
+            try:
+                if proc.pid in self.ignored:
+                    continue
+                if proc.pid not in self.peaks and any(name in " ".join(proc.cmdline()) for name in self.ignore):
+                    self.ignored.add(proc.pid)
+                    continue
+                self.peaks[proc.pid] = max(self.peaks.get(proc.pid, 0), proc.memory_info().rss)
+            except psutil.Error:
+                continue
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return {
+            "main": self.peaks.get(self.main, 0),
+            "workers": sorted(peak for pid, peak in self.peaks.items() if pid != self.main),
+        }
+
+def run(script, arguments, cwd, log, interval=0.2):
+    """Run script with arguments in cwd, output goes to the file log
+
+    Returns the exit code, the wall time, the number of dask tasks and the
+    peak resident memory of the script process and of every worker process.
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        stats = f.name
+    monitor = Monitor(interval)
+    monitor.start()
+    tasks = counts["tasks"]
+    start = time.perf_counter()
+    with open(log, "w") as output:
+        proc = subprocess.Popen([sys.executable, "-c", "from zarrconverter import benchrun; benchrun.main()",
+                                 stats, script] + list(arguments),
+                                cwd=cwd, env=env, stdout=output, stderr=subprocess.STDOUT)
+        monitor.main = proc.pid
+        code = proc.wait()
+    wall = time.perf_counter() - start
+    memory = monitor.stop()
+    # tasks of a cluster of this process (started by the benchmark) are counted here as well
+    tasks = counts["tasks"] - tasks
+    if os.path.getsize(stats):
+        with open(stats) as f:
+            tasks += json.load(f)["tasks"]
+    os.remove(stats)
+    return {"exit_code": code, "wall_s": wall, "tasks": tasks, "peak_rss": memory}
@@ -0,0 +1,226 @@
+# Checkpointed writing of a dataset to zarr.
+#
+# The dataset is written block by block along the time dimension. Every finished
+# block is recorded in a manifest file next to the store, so an interrupted run can
+# be resumed and only the missing blocks are computed again. Metadata is
+# consolidated once at the very end and the manifest is removed afterwards. The
+# store may also be an fsspec URL, see objectstore, the manifest stays local then.
+# The levels of a multiscale pyramid are written in the same blocks, so a block
+# counts as finished when the full resolution and all levels are stored. Temporal
+# aggregates (see aggregate.py) are reduced from the same blocks in the same
+# computation, every period of a product is recorded in the manifest. Chunks
+# that only hold the fill value are not written and the statistics of every
+# chunk are stored as an index in the group "chunkstats", see chunkstats.py.
+
+import os
+import math
+import json
+import logging
+import dask
+import dask.array as da
+import zarr
+from xarray import conventions
+from zarrconverter import aggregate, chunkstats, cluster, objectstore, pyramid, runreport, sharding
+
+def manifest_path(zarr_dir):
+    """Absolute path of the manifest file next to the zarr store, workers of a remote cluster have another working directory"""
+    return os.path.abspath(objectstore.local_path(zarr_dir, ".manifest"))
+
+def layout(ds, dim):
+    """Description of the blocks along dim, used to check that a manifest belongs to ds"""
+    chunks = ds.chunksizes.get(dim, (ds.sizes[dim],))
+    blocks = []
+    start = 0
+    for size in chunks:
+        blocks.append([start, start + size])
+        start += size
+    return {
+        "dim": dim,
+        "blocks": blocks,
+        "variables": {vname: list(ds[vname].shape) for vname in sorted(ds.data_vars)},
+    }
+
+def read_manifest(path):
+    """Return the layout and the set of finished blocks of a manifest"""
+    with open(path) as f:
+        lines = f.read().split("\n")
+    header = json.loads(lines[0])
+    # the last line may be cut off by a crash, only complete lines count
+    done = {line for line in lines[1:-1] if line}
+    return header, done
+
+def record(written, path, key):
+    """Append a finished block to the manifest with a single write, safe for concurrent workers"""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, (key + "\n").encode())
+    finally:
+        os.close(fd)
+    return key
+
+def create(ds, zarr_dir, encoding=None, dim="time", group=None, zarr_format=None):
+    """Write the metadata and all variables without dim, the variables along dim are written block by block later"""
+    # the encodings of the scripts are zarr v2 (compressor, filters), zarr-python 3 would write v3 by default;
+    # the format is only passed to zarr-python 3 and for sharded stores, older xarray versions do not know it
+    if zarr_format is None and chunkstats.zarr_v3():
+        zarr_format = 2
+        encoding = {vname: sharding.v2_encoding(settings) for vname, settings in (encoding or {}).items()}
+    options = {"zarr_format": zarr_format} if zarr_format else {}
+    ds.to_zarr(zarr_dir, mode="w", group=group, consolidated=False, compute=False, encoding=encoding, **options)
+    static = [vname for vname in ds.data_vars if dim not in ds[vname].dims]
+    if static:
+        ds[static].to_zarr(zarr_dir, mode="a", group=group, consolidated=False, compute=True)
+
+def create_all(ds, store, encoding, dim, zarr_format, levels, products=()):
+    """Create the root group and the groups of the pyramid levels and of the aggregates"""
+    create(ds, store, encoding, dim, zarr_format=zarr_format)
+    for level, (level_ds, level_encoding) in enumerate(levels, 1):
+        create(level_ds, store, level_encoding, dim, group=str(level), zarr_format=zarr_format)
+    for group, product_ds, product_encoding in products:
+        create(product_ds, store, product_encoding, dim, group=group, zarr_format=zarr_format)
+
+def prepare(ds, zarr_dir, encoding=None, resume=False, dim="time", zarr_format=None, levels=(), store=None,
+            products=()):
+    """Create the store (or reuse it when resuming) and return the manifest path, the layout and the finished blocks
+
+    levels is the list of (dataset, encoding) of the pyramid levels from
+    pyramid.build, they are created as the groups "1", "2", ... of the store.
+    products is the list of (group, dataset, encoding) of aggregate.build.
+    store is the store from objectstore.open_store if zarr_dir is a URL.
+    """
+    store = zarr_dir if store is None else store
+    path = manifest_path(zarr_dir)
+    plan = layout(ds, dim)
+    if levels:
+        plan["levels"] = len(levels)
+    if products:
+        plan["products"] = {group: product_ds.sizes[dim] for group, product_ds, _ in products}
+    done = set()
+    if resume and os.path.exists(path) and objectstore.exists(zarr_dir, getattr(store, "storage_options", None)):
+        header, done = read_manifest(path)
+        if header != plan:
+            raise ValueError("The manifest " + path + " does not match the dataset, start again without resume")
+        logging.info("Resuming conversion, %d of %d blocks are already written", len(done), len(plan["blocks"]))
+        if isinstance(store, objectstore.UploadStore):
+            # the metadata of an object store is only uploaded at the end, it is created again without the chunks
+            store.keep_data = True
+            create_all(ds, store, encoding, dim, zarr_format, levels, products)
+            store.keep_data = False
+    else:
+        # metadata and all variables without dask are written directly, the data is written block by block
+        create_all(ds, store, encoding, dim, zarr_format, levels, products)
+        with open(path, "w") as f:
+            f.write(json.dumps(plan) + "\n")
+    return path, plan, done
+
+def finish(zarr_dir, store=None):
+    """Consolidate (or upload) the metadata once all blocks are written and remove the manifest"""
+    objectstore.commit(zarr_dir if store is None else store)
+    os.remove(manifest_path(zarr_dir))
+
+def encoded_variables(ds, encoding=None, dim="time"):
+    """Dask backed variables along dim in the form they are stored, encoded like ds.to_zarr does it"""
+    encoding = encoding or {}
+    variables = {}
+    for vname in ds.variables:
+        var = ds[vname].variable
+        if dim not in var.dims or var.chunks is None:
+            continue
+        var = var.copy(deep=False)
+        var.encoding = {**var.encoding, **encoding.get(vname, {})}
+        variables[vname] = conventions.encode_cf_variable(var, name=vname)
+    return variables
+
+def chunk_count(array, region):
+    """Number of chunks of the zarr array covered by region"""
+    return math.prod(math.ceil(len(range(*r.indices(n))) / c)
+                     for r, n, c in zip(region, array.shape, array.chunks))
+
+def to_zarr(ds, zarr_dir, encoding=None, resume=False, dim="time", report=None, shards=None, overviews=None,
+            storage=None, aggregates=None):
+    """Write ds to zarr_dir like ds.to_zarr(mode="w"), but resumable with a manifest of finished blocks
+
+    The stages and the written bytes and chunks are recorded in the
+    runreport.RunReport report if one is given. With shards {dim: size} a zarr
+    v3 store is written, the chunks of ds become the inner chunks of the shards.
+    overviews are the arguments of pyramid.build (levels, dims, categorical)
+    for a multiscale pyramid computed from the same blocks. aggregates are the
+    arguments of aggregate.build (specs, quality, categorical) for temporal
+    aggregates computed in the same pass. zarr_dir may be an fsspec URL,
+    storage are the arguments of objectstore.open_store then.
+    """
+    if shards:
+        ds, encoding = sharding.apply(ds, encoding, shards)
+    products = aggregate.build(ds, encoding, dim=dim, **aggregates) if aggregates else []
+    levels = []
+    if overviews:
+        ds, levels = pyramid.build(ds, encoding, **overviews)
+    storage = storage or {}
+    store = objectstore.open_store(zarr_dir, **storage)
+    stored = runreport.du(zarr_dir, storage.get("storage_options")) if resume else 0
+    with runreport.stage(report, "create store"):
+        path, plan, done = prepare(ds, zarr_dir, encoding, resume, dim, zarr_format=3 if shards else None,
+                                   levels=levels, store=store, products=products)
+
+    # the blocks are encoded once (fill values, scaling, time units) and stored straight into the zarr arrays,
+    # the data variables through a target that records the statistics of their chunks
+    with runreport.stage(report, "build graph"):
+        records = chunkstats.begin(zarr_dir, resume=bool(done))
+        variables = {}
+        for prefix, level_ds, level_encoding in [("", ds, encoding)] + [("%d/" % level, level_ds, level_encoding)
+                                                                         for level, (level_ds, level_encoding) in enumerate(levels, 1)]:
+            for vname, var in encoded_variables(level_ds, level_encoding, dim).items():
+                array = chunkstats.open_array(store, prefix + vname)
+                if vname in level_ds.data_vars and var.dtype.kind in "fiu":
+                    array = chunkstats.Target(prefix + vname, array, records, chunkstats.decoding(var))
+                variables[prefix + vname] = (array, var)
+        tasks = []
+        chunks = 0
+        for start, stop in plan["blocks"]:
+            key = "%d:%d" % (start, stop)
+            if key in done:
+                continue
+            sources, targets, regions = [], [], []
+            for array, var in variables.values():
+                region = tuple(slice(start, stop) if d == dim else slice(None) for d in var.dims)
+                sources.append(var.data[region])
+                targets.append(array)
+                regions.append(region)
+                chunks += chunk_count(getattr(array, "array", array), region)
+            written = da.store(sources, targets, regions=regions, lock=False, compute=False)
+            tasks.append(dask.delayed(record)(written, path, key))
+        # every period of an aggregate is stored once the accumulators of its blocks are reduced
+        for group, product_ds, product_encoding in products:
+            product_variables = []
+            for vname, var in encoded_variables(product_ds, product_encoding, dim).items():
+                array = chunkstats.open_array(store, group + "/" + vname)
+                if vname in product_ds.data_vars:
+                    array = chunkstats.Target(group + "/" + vname, array, records, chunkstats.decoding(var))
+                product_variables.append((array, var))
+            for index in range(product_ds.sizes[dim]):
+                key = "%s:%d:%d" % (group, index, index + 1)
+                if key in done:
+                    continue
+                regions = [tuple(slice(index, index + 1) if d == dim else slice(None) for d in var.dims)
+                           for _, var in product_variables]
+                chunks += sum(chunk_count(getattr(array, "array", array), region)
+                              for (array, _), region in zip(product_variables, regions))
+                written = da.store([var.data[region] for (_, var), region in zip(product_variables, regions)],
+                                   [array for array, _ in product_variables], regions=regions, lock=False, compute=False)
+                tasks.append(dask.delayed(record)(written, path, key))
+    logging.info("Writing %d blocks", len(tasks))
+    # every period of an aggregate is a line of the manifest as well
+    total = len(plan["blocks"]) + sum(plan.get("products", {}).values())
+    with runreport.stage(report, "compute and write"), runreport.watch(report, path, total):
+        # on a cluster shared by a batch of conversions the tasks of more urgent jobs run first
+        dask.compute(*tasks, priority=cluster.priority())
+
+    with runreport.stage(report, "consolidate metadata"):
+        empty = chunkstats.write(store, zarr_dir)
+        finish(zarr_dir, store)
+    logging.info("%d chunks only hold fill values and are not stored", empty)
+    if report is not None:
+        report.count("blocks_written", len(tasks))
+        report.count("chunks_written", chunks)
+        report.count("chunks_empty", empty)
+        report.count("bytes_written", runreport.du(zarr_dir, storage.get("storage_options")) - stored)
@@ -0,0 +1,123 @@
+# Planning of chunk shapes by size in bytes and access pattern.
+#
+# Chunks grow from the native tiling of the source (TIFF blocks, netCDF/HDF5 chunks,
+# kept as "preferred_chunks" in the encoding) in multiples of it until the target
+# size in bytes is reached. The access profile decides which dimensions grow:
+#   map         one time step per chunk, only the spatial dimensions grow
+#   timeseries  time grows first (up to the full length), then the spatial dimensions
+#   balanced    all dimensions grow so that every dimension has about the same number of chunks
+
+import math
+import numpy as np
+
+ACCESS = ["map", "timeseries", "balanced"]
+
+# chunks outside of this range are too small for parallel filesystems or too big for workers
+MIN_CHUNK_BYTES = 1 * 2**20
+MAX_CHUNK_BYTES = 256 * 2**20
+
+def format_bytes(n):
+    """Text of a number of bytes like dask.utils.format_bytes, without importing dask for --plan"""
+    for prefix, k in (("Pi", 2**50), ("Ti", 2**40), ("Gi", 2**30), ("Mi", 2**20), ("ki", 2**10)):
+        if n >= k * 0.9:
+            return "%.2f %sB" % (n / k, prefix)
+    return "%d B" % n
+
+def native_chunks(var):
+    """Chunking of the source of var along its dimensions, one element where nothing is known"""
+    preferred = var.encoding.get("preferred_chunks", {})
+    return {dim: preferred.get(dim, 1) for dim in var.dims}
+
+def stored_itemsize(var):
+    """Bytes per element of var in the store, packed variables are smaller than in memory"""
+    return np.dtype(var.encoding.get("dtype", var.dtype)).itemsize
+
+def plan(sizes, itemsize, target_bytes="64MB", access="balanced", native=None, time_dim="time"):
+    """Chunk shape {dim: size} for an array with sizes {dim: size}, about target_bytes per chunk"""
+    if isinstance(target_bytes, str):
+        from dask.utils import parse_bytes
+        target_bytes = parse_bytes(target_bytes)
+    if access not in ACCESS:
+        raise ValueError("access has to be one of " + ", ".join(ACCESS))
+    native = native or {}
+    unit = {dim: min(size, native.get(dim, 1)) for dim, size in sizes.items()}
+    if time_dim in unit:
+        unit[time_dim] = 1
+    chunks = dict(unit)
+
+    def nbytes(chunks):
+        return math.prod(chunks.values()) * itemsize
+
+    def grow(dims):
+        # double the dimension with the most chunks left, in multiples of its native chunk
+        dims = [dim for dim in dims if dim in chunks]
+        while dims:
+            dim = max(dims, key=lambda dim: sizes[dim] / chunks[dim])
+            size = min(sizes[dim], math.ceil(2 * chunks[dim] / unit[dim]) * unit[dim])
+            if size == chunks[dim] or nbytes({**chunks, dim: size}) > target_bytes:
+                dims.remove(dim)
+            else:
+                chunks[dim] = size
+
+    spatial = [dim for dim in sizes if dim != time_dim]
+    if access == "map":
+        grow(spatial)
+    elif access == "timeseries":
+        grow([time_dim])
+        grow(spatial)
+    else:
+        grow(list(sizes))
+    return chunks
+
+def plan_dataset(ds, target_bytes="64MB", access="balanced", time_dim="time"):
+    """One chunk shape for all data variables of ds, planned for the variable with the biggest elements"""
+    sizes, native, itemsize = {}, {}, 1
+    for vname in ds.data_vars:
+        var = ds[vname]
+        sizes.update(var.sizes)
+        for dim, size in native_chunks(var).items():
+            native[dim] = max(native.get(dim, 1), size)
+        itemsize = max(itemsize, stored_itemsize(var))
+    return plan(sizes, itemsize, target_bytes, access, native, time_dim)
+
+def describe(var, chunks, time_dim="time"):
+    """Chunk count, chunk size and the cost of reading a map and a time series of var"""
+    shape = [var.sizes[dim] for dim in var.dims]
+    chunk = [min(chunks.get(dim, size), size) for dim, size in zip(var.dims, shape)]
+    counts = [math.ceil(size / c) for size, c in zip(shape, chunk)]
+    chunk_bytes = math.prod(chunk) * stored_itemsize(var)
+    result = {
+        "chunks": chunk,
+        "chunk_bytes": chunk_bytes,
+        "chunk_count": math.prod(counts),
+    }
+    if time_dim in var.dims:
+        axis = var.dims.index(time_dim)
+        map_chunks = math.prod(counts) // counts[axis]
+        result["map_read"] = {"chunks": map_chunks, "bytes": map_chunks * chunk_bytes}
+        result["timeseries_read"] = {"chunks": counts[axis], "bytes": counts[axis] * chunk_bytes}
+    return result
+
+def report(ds, chunks=None, time_dim="time"):
+    """Print the chunk layout of all data variables, the number of files and the cost of typical reads"""
+    files = 1
+    summary = {}
+    for vname in ds.data_vars:
+        var = ds[vname]
+        var_chunks = chunks or dict(zip(var.dims, (c[0] for c in var.chunks or [[s] for s in var.shape])))
+        info = describe(var, var_chunks, time_dim)
+        summary[vname] = info
+        # one file per chunk and the metadata files of the array
+        files += info["chunk_count"] + 2
+        line = "%s: chunks %s of %s, %d chunks" % (vname, tuple(info["chunks"]), format_bytes(info["chunk_bytes"]), info["chunk_count"])
+        if "map_read" in info:
+            line += ", map read %d chunks (%s), time series read %d chunks (%s)" % (
+                info["map_read"]["chunks"], format_bytes(info["map_read"]["bytes"]),
+                info["timeseries_read"]["chunks"], format_bytes(info["timeseries_read"]["bytes"]))
+        print(line)
+        if info["chunk_bytes"] < MIN_CHUNK_BYTES:
+            print("Warning: chunks of %s are smaller than %s, this makes a lot of small files" % (vname, format_bytes(MIN_CHUNK_BYTES)))
+        if info["chunk_bytes"] > MAX_CHUNK_BYTES:
+            print("Warning: chunks of %s are bigger than %s, this needs a lot of memory per worker" % (vname, format_bytes(MAX_CHUNK_BYTES)))
+    print("%d files in the zarr store" % files)
+    return summary
@@ -0,0 +1,237 @@
+# Empty chunks and an index of statistics of every chunk.
+#
+# Land-only products are mostly fill values over the oceans. The arrays are
+# opened with write_empty_chunks=False, so a chunk that holds nothing but the
+# fill value is neither compressed nor written, and readers get the fill value
+# for it without a request. While a chunk is stored the minimum, maximum and
+# mean of its valid cells, their number and the fraction of missing cells are
+# recorded. The records of all tasks are appended to a file next to the store,
+# like the manifest of checkpoint.py, so they survive an interrupted run. When
+# the store is finished they become one small array per variable in the group
+# "chunkstats" of the store, with the chunk grid of the variable and the
+# statistics as last dimension. Analysis code finds the chunks with data (in a
+# range of values) from these arrays without reading any chunk, see regions.
+
+import os
+import json
+import math
+import itertools
+import numpy as np
+import zarr
+from zarrconverter import objectstore, packing
+
+GROUP = "chunkstats"
+STATISTICS = ("min", "max", "mean", "valid", "nan_fraction")
+# values of a chunk of the index arrays, the index of a variable is usually a single chunk
+INDEX_CHUNK = 2 ** 20
+
+def zarr_v3():
+    return int(zarr.__version__.split(".")[0]) >= 3
+
+def records_path(zarr_dir):
+    """Absolute path of the file with the records of the written chunks next to the store"""
+    return os.path.abspath(objectstore.local_path(zarr_dir, ".chunkstats.jsonl"))
+
+def begin(zarr_dir, resume=False):
+    """Start the records of a new store, the records of finished blocks are kept when resuming"""
+    path = records_path(zarr_dir)
+    if not (resume and os.path.exists(path)):
+        open(path, "w").close()
+    return path
+
+def open_array(store, path):
+    """Array of the store that skips writing chunks which only hold the fill value"""
+    if zarr_v3():
+        return zarr.open_array(store, mode="r+", path=path, config={"write_empty_chunks": False})
+    return zarr.open_array(store, mode="r+", path=path, write_empty_chunks=False)
+
+def decoding(var):
+    """Fill values, scale_factor and add_offset of an encoded variable (see checkpoint.encoded_variables)"""
+    fills = [var.attrs.get(name, var.encoding.get(name)) for name in ("_FillValue", "missing_value")]
+    fills = [float(value) for value in packing.fill_values(*fills)]
+    return {"fill_values": fills, "scale_factor": var.attrs.get("scale_factor"),
+            "add_offset": var.attrs.get("add_offset")}
+
+def attribute_fill_value(value, dtype):
+    """_FillValue attribute of an array in a store, xarray writes float fill values of zarr v3 base64 encoded"""
+    if isinstance(value, (str, bytes)):
+        from xarray.backends.zarr import FillValueCoder
+        return FillValueCoder.decode(value, dtype)
+    return value
+
+def array_decoding(array):
+    """Fill values, scale_factor and add_offset of an array in a store"""
+    attrs = array.attrs
+    fill_value = attribute_fill_value(attrs.get("_FillValue"), array.dtype)
+    fills = [float(value) for value in packing.fill_values(array.fill_value, fill_value, attrs.get("missing_value"))]
+    return {"fill_values": fills, "scale_factor": attrs.get("scale_factor"), "add_offset": attrs.get("add_offset")}
+
+def statistics(values, fill_values=(), scale_factor=None, add_offset=None):
+    """Minimum, maximum and mean of the valid cells (None without any), their number and the fraction of missing cells"""
+    missing = np.isnan(values) if values.dtype.kind == "f" else np.zeros(values.shape, bool)
+    if len(fill_values):
+        missing |= np.isin(values, fill_values)
+    valid = values[~missing]
+    if not valid.size:
+        return [None, None, None, 0, 1.0 if values.size else 0.0]
+    low, high, mean = float(valid.min()), float(valid.max()), float(valid.mean(dtype="float64"))
+    scale, offset = float(scale_factor) if scale_factor is not None else 1.0, float(add_offset or 0)
+    if scale_factor is not None or add_offset is not None:
+        low, high, mean = sorted((low * scale + offset, high * scale + offset)) + [mean * scale + offset]
+    return [low, high, mean, int(valid.size), 1 - valid.size / values.size]
+
+def chunk_shape(array):
+    """Shape of the chunks that are read, the inner chunks of a sharded array"""
+    return tuple(array.chunks)
+
+def chunk_records(name, array, region, values, decoding=None):
+    """Records of the statistics of all chunks of array inside region, values are the data of region"""
+    decoding = decoding or {}
+    region = tuple(slice(*r.indices(n)[:2]) for r, n in zip(region, array.shape))
+    chunks = chunk_shape(array)
+    records = []
+    for starts in itertools.product(*[range(r.start, r.stop, c) for r, c in zip(region, chunks)]):
+        window = tuple(slice(start - r.start, min(start + c, r.stop) - r.start) for start, r, c in zip(starts, region, chunks))
+        records.append({"array": name, "chunk": [start // c for start, c in zip(starts, chunks)],
+                        "stats": statistics(values[window], **decoding)})
+    return records
+
+def append(path, records):
+    """Append records with a single write, safe for concurrent workers like checkpoint.record"""
+    if not records:
+        return
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, "".join(json.dumps(record) + "\n" for record in records).encode())
+    finally:
+        os.close(fd)
+
+class Target:
+    """Target of dask.array.store that writes into a zarr array and records the statistics of the chunks"""
+
+    def __init__(self, name, array, path, decoding=None):
+        self.name = name
+        self.array = array
+        self.path = path
+        self.decoding = decoding
+
+    def __setitem__(self, region, values):
+        self.array[region] = values
+        append(self.path, chunk_records(self.name, self.array, region, np.asarray(values), self.decoding))
+
+def read_records(path):
+    """Statistics of every recorded chunk {array: {chunk: stats}}, complete lines only, later records win"""
+    with open(path) as f:
+        lines = f.read().split("\n")
+    records = {}
+    for line in lines[:-1]:
+        if line:
+            record = json.loads(line)
+            records.setdefault(record["array"], {})[tuple(record["chunk"])] = record["stats"]
+    return records
+
+def dimensions(array):
+    """Names of the dimensions of a zarr array written by xarray"""
+    names = getattr(getattr(array, "metadata", None), "dimension_names", None)
+    return list(names) if names else list(array.attrs["_ARRAY_DIMENSIONS"])
+
+def create_index(store, name, array):
+    """Empty index array for the chunk grid of the data array name, NaN for chunks without a record"""
+    grid = [math.ceil(size / chunk) for size, chunk in zip(array.shape, chunk_shape(array))]
+    shape = tuple(grid) + (len(STATISTICS),)
+    rows = max(1, INDEX_CHUNK // math.prod(shape[1:]))
+    chunks = (max(1, min(rows, shape[0])),) + shape[1:]
+    dims = [dim + "_chunk" for dim in dimensions(array)] + ["statistic"]
+    options = {}
+    zarr_format = getattr(getattr(array, "metadata", None), "zarr_format", 2)
+    if zarr_v3():
+        options["zarr_format"] = zarr_format
+        if zarr_format == 3:
+            options["dimension_names"] = dims
+    index = zarr.create(shape, chunks=chunks, dtype="f8", fill_value=np.nan, store=store, path=GROUP + "/" + name,
+                        overwrite=True, **options)
+    attrs = {"statistics": list(STATISTICS), "chunks": list(chunk_shape(array))}
+    if zarr_format == 2:
+        attrs["_ARRAY_DIMENSIONS"] = dims
+    index.attrs.update(attrs)
+    return index
+
+def set_rows(index, stats):
+    """Write {chunk: stats} into the index array"""
+    values = index[...]
+    for chunk, row in stats.items():
+        if all(c < n for c, n in zip(chunk, values.shape)):
+            values[chunk] = [np.nan if value is None else value for value in row]
+    index[...] = values
+
+def write(store, zarr_dir):
+    """Write the recorded statistics as index arrays into the store and remove the records
+
+    Returns the number of chunks without valid cells, which were not written.
+    """
+    path = records_path(zarr_dir)
+    records = read_records(path)
+    group = zarr.open_group(store, mode="r+")
+    empty = 0
+    for name, stats in sorted(records.items()):
+        set_rows(create_index(store, name, group[name]), stats)
+        empty += sum(1 for row in stats.values() if not row[STATISTICS.index("valid")])
+    if GROUP in group:
+        group[GROUP].attrs.update({"description": "statistics of the valid cells of every chunk of the variables "
+                                                  "with the same path, chunks without valid cells are not stored",
+                                   "statistics": list(STATISTICS)})
+    os.remove(path)
+    return empty
+
+def index_names(group):
+    """Paths of the arrays that have an index in the group chunkstats of group"""
+    index = group[GROUP]
+    if zarr_v3():
+        return sorted(path for path, node in index.members(max_depth=None) if isinstance(node, zarr.Array))
+    names = []
+    index.visititems(lambda path, node: names.append(path) if isinstance(node, zarr.Array) else None)
+    return sorted(names)
+
+def refresh(store, start, stop, dim="time"):
+    """Read the chunks of the time steps start to stop of all indexed arrays again and update their statistics
+
+    Used after an append or an update in place of an existing store, the
+    index arrays grow with the arrays. Stores without an index are left alone.
+    """
+    group = zarr.open_group(store, mode="r+")
+    if GROUP not in group:
+        return 0
+    empty = 0
+    for name in index_names(group):
+        array = open_array(store, name)
+        dims = dimensions(array)
+        region = tuple(slice(start, stop) if d == dim else slice(None) for d in dims)
+        index = group[GROUP + "/" + name]
+        grid = [math.ceil(size / chunk) for size, chunk in zip(array.shape, chunk_shape(array))]
+        if list(index.shape[:-1]) != grid:
+            index.resize(tuple(grid) + (len(STATISTICS),))
+        stats = {}
+        for record in chunk_records(name, array, region, array[region], array_decoding(array)):
+            stats[tuple(record["chunk"])] = record["stats"]
+            empty += not record["stats"][STATISTICS.index("valid")]
+        set_rows(index, stats)
+    return empty
+
+def regions(store, name, low=None, high=None):
+    """Regions (tuples of slices) of the chunks of the array name with valid cells between low and high
+
+    Chunks that hold no valid cell, or only values outside of [low, high],
+    are left out, without reading any chunk of the array.
+    """
+    group = zarr.open_group(store, mode="r")
+    index = group[GROUP + "/" + name]
+    shape = group[name].shape
+    chunks = index.attrs["chunks"]
+    stats = index[...]
+    keep = stats[..., STATISTICS.index("valid")] > 0
+    if low is not None:
+        keep &= stats[..., STATISTICS.index("max")] >= low
+    if high is not None:
+        keep &= stats[..., STATISTICS.index("min")] <= high
+    for chunk in zip(*np.nonzero(keep)):
+        yield tuple(slice(c * size, min((c + 1) * size, n)) for c, size, n in zip(chunk, chunks, shape))
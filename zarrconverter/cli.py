@@ -0,0 +1,115 @@
+import json
+import argparse
+from zarrconverter import aggregate, precision
+
+def aggregate_spec(spec):
+    """argparse type of --aggregate"""
+    try:
+        aggregate.parse(spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return spec
+
+def precision_spec(spec):
+    """argparse type of --precision"""
+    try:
+        precision.parse(spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return spec
+
+def converter_parser(description, tiff=False, packed=False):
+    """Argument parser with the options shared by all Create*.py converter scripts"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--output", default=None,
+                        help="Path or fsspec URL (e.g. s3://bucket/name.zarr) of the zarr store instead of the folder named by the script")
+    parser.add_argument("--storage-options", type=json.loads, default=None, metavar="JSON",
+                        help='fsspec options for a URL given with --output, e.g. \'{"client_kwargs": {"endpoint_url": "https://s3.example.org"}}\'')
+    parser.add_argument("--upload-concurrency", type=int, default=16,
+                        help="Number of chunks uploaded at the same time by every task when writing to a URL (default: 16)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted conversion, only blocks missing in the manifest next to the zarr store are written")
+    parser.add_argument("--access", choices=["map", "timeseries", "balanced"],
+                        help="Plan the chunks for this access pattern instead of using the chunks of the script")
+    parser.add_argument("--chunk-bytes", default="64MB",
+                        help="Target size of a chunk for --access (default: 64MB)")
+    parser.add_argument("--report", default=None,
+                        help="JSON file for the run report with the time of every stage, bytes and chunks written and peak memory (default: next to the zarr store)")
+    parser.add_argument("--progress", action="store_true",
+                        help="Show a live progress line while the blocks are written and the chunks verified")
+    parser.add_argument("--tune-codecs", action="store_true",
+                        help="Choose the compressor of every variable from measurements on sampled chunks, the report is written next to the zarr store")
+    parser.add_argument("--min-ratio", type=float, default=2.0,
+                        help="Minimum compression ratio for --tune-codecs, the fastest codec to read with this ratio is chosen (default: 2.0)")
+    parser.add_argument("--precision", nargs="+", type=precision_spec, default=None, metavar="[VARIABLE=]MODE",
+                        help="Lossy compression of float variables: float32 stores float64 as float32, N keeps N mantissa bits (rounded by a BitRound filter), auto[:LEVEL] keeps the bits holding LEVEL (default 0.99) of the information of sampled chunks, e.g. float32 or auto GPP=7; precision and max_relative_error are recorded in the attributes")
+    parser.add_argument("--shards", nargs=3, type=int, metavar=("TIME", "LAT", "LON"),
+                        help="Write zarr v3 with shards of this size, the chunks of the script (or --access) become the inner chunks inside the shard files (needs zarr-python 3)")
+    parser.add_argument("--pyramid", type=int, default=0, metavar="LEVELS",
+                        help="Write a multiscale pyramid with LEVELS levels of 2x, 4x, ... lower resolution as the groups 1 to LEVELS of the store (default: 0, no pyramid)")
+    parser.add_argument("--aggregate", nargs="+", type=aggregate_spec, default=None, metavar="PERIOD:REDUCTION",
+                        help="Also write temporal aggregates computed in the same pass, each into its own group of the store, e.g. monthly:mean annual:max monthly:count (PERIOD: %s, REDUCTION: %s)"
+                        % (", ".join(aggregate.PERIODS), ", ".join(aggregate.REDUCTIONS)))
+    parser.add_argument("--verify", action="store_true",
+                        help="Compare every chunk of the zarr store with the source files after writing, hashes and statistics of the chunks are written next to the store")
+    parser.add_argument("--verify-only", action="store_true",
+                        help="Only verify an existing zarr store against the source files, nothing is written")
+    parser.add_argument("--tolerance", nargs=2, type=float, default=[0.0, 0.0], metavar=("RTOL", "ATOL"),
+                        help="Relative and absolute tolerance of --verify (default: 0 0, exact)")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only print the plan of the conversion (inputs, variables, chunks, files, estimated size and tasks) without importing the converters or starting a cluster")
+    parser.add_argument("--bbox", nargs=4, type=float, metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                        help="Only convert the cells inside this bounding box, only the tiles or chunks of the files that intersect it are read")
+    parser.add_argument("--bbox-crs", default="EPSG:4326",
+                        help="CRS of --bbox, e.g. EPSG:3035 (default: EPSG:4326, longitude and latitude)")
+    parser.add_argument("--time-range", nargs=2, metavar=("START", "END"),
+                        help="Only convert the time steps from START to END, e.g. 2010 2015 or 2010-03-01 2010-05-31 (END includes the whole year or month), files outside are not opened")
+    parser.add_argument("--variables", nargs="+", metavar="NAME",
+                        help="Only convert these variables (default: all)")
+    parser.add_argument("--scheduler", default="local",
+                        help="Address of a running dask scheduler, 'local' to start a local cluster sized for this machine (default) or 'synchronous' to run without a cluster")
+    parser.add_argument("--n-workers", type=int, default=None,
+                        help="Number of worker processes of the local cluster (default: derived from the cores, the memory and the chunks)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="Number of threads of every worker of the local cluster (default: derived from the kind of input files)")
+    parser.add_argument("--memory-limit", default=None,
+                        help="Memory limit of every worker of the local cluster, e.g. 10GB (default: the available memory shared by the workers)")
+    if not tiff:
+        parser.add_argument("--no-index", action="store_true",
+                            help="Open every netCDF file instead of using the index of their coordinates and variables next to the files")
+        parser.add_argument("--readers", type=int, default=None, metavar="PROCESSES",
+                            help="Decode the netCDF files in a pool of PROCESSES processes (0: one per core) and compress and write in threads of this process instead of a dask cluster, needs the file index")
+    if tiff:
+        parser.add_argument("--direct", action="store_true",
+                            help="Write every TIFF file straight into its time slice with a process pool instead of a dask cluster")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Number of processes for --direct (default: number of cores)")
+    if packed:
+        parser.add_argument("--packed", action="store_true",
+                            help="Store the original integers with CF _FillValue and scale_factor instead of floats with NaN")
+    return parser
+
+def shards(args, dims=("time", "lat", "lon")):
+    """Shard sizes {dim: size} from --shards, None without sharding"""
+    return dict(zip(dims, args.shards)) if args.shards else None
+
+def overviews(args, dims=("lat", "lon"), categorical=()):
+    """Arguments of pyramid.build from --pyramid, None without a pyramid"""
+    return {"levels": args.pyramid, "dims": dims, "categorical": categorical} if args.pyramid else None
+
+def aggregates(args, quality=None, categorical=()):
+    """Arguments of aggregate.build from --aggregate, None without aggregates
+
+    quality maps variables to an aggregate.QualityFlag, categorical variables
+    are not aggregated.
+    """
+    return {"specs": args.aggregate, "quality": quality, "categorical": categorical} if args.aggregate else None
+
+def storage(args):
+    """Arguments of objectstore.open_store from --storage-options and --upload-concurrency"""
+    return {"storage_options": args.storage_options, "concurrency": args.upload_concurrency}
+
+def cluster(args):
+    """Arguments of cluster.start from --scheduler, --n-workers, --threads-per-worker and --memory-limit"""
+    return {"scheduler": args.scheduler, "n_workers": args.n_workers, "threads_per_worker": args.threads_per_worker,
+            "memory_limit": args.memory_limit}
@@ -0,0 +1,135 @@
+# Execution profile of a conversion: the dask cluster sized for this machine.
+#
+# The number of worker processes, threads per worker and the memory limit are
+# derived from the usable cores and memory (CPU affinity and cgroup limits count,
+# e.g. in a container or a batch job) and from the memory of a single task, which
+# follows from the dask blocks of the planned dataset. The kind of work decides
+# the split: HDF5 (netCDF) serializes all calls of a process behind a global lock,
+# so its reads only scale with processes; GDAL reads scale with a few threads;
+# Blosc compression releases the GIL and scales with threads. Processes are
+# dropped until the tasks running at the same time fit into memory.
+#
+# If a given scheduler can not be reached a local cluster is started, if that
+# fails as well the tasks run in this process with the synchronous scheduler.
+# Conversions of a batch (see batch.py) share one cluster, the priority of their
+# tasks comes from the dask configuration.
+
+import os
+import math
+import logging
+import psutil
+import dask
+from dask.utils import format_bytes, parse_bytes
+from dask.distributed import Client, LocalCluster
+
+# threads per worker process for every kind of work
+THREADS = {"hdf5": 1, "gdal": 2, "compress": 4}
+# a task holds the block read from the files, the decoded block, the chunk copied for the store and its compressed form
+TASK_OVERHEAD = 4
+# part of the memory for the workers, the rest is left to the scheduler, this script and the page cache
+MEMORY_FRACTION = 0.8
+CONNECT_TIMEOUT = "10s"
+
+def cgroup_value(name):
+    """Value of a cgroup v2 file of this process, None if there is no limit"""
+    try:
+        with open(os.path.join("/sys/fs/cgroup", name)) as f:
+            value = f.read().split()
+    except OSError:
+        return None
+    return None if not value or value[0] == "max" else value
+
+def resources():
+    """Usable cores and available memory in bytes, limited by CPU affinity and cgroups"""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    quota = cgroup_value("cpu.max")
+    if quota:
+        cores = min(cores, max(1, int(quota[0]) // int(quota[1])))
+    memory = psutil.virtual_memory().available
+    limit, current = cgroup_value("memory.max"), cgroup_value("memory.current")
+    if limit:
+        memory = min(memory, int(limit[0]) - int(current[0] if current else 0))
+    return {"cores": cores, "memory": memory}
+
+def task_memory(ds):
+    """Memory of a task writing the largest dask block of ds"""
+    blocks = [math.prod(max(sizes) for sizes in var.chunks) * var.dtype.itemsize
+              for var in ds.data_vars.values() if var.chunks]
+    return TASK_OVERHEAD * max(blocks, default=0)
+
+def chunk_memory(chunks, itemsize=8):
+    """Memory of a task for chunks {dim: size} before the files are opened, 8 bytes per value by default"""
+    return TASK_OVERHEAD * math.prod(chunks.values()) * itemsize
+
+def profile(workload, task_bytes=0, n_workers=None, threads_per_worker=None, memory_limit=None):
+    """Arguments of LocalCluster for workload ("hdf5", "gdal" or "compress") and tasks of task_bytes
+
+    n_workers, threads_per_worker and memory_limit override the derived values.
+    """
+    available = resources()
+    usable = int(available["memory"] * MEMORY_FRACTION)
+    threads = threads_per_worker or min(THREADS[workload], available["cores"])
+    workers = n_workers or max(1, available["cores"] // threads)
+    if task_bytes:
+        # the tasks running at the same time have to fit into memory, fewer processes rather than spilling
+        tasks = max(1, usable // task_bytes)
+        if not n_workers:
+            workers = max(1, min(workers, tasks // threads))
+        if not threads_per_worker:
+            threads = max(1, min(threads, tasks // workers))
+    memory_limit = memory_limit or usable // workers
+    if task_bytes > parse_bytes(memory_limit) // threads:
+        logging.warning("A task needs about %s, more than the %s per thread of the workers, use smaller chunks",
+                        format_bytes(task_bytes), format_bytes(parse_bytes(memory_limit) // threads))
+    logging.info("%d cores and %s available, %s per task", available["cores"], format_bytes(available["memory"]),
+                 format_bytes(task_bytes))
+    return {"n_workers": workers, "threads_per_worker": threads, "memory_limit": memory_limit}
+
+def priority():
+    """Priority of the tasks of this conversion on a shared cluster, zarrconverter.priority of the dask configuration
+
+    batch.py sets it for its jobs with the environment variable
+    DASK_ZARRCONVERTER__PRIORITY, tasks of higher priority run first.
+    """
+    return int(dask.config.get("zarrconverter.priority", 0))
+
+def synchronous():
+    """Run all tasks in this process, returns None instead of a client"""
+    dask.config.set(scheduler="synchronous")
+    return None
+
+def start(workload, task_bytes=0, scheduler="local", n_workers=None, threads_per_worker=None, memory_limit=None):
+    """Client of the cluster for the conversion, None if the tasks run in this process
+
+    scheduler is the address of a running dask scheduler, "local" for a local
+    cluster sized by profile or "synchronous" for no cluster at all.
+    """
+    if scheduler == "synchronous":
+        return synchronous()
+    if scheduler and scheduler != "local":
+        try:
+            client = Client(scheduler, timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            logging.warning("No dask scheduler at %s (%s), starting a local cluster", scheduler, e)
+        else:
+            print("Connected to the dask scheduler at " + scheduler)
+            return client
+    settings = profile(workload, task_bytes, n_workers, threads_per_worker, memory_limit)
+    try:
+        client = Client(LocalCluster(**settings))
+    except Exception as e:
+        logging.warning("Local dask cluster could not be started (%s), running the tasks in this process", e)
+        return synchronous()
+    print("Local dask cluster with %d workers x %d threads and %s memory per worker" % (
+        settings["n_workers"], settings["threads_per_worker"], format_bytes(parse_bytes(settings["memory_limit"]))))
+    print("Dashboard available under: " + str(client.dashboard_link))
+    return client
+
+def stop(client):
+    """Close the client and the local cluster started for it"""
+    if client is None:
+        return
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        cluster.close()
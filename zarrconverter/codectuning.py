@@ -0,0 +1,130 @@
+# Selection of the compressor per variable from measurements.
+#
+# A few chunks of every variable are sampled in the form they are stored and
+# compressed with all candidate Blosc settings (compressor, level, shuffle and a
+# delta filter for integer data such as QC bands). For every candidate the
+# compression ratio and the encode and decode throughput are measured. The
+# fastest candidate to decode (read) with at least the required ratio is chosen.
+
+import json
+import time
+import itertools
+import logging
+import numpy as np
+import dask
+import numcodecs
+from zarrconverter import checkpoint
+
+CNAMES = ["zstd", "lz4", "lz4hc", "blosclz", "zlib"]
+CLEVELS = [1, 3, 5, 7]
+SHUFFLES = {"noshuffle": numcodecs.Blosc.NOSHUFFLE, "shuffle": numcodecs.Blosc.SHUFFLE, "bitshuffle": numcodecs.Blosc.BITSHUFFLE}
+
+def candidates(dtype):
+    """All codec settings to try for data of dtype as (name, compressor, filters)"""
+    filters = [("", None)]
+    if np.dtype(dtype).kind in "iu":
+        filters.append(("delta+", [numcodecs.Delta(dtype=dtype)]))
+    for (prefix, pipeline), cname, clevel, (shuffle_name, shuffle) in itertools.product(
+            filters, CNAMES, CLEVELS, SHUFFLES.items()):
+        name = "%s%s-%d-%s" % (prefix, cname, clevel, shuffle_name)
+        yield name, numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=shuffle), pipeline
+
+def sample_window(shape, itemsize, max_bytes):
+    """Slices of the window of at most max_bytes in the middle of a chunk of shape
+
+    The leading dimensions are cut first, so the window holds whole rows of the
+    last dimension as long as one of them fits.
+    """
+    budget = max(1, max_bytes // itemsize)
+    window = []
+    for axis, size in enumerate(shape):
+        rest = int(np.prod(shape[axis + 1:]))
+        length = max(1, min(size, budget // max(1, rest)))
+        budget = max(1, budget // length)
+        start = (size - length) // 2
+        window.append(slice(start, start + length))
+    return tuple(window)
+
+def sample_chunks(data, samples=4, max_bytes=8 * 2**20):
+    """Compute a window of at most max_bytes of a few chunks spread over the dask array data
+
+    Only the window is computed, dask passes it on to the reader of chunks
+    that come straight from the files, so big chunks are not read whole.
+    """
+    count = int(np.prod(data.numblocks))
+    indices = sorted(set(np.linspace(0, count - 1, min(samples, count)).astype(int)))
+    blocks = []
+    for index in indices:
+        block = np.unravel_index(index, data.numblocks)
+        starts = [sum(sizes[:i]) for sizes, i in zip(data.chunks, block)]
+        shape = [sizes[i] for sizes, i in zip(data.chunks, block)]
+        # the middle of the chunk, the edges of global grids are often only fill values; the window is cut
+        # from data itself and not from data.blocks, which newer dask versions compute whole before the cut
+        window = sample_window(shape, data.dtype.itemsize, max_bytes)
+        blocks.append(data[tuple(slice(start + cut.start, start + cut.stop) for start, cut in zip(starts, window))])
+    return [np.ascontiguousarray(block) for block in dask.compute(*blocks)]
+
+def measure(chunks, compressor, filters, repeats=2):
+    """Compression ratio and encode and decode throughput in MB/s of one codec setting"""
+    raw = sum(chunk.nbytes for chunk in chunks)
+    encode_time = decode_time = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        encoded = []
+        for chunk in chunks:
+            buffer = chunk
+            for codec in filters or []:
+                buffer = codec.encode(buffer)
+            encoded.append(compressor.encode(buffer))
+        encode_time = min(encode_time, time.perf_counter() - start)
+        start = time.perf_counter()
+        for buffer in encoded:
+            buffer = compressor.decode(buffer)
+            for codec in reversed(filters or []):
+                buffer = codec.decode(buffer)
+        decode_time = min(decode_time, time.perf_counter() - start)
+    compressed = sum(len(buffer) for buffer in encoded)
+    return {
+        "ratio": raw / compressed,
+        "encode_MBps": raw / 1e6 / encode_time,
+        "decode_MBps": raw / 1e6 / decode_time,
+    }
+
+def choose(results, min_ratio):
+    """Fastest candidate to decode with at least min_ratio, otherwise the one with the best ratio"""
+    good = [result for result in results if result["ratio"] >= min_ratio]
+    if good:
+        return max(good, key=lambda result: result["decode_MBps"])
+    return max(results, key=lambda result: result["ratio"])
+
+def tune(ds, encoding=None, min_ratio=2.0, samples=4, report=None, dim="time"):
+    """Return encoding with the compressor and filters of every data variable chosen from measurements
+
+    The measurements of all candidates are written as JSON to the file report.
+    """
+    encoding = {vname: dict(settings) for vname, settings in (encoding or {}).items()}
+    variables = checkpoint.encoded_variables(ds, encoding, dim)
+    summary = {}
+    for vname in ds.data_vars:
+        if vname not in variables:
+            continue
+        chunks = sample_chunks(variables[vname].data, samples)
+        results = []
+        for name, compressor, filters in candidates(chunks[0].dtype):
+            result = measure(chunks, compressor, filters)
+            result.update(name=name, compressor=compressor.get_config(),
+                          filters=[codec.get_config() for codec in filters or []])
+            results.append(result)
+        best = choose(results, min_ratio)
+        logging.info("%s: %s with ratio %.2f, decode %.0f MB/s, encode %.0f MB/s", vname, best["name"],
+                     best["ratio"], best["decode_MBps"], best["encode_MBps"])
+        print("Codec for %s: %s (ratio %.2f, read %.0f MB/s)" % (vname, best["name"], best["ratio"], best["decode_MBps"]))
+        settings = encoding.setdefault(vname, {})
+        settings["compressor"] = numcodecs.get_codec(best["compressor"])
+        settings["filters"] = [numcodecs.get_codec(config) for config in best["filters"]] or None
+        summary[vname] = {"dtype": str(chunks[0].dtype), "min_ratio": min_ratio, "chosen": best["name"],
+                          "candidates": results}
+    if report:
+        with open(report, "w") as f:
+            json.dump(summary, f, indent=2)
+    return encoding
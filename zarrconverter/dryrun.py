@@ -0,0 +1,367 @@
+# Dry run of a conversion: the plan of the zarr store without converting anything.
+#
+# --plan tells within a second whether a big job is set up right, before cluster
+# hours are spent on it. Only the file names are listed and parsed, the header of
+# the first TIFF file or the file index (or the headers) of the netCDF files are
+# read and only light modules are imported: no xarray, no dask, no zarr and no
+# cluster, rasterio only for TIFF files or a --bbox. The planned dataset is a Layout, which is enough of an xarray
+# Dataset for chunkplan, so the chunks are planned exactly as in the real run.
+# Reported are the inputs with their time stamps, the variables with shape,
+# dtype, precision, chunks and chunk grid, the temporal aggregates, the chunks
+# and files of the store, its estimated compressed size and the number of tasks.
+
+import os
+import json
+import math
+import collections
+import numpy as np
+from zarrconverter import aggregate, chunkplan, precision, subset
+from zarrconverter.chunkplan import format_bytes
+
+# the index written by fileindex.py next to the netCDF files and its format version
+INDEX_NAME = ".fileindex.json"
+INDEX_VERSION = 1
+# compression ratio of the size estimate without a codec report of --tune-codecs, the default --min-ratio
+COMPRESSION_RATIO = 2.0
+# chunkstats.GROUP, chunkstats imports zarr
+CHUNKSTATS_GROUP = "chunkstats"
+# number of files listed at the beginning and at the end of the inputs
+LISTED = 3
+
+class Variable(collections.namedtuple("Variable", ["dims", "shape", "dtype", "encoding"])):
+    """Data variable of the planned dataset with the attributes of a DataArray that chunkplan uses"""
+
+    chunks = None
+
+    @property
+    def sizes(self):
+        return dict(zip(self.dims, self.shape))
+
+class Layout(dict):
+    """Data variables {name: Variable} of the planned dataset, used like a Dataset by chunkplan"""
+
+    @property
+    def data_vars(self):
+        return self
+
+def variable(dims, shape, dtype, native=None):
+    """Variable with the native chunks {dim: size} of the source"""
+    return Variable(tuple(dims), tuple(shape), np.dtype(dtype), {"preferred_chunks": native or {}})
+
+def transpose(var, dims):
+    """var with its dimensions in the order dims, like DataArray.transpose"""
+    sizes = var.sizes
+    return var._replace(dims=tuple(dims), shape=tuple(sizes[dim] for dim in dims))
+
+def time_stamps(files, file_date):
+    """Files sorted by the time stamps of their names and the time stamps"""
+    stamps = sorted((np.datetime64(file_date(file), "ns"), file) for file in files)
+    times = [time for time, _ in stamps]
+    if len(set(times)) != len(times):
+        raise ValueError("Several files have the same time stamp")
+    return [file for _, file in stamps], times
+
+def tiffs(files, file_date, bands, masked=True, y="lat", x="lon", crs=None, resolution=None, bbox=None,
+          bbox_crs=subset.DEFAULT_CRS):
+    """Inputs of a TIFF converter from the file names and the header of the first file
+
+    bands maps the band numbers to the variables, masked means the fill values
+    become NaN, which turns integers into floats. crs and resolution give the
+    target grid of a reprojection (see warp.py), bbox (in bbox_crs) the window
+    that is converted (see subset.py).
+    """
+    files, times = time_stamps(files, file_date)
+    if not files:
+        return {"files": [], "times": [], "layout": Layout()}
+    # GDAL is only needed for the header of the TIFF files, not for the plans of netCDF files
+    import rasterio
+    from rasterio.warp import calculate_default_transform
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR"), rasterio.open(files[0]) as src:
+        width, height, dtype, block = src.width, src.height, src.dtypes[0], src.block_shapes[0]
+        transform, grid_crs = src.transform, src.crs
+        if max(bands) > src.count:
+            raise ValueError("%s has %d bands, band %d is converted" % (files[0], src.count, max(bands)))
+        if crs:
+            transform, width, height = calculate_default_transform(src.crs, crs, width, height, *src.bounds,
+                                                                   resolution=resolution)
+            grid_crs = crs
+        if bbox:
+            window = subset.window(transform, width, height, subset.grid_bounds(bbox, bbox_crs, grid_crs),
+                                   geographic=subset.is_geographic(grid_crs))
+            width, height = window.width, window.height
+        block = (min(block[0], height), min(block[1], width))
+    # the same promotion as tiffscan.masked_dtype
+    dtype = np.promote_types(dtype, "float32") if masked else np.dtype(dtype)
+    layout = Layout({name: variable(("time", y, x), (len(files), height, width), dtype, {y: block[0], x: block[1]})
+                     for name in bands.values()})
+    return {"files": files, "times": times, "layout": layout}
+
+def load_index(path):
+    """Entries of the file index at path, {} if there is none"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        index = json.load(f)
+    return index["files"] if index.get("version") == INDEX_VERSION else {}
+
+def read_header(path):
+    """Dimensions and variables of a netCDF file in the form of an entry of the file index"""
+    import netCDF4
+    entry = {"dims": {}, "variables": {}}
+    with netCDF4.Dataset(path) as nc:
+        nc.set_auto_maskandscale(False)
+        entry["dims"] = {name: len(dim) for name, dim in nc.dimensions.items()}
+        for name, var in nc.variables.items():
+            chunking = var.chunking()
+            meta = {"dims": list(var.dimensions), "shape": list(var.shape), "dtype": np.dtype(var.dtype).str,
+                    "attrs": {key: var.getncattr(key) for key in var.ncattrs() if isinstance(var.getncattr(key), str)},
+                    "encoding": {"chunksizes": None if chunking == "contiguous" else list(chunking)}}
+            if name in var.dimensions and var.size:
+                values = [np.asarray(var[0]).item(), np.asarray(var[-1]).item()]
+                meta["range"] = [min(values), max(values)]
+            entry["variables"][name] = meta
+    return entry
+
+def decode_time(value, attrs):
+    """Time stamp of a raw value of a CF time coordinate"""
+    import cftime
+    if "units" not in attrs:
+        return value
+    return cftime.num2date(value, attrs["units"], attrs.get("calendar", "standard"),
+                           only_use_cftime_datetimes=False, only_use_python_datetimes=False)
+
+def data_variables(entry):
+    """Names of the data variables of a file, without coordinates, bounds, grid mappings and scalars"""
+    referenced = set()
+    for meta in entry["variables"].values():
+        for key in ("coordinates", "bounds", "grid_mapping"):
+            value = meta["attrs"].get(key)
+            if isinstance(value, str):
+                referenced.update(value.replace(":", " ").split())
+    return [name for name, meta in entry["variables"].items()
+            if meta["dims"] and name not in entry["dims"] and name not in referenced]
+
+def coordinate_values(meta, size):
+    """Cell centers of a regular dimension coordinate from its range"""
+    return np.linspace(meta["range"][0], meta["range"][1], size)
+
+def window_sizes(entry, bbox, bbox_crs, y=None, x=None):
+    """Sizes {dim: size} of the spatial dimensions of a file inside bbox (in bbox_crs), see subset.select"""
+    y, x = subset.spatial_dims(entry["dims"], y, x)
+    crs = subset.coordinate_crs({name: meta["attrs"] for name, meta in entry["variables"].items()}, x)
+    west, south, east, north = subset.grid_bounds(bbox, bbox_crs, crs)
+    sizes = {}
+    for dim, low, high in ((y, south, north), (x, west, east)):
+        meta = entry["variables"].get(dim)
+        if meta is None or "range" not in meta:
+            raise ValueError("No coordinate %s to select the bounding box" % dim)
+        values = coordinate_values(meta, entry["dims"][dim])
+        if dim == x and subset.is_geographic(crs):
+            cells, _ = subset.longitude_columns(values, low, high)
+        else:
+            cells = subset.coordinate_slice(values, low, high)
+        sizes[dim] = len(values[cells])
+    return sizes
+
+def netcdfs(files, index_path=None, dim="time", new_dim=False, time_range=None, variables=None, bbox=None,
+            bbox_crs=subset.DEFAULT_CRS, y=None, x=None):
+    """Inputs of a netCDF converter combined along dim, from the file index and the headers of other files
+
+    With new_dim every file becomes one step of the new dimension dim
+    (xr.concat), otherwise the files are combined along their dimension dim
+    (xr.open_mfdataset). Like both of them, data variables without dim get it
+    when there is something to concatenate. Files outside of time_range are
+    left out, time steps of a file that is partly inside are all counted.
+    variables and bbox (in bbox_crs) select as subset.select does.
+    """
+    files = sorted(files)
+    if not files:
+        return {"files": [], "times": [], "layout": Layout()}
+    index = load_index(index_path)
+    root = os.path.dirname(os.path.abspath(index_path)) if index_path else None
+    entries = []
+    for file in files:
+        entry = index.get(os.path.relpath(os.path.abspath(file), root)) if root else None
+        stat = os.stat(file)
+        if entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            entry = read_header(file)
+        entries.append(entry)
+
+    times = []
+    bounds = subset.time_bounds(time_range)
+    selected = []
+    for file, entry in zip(files, entries):
+        meta = entry["variables"].get(dim)
+        first, last = [decode_time(value, meta["attrs"]) for value in meta["range"]] if meta and "range" in meta else [None, None]
+        if subset.range_overlaps(first, last, bounds):
+            selected.append((file, entry))
+            times.append(first)
+    if not selected:
+        return {"files": [], "times": [], "layout": Layout()}
+    files, entries = [file for file, _ in selected], [entry for _, entry in selected]
+    first = entries[0]
+    length = len(files) if new_dim else sum(entry["dims"].get(dim, 0) for entry in entries)
+    names = data_variables(first)
+    if variables:
+        missing = [name for name in variables if name not in names]
+        if missing:
+            raise ValueError("No variables %s, the files have %s" % (missing, names))
+        names = [name for name in names if name in variables]
+    sizes = window_sizes(first, bbox, bbox_crs, y, x) if bbox else {}
+    layout = Layout()
+    for name in names:
+        meta = first["variables"][name]
+        dims, shape = list(meta["dims"]), [sizes.get(d, size) for d, size in zip(meta["dims"], meta["shape"])]
+        chunksizes = meta["encoding"].get("chunksizes") or shape
+        native = dict(zip(dims, chunksizes))
+        if dim not in dims and (new_dim or len(files) > 1):
+            dims, shape = [dim] + dims, [length] + shape
+        elif dim in dims:
+            shape[dims.index(dim)] = length
+        layout[name] = variable(dims, shape, meta["dtype"], native)
+    return {"files": files, "times": times, "layout": layout}
+
+def codec_ratios(path):
+    """Compression ratio of the chosen codec of every variable from the report of --tune-codecs"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        summary = json.load(f)
+    return {vname: next(candidate["ratio"] for candidate in result["candidates"] if candidate["name"] == result["chosen"])
+            for vname, result in summary.items()}
+
+def label(time):
+    """Short form of a time stamp"""
+    if time is None:
+        return "-"
+    if isinstance(time, np.datetime64):
+        time = time.astype("datetime64[s]").item()
+    return str(time).replace(" 00:00:00", "")
+
+def level_chunks(var, chunks, level, dims):
+    """Shape and chunks of var in level of a pyramid reduced along dims, see pyramid.build"""
+    factor = 2 ** level
+    shape = [size // factor if dim in dims else size for dim, size in zip(var.dims, var.shape)]
+    chunk = [max(1, min(chunks.get(dim, size), size) // factor) if dim in dims else min(chunks.get(dim, size), size)
+             for dim, size in zip(var.dims, var.shape)]
+    return shape, chunk
+
+def show_aggregates(plan, layout, chunks, times, specs, categorical=(), time_dim="time"):
+    """Print the groups of the temporal aggregates and add their chunks, files, bytes and tasks to plan"""
+    names = [vname for vname, var in layout.items()
+             if time_dim in var.dims and var.dtype.kind in "fiu" and vname not in categorical]
+    try:
+        stamps = np.asarray(times, dtype="datetime64[ns]")
+    except (TypeError, ValueError):
+        print("Aggregates %s: the periods cannot be counted from the time stamps of the files" % " ".join(specs))
+        return
+    print("Aggregates of %s, with one chunk per period:" % ", ".join(names))
+    for spec in specs:
+        period, reduction = aggregate.parse(spec)
+        periods = len(np.unique(aggregate.labels(stamps, period)))
+        count = 0
+        for vname in names:
+            var = layout[vname]
+            info = chunkplan.describe(var, chunks, time_dim)
+            spatial = [size for dim, size in zip(var.dims, var.shape) if dim != time_dim]
+            grid = math.prod(math.ceil(size / chunk) for dim, size, chunk in zip(var.dims, var.shape, info["chunks"]) if dim != time_dim)
+            dtype = np.dtype(aggregate.COUNT_DTYPE) if reduction == "count" else np.promote_types(var.dtype, "float32")
+            count += periods * grid
+            plan["bytes"] += periods * math.prod(spatial) * dtype.itemsize
+            plan["compressed_bytes"] += int(periods * math.prod(spatial) * dtype.itemsize / COMPRESSION_RATIO)
+            plan["store_files"] += periods * grid + 5
+        print("  %s: %d periods in the group %s, %d chunks" % (spec, periods, aggregate.group_name(period, reduction), count))
+        plan["chunks"] += count
+        plan["tasks"] += count
+        plan["store_files"] += 3 * (len(layout[names[0]].dims) if names else 0) + 2
+
+def show(inputs, chunks, access=None, chunk_bytes="64MB", direct=False, shards=None, levels=0,
+         level_dims=("lat", "lon"), zarr_dir=None, time_dim="time", aggregates=None, categorical=(),
+         precisions=None):
+    """Print the plan of the conversion of inputs (from tiffs or netcdfs) and return it, None without files
+
+    chunks {dim: size} are the chunks of the script, replaced by a plan for
+    access. With direct every file is one task, shards {dim: size} and
+    levels of a pyramid are counted as they would be written. The compressed
+    size uses the ratios of an earlier --tune-codecs run for zarr_dir if its
+    report is there. aggregates are the specs of --aggregate, their periods
+    are counted from the time stamps of the files, categorical variables are
+    not aggregated or rounded. precisions are the specs of --precision, the
+    float variables are counted with the dtype they are stored with.
+    """
+    files, times, layout = inputs["files"], inputs["times"], inputs["layout"]
+    if not files:
+        print("No input files, nothing to convert")
+        return None
+    if access:
+        chunks = chunkplan.plan_dataset(layout, chunk_bytes, access, time_dim)
+    known = [time for time in times if time is not None]
+    print("%d input files" % len(files) + (", %s to %s" % (label(known[0]), label(known[-1])) if known else ""))
+    listed = list(range(len(files))) if len(files) <= 2 * LISTED else list(range(LISTED)) + list(range(len(files) - LISTED, len(files)))
+    for position, i in enumerate(listed):
+        if position and i != listed[position - 1] + 1:
+            print("  ... %d more" % (i - listed[position - 1] - 1))
+        print("  %s  %s" % (label(times[i]), files[i]))
+
+    ratios = codec_ratios(str(zarr_dir).rstrip("/\\") + ".codecs.json" if zarr_dir else None)
+    plan = {"files": len(files), "variables": {}, "chunks": 0, "store_files": 3, "bytes": 0, "compressed_bytes": 0,
+            "tasks": 0}
+    settings = precision.precisions(precisions)
+    print("Variables:")
+    for vname, var in layout.items():
+        mode = precision.of(settings, vname) if var.dtype.kind == "f" and vname not in categorical else None
+        var = var._replace(dtype=precision.stored_dtype(var.dtype, mode))
+        info = chunkplan.describe(var, chunks, time_dim)
+        grid = [math.ceil(size / chunk) for size, chunk in zip(var.shape, info["chunks"])]
+        nbytes = math.prod(var.shape) * var.dtype.itemsize
+        ratio = ratios.get(vname, COMPRESSION_RATIO)
+        print("  %s: %s %s %s, chunks %s of %s, chunk grid %s, %d chunks" % (
+            vname, var.dims, var.shape, var.dtype, tuple(info["chunks"]), format_bytes(info["chunk_bytes"]),
+            tuple(grid), info["chunk_count"]))
+        if mode:
+            print("  Precision of %s: %s" % (vname, precision.describe(mode)))
+        if info["chunk_bytes"] < chunkplan.MIN_CHUNK_BYTES:
+            print("  Warning: chunks of %s are smaller than %s, this makes a lot of small files" % (vname, format_bytes(chunkplan.MIN_CHUNK_BYTES)))
+        if info["chunk_bytes"] > chunkplan.MAX_CHUNK_BYTES:
+            print("  Warning: chunks of %s are bigger than %s, this needs a lot of memory per worker" % (vname, format_bytes(chunkplan.MAX_CHUNK_BYTES)))
+        chunk_count = info["chunk_count"]
+        # a shard file holds several chunks, every shard is written by one task
+        units = math.prod(math.ceil(size / max(shards.get(dim, chunk), chunk))
+                          for dim, size, chunk in zip(var.dims, var.shape, info["chunks"])) if shards else chunk_count
+        for level in range(1, levels + 1):
+            shape, chunk = level_chunks(var, chunks, level, level_dims)
+            count = math.prod(math.ceil(size / c) for size, c in zip(shape, chunk) if size)
+            chunk_count += count
+            units += count
+            nbytes += math.prod(shape) * var.dtype.itemsize
+        # every task reads the part of one file in one chunk, files split along time are read once per chunk
+        spatial = info["chunk_count"] // grid[var.dims.index(time_dim)] if time_dim in var.dims else info["chunk_count"]
+        reads = spatial * max(len(files), grid[var.dims.index(time_dim)]) if time_dim in var.dims else spatial
+        plan["variables"][vname] = {"dims": var.dims, "shape": var.shape, "dtype": str(var.dtype),
+                                    "chunks": info["chunks"], "chunk_grid": grid, "chunk_count": chunk_count}
+        plan["chunks"] += chunk_count
+        # metadata of the array in every level and the index of chunk statistics (metadata and one chunk)
+        plan["store_files"] += units + 2 * (levels + 1) + 3 * (levels + 1)
+        plan["bytes"] += nbytes
+        plan["compressed_bytes"] += int(nbytes / ratio)
+        plan["tasks"] += reads + units
+    if levels:
+        print("Pyramid of %d levels, reduced along %s" % (levels, ", ".join(level_dims)))
+    if aggregates:
+        show_aggregates(plan, layout, chunks, known, aggregates, categorical, time_dim)
+    # the coordinates of every dimension in every group and the metadata of the groups
+    dims = {dim for var in layout.values() for dim in var.dims}
+    plan["store_files"] += (levels + 1) * 3 * len(dims) + 2 * levels + 2 * (levels + 1)
+    if direct:
+        plan["tasks"] = len(files)
+    print("Store: %d chunks in at most %d files%s, %s uncompressed, about %s compressed (%s)" % (
+        plan["chunks"], plan["store_files"], " (shards %s)" % (tuple(shards.values()),) if shards else "",
+        format_bytes(plan["bytes"]), format_bytes(plan["compressed_bytes"]),
+        "ratio of the codec report" if ratios else "assumed ratio %.1f" % COMPRESSION_RATIO))
+    print("Chunks that only hold fill values are not written, the statistics of every chunk are indexed in the group " + CHUNKSTATS_GROUP)
+    if direct:
+        print("Tasks: %d files written by a process pool" % plan["tasks"])
+    else:
+        print("Tasks: about %d dask tasks reading and writing" % plan["tasks"])
+    plan["chunk_shape"] = chunks
+    return plan
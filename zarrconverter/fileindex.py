@@ -0,0 +1,257 @@
+# Cached index of the metadata of a set of netCDF files.
+#
+# xr.open_mfdataset opens every file to read its coordinates before the files
+# can be combined, which takes minutes for decades of daily files and happens
+# again on every retry. The index keeps path, modification time and size, the
+# dimensions, the variables with their raw dtype, attributes and internal
+# chunking and the values of the coordinates (and other small variables) of every
+# file in a JSON file next to the files. It is built in parallel by a pool of
+# processes (HDF5 serializes all reads within a process) and only files that were
+# added or changed since the last run are read again.
+#
+# IndexBackend is an xarray backend that builds the dataset of a file from the
+# index. Combined with xr.open_mfdataset the result is the same as opening the
+# files, only the data variables are read from the files when they are computed,
+# in this process or by the processes of a readerpool.ReaderPool set as reader.
+
+import os
+import json
+import hashlib
+import logging
+import functools
+import concurrent.futures
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray, BackendEntrypoint
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+from xarray.core import indexing
+
+VERSION = 1
+INDEX_NAME = ".fileindex.json"
+# variables with at most this many values (coordinates, bounds, grid mappings) are kept in the index
+SMALL = 100_000
+# per variable encoding of the netCDF backends that is restored from the index
+ENCODING = ("zlib", "szip", "zstd", "bzip2", "blosc", "shuffle", "complevel", "fletcher32", "contiguous",
+            "chunksizes", "preferred_chunks", "original_shape")
+# files kept open by every process to read the data variables
+OPEN_FILES = 128
+# the locks the netCDF backends of xarray take around their reads, the HDF5 library is not thread safe for
+# opening, reading or closing, so open_file and read_values hold them for all three
+LOCK = combine_locks([NETCDFC_LOCK, HDF5_LOCK])
+
+def encode_value(value):
+    """JSON form of an attribute value or array that keeps its numpy dtype"""
+    if isinstance(value, str):
+        return value
+    array = np.asarray(value)
+    if array.dtype.kind == "S":
+        return {"dtype": array.dtype.str, "shape": array.shape,
+                "values": np.char.decode(array, "latin-1").tolist()}
+    return {"dtype": array.dtype.str, "shape": array.shape, "values": array.tolist()}
+
+def decode_value(value):
+    """Attribute value or array from encode_value, scalars become numpy scalars"""
+    if isinstance(value, str):
+        return value
+    dtype = np.dtype(value["dtype"])
+    values = value["values"]
+    if dtype.kind == "S":
+        values = np.char.encode(np.asarray(values, dtype="U"), "latin-1")
+    array = np.asarray(values, dtype=dtype).reshape(value["shape"])
+    return array[()] if array.ndim == 0 else array
+
+def array_key(array):
+    """Hash of the dtype and values of an array, equal coordinates of many files are stored once"""
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(array.dtype.str.encode() + str(array.shape).encode() + array.tobytes()).hexdigest()
+
+def read_entry(path):
+    """Metadata of one netCDF file and the values of its small variables, arrays are returned separately"""
+    stat = os.stat(path)
+    entry = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "variables": {}}
+    arrays = {}
+    with xr.open_dataset(path, decode_cf=False, mask_and_scale=False, decode_times=False,
+                         decode_coords=False) as nc:
+        entry["dims"] = dict(nc.sizes)
+        entry["attrs"] = {key: encode_value(value) for key, value in nc.attrs.items()}
+        entry["unlimited_dims"] = sorted(nc.encoding.get("unlimited_dims", ()))
+        for name, var in nc.variables.items():
+            meta = {"dims": list(var.dims), "shape": list(var.shape), "dtype": var.dtype.str,
+                    "attrs": {key: encode_value(value) for key, value in var.attrs.items()},
+                    "encoding": {key: var.encoding[key] for key in ENCODING if key in var.encoding}}
+            if var.size <= SMALL and var.dtype.kind in "biuf":
+                values = var.values
+                key = array_key(values)
+                arrays[key] = encode_value(values)
+                meta["values"] = key
+                if name in var.dims and var.size:
+                    meta["range"] = [values.min().item(), values.max().item()]
+            entry["variables"][name] = meta
+    return entry, arrays
+
+@functools.lru_cache(maxsize=OPEN_FILES)
+def open_file(path):
+    """The raw dataset of a file for reading data variables, kept open for later blocks of the same file
+
+    Only called with LOCK held: the dataset takes no lock of its own, it is
+    read under LOCK by read_values.
+    """
+    return xr.open_dataset(path, decode_cf=False, mask_and_scale=False, decode_times=False, decode_coords=False,
+                           lock=False)
+
+def read_values(path, name, key):
+    """Values of variable name of the file path at the outer indexer key (a tuple)"""
+    # xarray only locks the reads, not the opens, and the files dropped from the cache are closed right here,
+    # so the open, the read and the close of several threads are serialized by LOCK
+    with LOCK:
+        return np.asarray(open_file(path)[name].variable[key].values)
+
+class FileArray(BackendArray):
+    """Data variable of a netCDF file that is read when it is indexed, by reader if one is given"""
+
+    def __init__(self, path, name, shape, dtype, reader=None):
+        self.path = path
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.reader = reader
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.OUTER, self._getitem)
+
+    def _getitem(self, key):
+        if self.reader is not None:
+            return self.reader.read(self.path, self.name, key)
+        return read_values(self.path, self.name, key)
+
+class FileIndex:
+    """Index of netCDF files stored as JSON at path, the files are given relative to its folder
+
+    The data variables of datasets opened through the index are read by
+    reader (a readerpool.ReaderPool) if it is set before they are opened.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.root = os.path.dirname(self.path)
+        self.files = {}
+        self.arrays = {}
+        self.reader = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                index = json.load(f)
+            if index.get("version") == VERSION:
+                self.files, self.arrays = index["files"], index["arrays"]
+            else:
+                logging.info("Index %s has an old format, all files are read again", self.path)
+
+    def __dask_tokenize__(self):
+        return self.path, len(self.files)
+
+    def key(self, file):
+        return os.path.relpath(os.path.abspath(file), self.root)
+
+    def changed(self, files):
+        """Files that are new or have a different modification time or size than in the index"""
+        changed = []
+        for file in files:
+            entry = self.files.get(self.key(file))
+            stat = os.stat(file)
+            if entry is None or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                changed.append(file)
+        return changed
+
+    def update(self, files, workers=None):
+        """Read new and changed files in parallel, forget deleted files and write the index"""
+        changed = self.changed(files)
+        deleted = [key for key in self.files if not os.path.exists(os.path.join(self.root, key))]
+        for key in deleted:
+            del self.files[key]
+        if not changed and not deleted:
+            return self
+        logging.info("Indexing %d of %d files", len(changed), len(files))
+        if len(changed) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                entries = list(pool.map(read_entry, changed, chunksize=max(1, len(changed) // 256)))
+        else:
+            entries = [read_entry(file) for file in changed]
+        for file, (entry, arrays) in zip(changed, entries):
+            self.files[self.key(file)] = entry
+            self.arrays.update(arrays)
+        # arrays of changed or deleted files that no other file uses
+        used = {meta["values"] for entry in self.files.values() for meta in entry["variables"].values()
+                if "values" in meta}
+        self.arrays = {key: value for key, value in self.arrays.items() if key in used}
+        self.write()
+        return self
+
+    def write(self):
+        """Write the index, a folder that is not writable only costs the next run the time to read the files"""
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                # numpy scalars in the encoding of some backends are written as plain numbers
+                json.dump({"version": VERSION, "files": self.files, "arrays": self.arrays}, f,
+                          default=lambda value: value.item())
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.warning("Index %s could not be written: %s", self.path, e)
+
+    def raw_dataset(self, file):
+        """Dataset of a file as the netCDF backends return it without decoding, the data variables are lazy"""
+        path = os.path.abspath(file)
+        entry = self.files[self.key(file)]
+        variables = {}
+        for name, meta in entry["variables"].items():
+            if "values" in meta:
+                data = decode_value(self.arrays[meta["values"]])
+            else:
+                data = indexing.LazilyIndexedArray(FileArray(path, name, meta["shape"], meta["dtype"], self.reader))
+            encoding = dict(meta["encoding"], source=path, dtype=np.dtype(meta["dtype"]))
+            for key in ("chunksizes", "original_shape"):
+                if encoding.get(key) is not None:
+                    encoding[key] = tuple(encoding[key])
+            attrs = {key: decode_value(value) for key, value in meta["attrs"].items()}
+            variables[name] = xr.Variable(meta["dims"], data, attrs, encoding)
+        ds = xr.Dataset(variables, attrs={key: decode_value(value) for key, value in entry["attrs"].items()})
+        ds.encoding = {"source": path, "unlimited_dims": set(entry["unlimited_dims"])}
+        return ds
+
+    def open_dataset(self, file, **kwargs):
+        """xr.open_dataset of a file from the index"""
+        return xr.open_dataset(file, engine=IndexBackend, index=self, **kwargs)
+
+    def open_mfdataset(self, files, **kwargs):
+        """xr.open_mfdataset of files from the index, nothing is read from the files themselves"""
+        # the datasets are built from the index in memory, there is nothing to parallelize
+        kwargs["parallel"] = False
+        return xr.open_mfdataset(files, engine=IndexBackend, index=self, **kwargs)
+
+class IndexBackend(BackendEntrypoint):
+    """xarray backend that returns the dataset of a netCDF file from a FileIndex given as index"""
+
+    description = "netCDF files described by a FileIndex, only the data is read from the files"
+    open_dataset_parameters = ("filename_or_obj", "drop_variables", "index", "mask_and_scale", "decode_times",
+                               "concat_characters", "decode_coords", "use_cftime", "decode_timedelta")
+
+    def open_dataset(self, filename_or_obj, *, drop_variables=None, index=None, mask_and_scale=True,
+                     decode_times=True, concat_characters=True, decode_coords=True, use_cftime=None,
+                     decode_timedelta=None):
+        ds = index.raw_dataset(filename_or_obj)
+        ds = ds.drop_vars(drop_variables or [], errors="ignore")
+        decoded = xr.decode_cf(ds, mask_and_scale=mask_and_scale, decode_times=decode_times,
+                               concat_characters=concat_characters, decode_coords=decode_coords,
+                               use_cftime=use_cftime, decode_timedelta=decode_timedelta)
+        decoded.encoding = ds.encoding
+        return decoded
+
+def index_path(files):
+    """Default location of the index, in the folder of the first file"""
+    return os.path.join(os.path.dirname(os.path.abspath(files[0])), INDEX_NAME)
+
+def load(files, path=None, workers=None):
+    """The index of files at path (default: next to the files), updated for new and changed files"""
+    return FileIndex(path or index_path(files)).update(files, workers)
+
+def open_mfdataset(files, path=None, workers=None, **kwargs):
+    """xr.open_mfdataset of files through their index, kwargs are passed to xr.open_mfdataset"""
+    return load(files, path, workers).open_mfdataset(files, **kwargs)
@@ -0,0 +1,214 @@
+# Output to object storage (S3 and everything else fsspec can write to).
+#
+# Instead of writing to a local folder and copying the tree afterwards, the chunks
+# are uploaded while they are computed. All chunks written by one task (one call
+# of setitems by zarr) are uploaded concurrently by a bounded pool of threads, a
+# failed upload is retried with an increasing delay. The metadata (.zgroup,
+# .zarray, .zattrs) is kept in memory and uploaded by commit once all chunks are
+# stored, the consolidated metadata last, so readers never see a store with
+# missing chunks. Any fsspec URL works, e.g. memory:// for tests without network.
+#
+# The store is a zarr-python 2 store. zarr-python 3 writes URLs with its own
+# bounded pool of async requests (zarr.config "async.concurrency"), there the
+# metadata is written up front like for local folders.
+
+import os
+import json
+import time
+import logging
+import concurrent.futures
+from collections.abc import MutableMapping
+import fsspec
+from numcodecs.compat import ensure_bytes
+import zarr
+
+METADATA = (".zgroup", ".zarray", ".zattrs", ".zmetadata")
+CONCURRENCY = 16
+RETRIES = 5
+
+try:
+    from aiohttp import ClientError
+    RETRY_ERRORS = (OSError, TimeoutError, ClientError)
+except ImportError:
+    RETRY_ERRORS = (OSError, TimeoutError)
+
+def is_url(path):
+    """True for fsspec URLs of remote or in-memory file systems, False for local paths"""
+    return "://" in str(path) and not str(path).startswith("file://")
+
+def is_reference(path):
+    """True for the JSON file of a reference store (see references.py)"""
+    return str(path).endswith(".json")
+
+def local_path(zarr_dir, suffix):
+    """Local file next to the store (manifests, reports), in the working directory for URLs"""
+    zarr_dir = str(zarr_dir).rstrip("/\\")
+    return os.path.basename(zarr_dir) + suffix if is_url(zarr_dir) else zarr_dir + suffix
+
+def exists(zarr_dir, storage_options=None):
+    """True if the store exists, it may not have metadata yet if an upload was interrupted"""
+    if not is_url(zarr_dir):
+        return os.path.exists(zarr_dir)
+    fs, root = fsspec.url_to_fs(zarr_dir, **(storage_options or {}))
+    return fs.exists(root)
+
+def is_metadata(key):
+    return key.rsplit("/", 1)[-1] in METADATA
+
+# the base class of zarr-python 2 stores, zarr-python 3 does not use UploadStore
+StoreBase = getattr(zarr.storage, "Store", MutableMapping)
+
+class UploadStore(StoreBase):
+    """Zarr store at an fsspec URL with concurrent chunk uploads and the metadata written at the end
+
+    The metadata only exists in memory until commit, it is never read from the
+    URL. With keep_data the objects already at the URL are not deleted when
+    zarr overwrites the store, only the metadata is created again (used to resume).
+    """
+
+    def __init__(self, url, storage_options=None, concurrency=CONCURRENCY, retries=RETRIES):
+        self.url = url
+        self.storage_options = storage_options or {}
+        self.fs, self.root = fsspec.url_to_fs(url, **self.storage_options)
+        self.root = self.root.rstrip("/")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.metadata = {}
+        self.keep_data = False
+        self._pool = None
+
+    def __getstate__(self):
+        # the pool of threads is created again in every dask worker
+        state = dict(self.__dict__)
+        state["_pool"] = None
+        return state
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        return self._pool
+
+    def path(self, key):
+        return self.root + "/" + key if key else self.root
+
+    def retry(self, function, *args):
+        """Call function, repeat it with an increasing delay as long as it fails with a transient error"""
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except FileNotFoundError:
+                raise
+            except RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                delay = 0.5 * 2 ** attempt
+                logging.warning("Request for %s failed (%s), retrying in %.1f s", args[0], e, delay)
+                time.sleep(delay)
+
+    def __getitem__(self, key):
+        if is_metadata(key):
+            return self.metadata[key]
+        try:
+            return self.retry(self.fs.cat_file, self.path(key))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if is_metadata(key):
+            self.metadata[key] = ensure_bytes(value)
+        else:
+            self.retry(self.fs.pipe_file, self.path(key), ensure_bytes(value))
+
+    def setitems(self, values):
+        """Upload all chunks concurrently and return when every upload has finished"""
+        uploads = []
+        for key, value in values.items():
+            if is_metadata(key):
+                self.metadata[key] = ensure_bytes(value)
+            else:
+                uploads.append(self.pool.submit(self.retry, self.fs.pipe_file, self.path(key), ensure_bytes(value)))
+        for upload in uploads:
+            upload.result()
+
+    def __delitem__(self, key):
+        if is_metadata(key):
+            del self.metadata[key]
+        elif self.fs.exists(self.path(key)):
+            self.fs.rm_file(self.path(key))
+        else:
+            raise KeyError(key)
+
+    def delitems(self, keys):
+        for key in keys:
+            try:
+                del self[key]
+            except KeyError:
+                pass
+
+    def __contains__(self, key):
+        if is_metadata(key):
+            return key in self.metadata
+        return self.fs.exists(self.path(key))
+
+    def keys(self):
+        keys = set(self.metadata)
+        if self.fs.exists(self.root):
+            keys.update(path[len(self.root) + 1:] for path in self.fs.find(self.root))
+        return sorted(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def listdir(self, path=""):
+        # groups and arrays are found by their metadata, the chunks are not listed
+        prefix = path.rstrip("/") + "/" if path else ""
+        return sorted({key[len(prefix):].split("/", 1)[0] for key in self.metadata if key.startswith(prefix)})
+
+    def rmdir(self, path=""):
+        prefix = path.rstrip("/") + "/" if path else ""
+        for key in [key for key in self.metadata if key.startswith(prefix)]:
+            del self.metadata[key]
+        if not self.keep_data and self.fs.exists(self.path(path.rstrip("/"))):
+            self.fs.rm(self.path(path.rstrip("/")), recursive=True)
+
+    def commit(self):
+        """Upload the metadata of all groups and arrays and the consolidated metadata, the root group last"""
+        consolidated = {
+            "zarr_consolidated_format": 1,
+            "metadata": {key: json.loads(value) for key, value in self.metadata.items() if key != ".zmetadata"},
+        }
+        self.metadata[".zmetadata"] = json.dumps(consolidated, indent=4, sort_keys=True).encode()
+        # everything below the root first, the root group appears when the store is complete
+        nested = [key for key in self.metadata if "/" in key]
+        for upload in [self.pool.submit(self.retry, self.fs.pipe_file, self.path(key), self.metadata[key])
+                       for key in nested]:
+            upload.result()
+        for key in (".zattrs", ".zgroup", ".zmetadata"):
+            if key in self.metadata:
+                self.retry(self.fs.pipe_file, self.path(key), self.metadata[key])
+
+def open_store(zarr_dir, storage_options=None, concurrency=CONCURRENCY, retries=RETRIES):
+    """The store to write to: the path for local folders, an UploadStore (or a zarr 3 store) for URLs"""
+    if not is_url(zarr_dir):
+        return zarr_dir
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        zarr.config.set({"async.concurrency": concurrency})
+        return zarr.storage.FsspecStore.from_url(zarr_dir, storage_options=storage_options, read_only=False)
+    return UploadStore(zarr_dir, storage_options, concurrency, retries)
+
+def mapper(zarr_dir, storage_options=None):
+    """The path of a local folder or a key-value mapping of a URL or a reference store, to read or update an existing store"""
+    if is_reference(zarr_dir):
+        return fsspec.get_mapper("reference://", fo=zarr_dir, target_options=storage_options or {})
+    return fsspec.get_mapper(zarr_dir, **(storage_options or {})) if is_url(zarr_dir) else zarr_dir
+
+def commit(store):
+    """Write the held back metadata of an UploadStore, consolidate the metadata of any other store"""
+    if isinstance(store, UploadStore):
+        store.commit()
+    else:
+        zarr.consolidate_metadata(store)
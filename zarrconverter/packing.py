@@ -0,0 +1,39 @@
+# Packed storage of integer rasters.
+#
+# Instead of replacing the fill values by NaN, which turns uint16 data into floats,
+# the original integers are stored and the fill values and the scaling are
+# described with CF attributes. Readers like xarray mask and scale lazily on access.
+# xarray knows only one fill value per variable, with a missing_value besides the
+# _FillValue it masks both but warns about multiple fill values when decoding.
+
+import numpy as np
+
+def pack(var, fill_values, scale_factor=None, add_offset=None):
+    """Describe the fill values and the scaling of the raw integer DataArray var with CF attributes
+
+    The first fill value becomes _FillValue, further ones missing_value. An
+    informational Scale_Factor attribute is replaced by the CF scale_factor.
+    scale_factor and add_offset get the float type that holds the integers
+    exactly, the type xarray decodes to.
+    """
+    if var.dtype.kind not in "iu":
+        raise ValueError("Only integer data can be packed, %s has dtype %s" % (var.name, var.dtype))
+    attrs = dict(var.attrs)
+    attrs.pop("Scale_Factor", None)
+    attrs["_FillValue"] = var.dtype.type(fill_values[0])
+    if len(fill_values) > 1:
+        # plain integers, zarr-python 3 writes only JSON types in lists of attributes
+        attrs["missing_value"] = [var.dtype.type(value).item() for value in fill_values[1:]]
+    float_type = np.float32 if var.dtype.itemsize <= 2 else np.float64
+    if scale_factor is not None:
+        attrs["scale_factor"] = float_type(scale_factor)
+    if add_offset is not None:
+        attrs["add_offset"] = float_type(add_offset)
+    var = var.copy(deep=False)
+    var.attrs = attrs
+    return var
+
+def fill_values(*values):
+    """Flat list of the fill values given as scalars or lists (e.g. _FillValue and missing_value), without None and NaN"""
+    arrays = [np.atleast_1d(value) for value in values if value is not None]
+    return [value for value in (np.concatenate(arrays) if arrays else []) if not np.isnan(value)]
@@ -0,0 +1,194 @@
+# Precision-controlled lossy compression of float variables.
+#
+# Most mantissa bits of gridded products are noise far below their real
+# accuracy, they cost disk and read bandwidth but compress badly. A precision
+# spec [VARIABLE=]MODE chooses how much of them is kept:
+#   float32   float64 variables are stored as float32
+#   N         only N mantissa bits are kept, the others are rounded to nearest
+#             (numcodecs.BitRound as a filter of the zarr encoding), a float64
+#             variable with N <= 23 is also stored as float32
+#   auto[:L]  N is chosen from sampled chunks such that the kept bits hold the
+#             fraction L (default 0.99) of the real information of the data
+# The real information of a bit is the mutual information of the bit in
+# neighbouring cells along the last (x) axis, with the information a random
+# pairing would show at the same sample size set to zero (Klöwer et al., 2021,
+# Compressing atmospheric data into its real information content). A spec
+# without VARIABLE= applies to all float variables, integer variables (packed
+# data) and categorical variables (QC bands) are never rounded. The precision
+# and the largest relative error of the stored values are recorded in the
+# attributes precision and max_relative_error of every rounded variable, verify
+# uses the latter as its relative tolerance.
+
+import math
+import logging
+import numpy as np
+
+MODES = ["float32", "N", "auto", "auto:LEVEL"]
+# fraction of the real information kept by auto
+DEFAULT_LEVEL = 0.99
+# exponent and mantissa bits of the float types
+EXPONENT_BITS = {4: 8, 8: 11}
+MANTISSA_BITS = {4: 23, 8: 52}
+# z-score of the 99% confidence bound of the information of a random pairing of bits
+CONFIDENCE_Z = 2.576
+# at least one mantissa bit is kept, with none a NaN would round to zero
+MIN_KEEPBITS = 1
+
+def parse(spec):
+    """(variable, mode, value) of one precision spec, variable is None for all float variables"""
+    variable, _, mode = spec.rpartition("=")
+    variable = variable or None
+    if mode == "float32":
+        return variable, "float32", None
+    if mode.isdigit():
+        bits = int(mode)
+        if not MIN_KEEPBITS <= bits <= MANTISSA_BITS[8]:
+            raise ValueError("%s keeps %d mantissa bits, only %d to %d are possible" % (spec, bits, MIN_KEEPBITS, MANTISSA_BITS[8]))
+        return variable, "bits", bits
+    if mode == "auto" or mode.startswith("auto:"):
+        try:
+            level = float(mode[5:]) if mode != "auto" else DEFAULT_LEVEL
+        except ValueError:
+            level = None
+        if level is None or not 0 < level <= 1:
+            raise ValueError("%s needs a fraction of the information between 0 and 1, e.g. auto:0.99" % spec)
+        return variable, "auto", level
+    raise ValueError("%s is not a precision, use [VARIABLE=]MODE with MODE one of %s" % (spec, ", ".join(MODES)))
+
+def precisions(specs):
+    """{variable: (mode, value)} of the specs, the key None holds the spec for all float variables"""
+    result = {}
+    for spec in specs or []:
+        variable, mode, value = parse(spec)
+        result[variable] = (mode, value)
+    return result
+
+def of(settings, vname):
+    """(mode, value) of variable vname in precisions settings, None to keep its values"""
+    return settings.get(vname, settings.get(None))
+
+def stored_dtype(dtype, mode, bits=None):
+    """dtype of the stored values of a float variable of dtype with precision mode
+
+    bits are the mantissa bits chosen by auto. Before the chunks are sampled
+    (in the plan) they are unknown and an auto variable keeps its dtype, like
+    it does with more than 23 bits.
+    """
+    dtype = np.dtype(dtype)
+    if mode is None or dtype != np.float64:
+        return dtype
+    kind, value = mode
+    bits = value if kind == "bits" else bits
+    if kind == "float32" or (bits is not None and bits <= MANTISSA_BITS[4]):
+        return np.dtype("float32")
+    return dtype
+
+def describe(mode):
+    """Text of a precision mode for the plan"""
+    kind, value = mode
+    if kind == "float32":
+        return "float32"
+    if kind == "bits":
+        return "%d mantissa bits" % value
+    return "mantissa bits holding %g of the information of sampled chunks, float64 becomes float32 with at most %d" % (
+        value, MANTISSA_BITS[4])
+
+def bitinformation(chunks):
+    """Real information of every bit of the float values in chunks, from the sign bit to the last mantissa bit"""
+    nbits = chunks[0].dtype.itemsize * 8
+    uint = np.dtype("uint%d" % nbits)
+    counts = np.zeros((nbits, 4), dtype="int64")
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        left, right = chunk[..., :-1], chunk[..., 1:]
+        # pairs with a missing value carry no information
+        valid = ~(np.isnan(left) | np.isnan(right))
+        left, right = left[valid].view(uint), right[valid].view(uint)
+        for bit in range(nbits):
+            shift = uint.type(nbits - 1 - bit)
+            pairs = 2 * ((left >> shift) & 1).astype("int64") + ((right >> shift) & 1).astype("int64")
+            counts[bit] += np.bincount(pairs, minlength=4)
+    total = counts[0].sum()
+    info = np.zeros(nbits)
+    if not total:
+        return info
+    # a random pairing of n bits shows up to this much information at the confidence bound
+    p = min(1.0, 0.5 + CONFIDENCE_Z / (2 * math.sqrt(total)))
+    noise = 1 - entropy(np.array([p, 1 - p]))
+    for bit in range(nbits):
+        joint = counts[bit].reshape(2, 2) / total
+        independent = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nonzero = joint > 0
+        info[bit] = np.sum(joint[nonzero] * np.log2(joint[nonzero] / independent[nonzero]))
+    info[info <= noise] = 0
+    return info
+
+def entropy(p):
+    """Entropy in bits of the probabilities p"""
+    p = p[p > 0]
+    return float(-np.sum(p * np.log2(p)))
+
+def keepbits(chunks, level=DEFAULT_LEVEL):
+    """Number of mantissa bits holding the fraction level of the real information of chunks"""
+    itemsize = chunks[0].dtype.itemsize
+    info = bitinformation(chunks)
+    if not info.sum():
+        # no information above the noise: constant data or pure noise, nothing is rounded
+        return MANTISSA_BITS[itemsize]
+    needed = int(np.argmax(np.cumsum(info) / info.sum() >= level - 1e-9)) + 1
+    return int(np.clip(needed - 1 - EXPONENT_BITS[itemsize], MIN_KEEPBITS, MANTISSA_BITS[itemsize]))
+
+def max_relative_error(source, stored, bits):
+    """Largest relative error of values of dtype source stored as dtype stored with bits mantissa bits"""
+    error = 0.0
+    if np.dtype(stored).itemsize < np.dtype(source).itemsize:
+        error += 2.0 ** -(MANTISSA_BITS[np.dtype(stored).itemsize] + 1)
+    if bits is not None and bits < MANTISSA_BITS[np.dtype(stored).itemsize]:
+        error += 2.0 ** -(bits + 1)
+    return error
+
+def apply(ds, encoding, specs, categorical=(), samples=4):
+    """Return ds and encoding with the precision of specs, a list of [VARIABLE=]MODE, for every float variable
+
+    The data of ds is not changed, the rounding is a filter of the encoding
+    and the downcast its dtype. categorical variables keep their values. ds
+    gets the attributes precision and max_relative_error of every rounded
+    variable.
+    """
+    settings = precisions(specs)
+    if not settings:
+        return ds, encoding
+    import numcodecs
+    from zarrconverter import codectuning
+    for vname in settings:
+        if vname is not None and (vname not in ds.data_vars or ds[vname].dtype.kind != "f" or vname in categorical):
+            raise ValueError("--precision %s: %s is not a float variable of the dataset with values to round" % (vname, vname))
+    ds = ds.copy()
+    encoding = {vname: dict(values) for vname, values in (encoding or {}).items()}
+    for vname, var in ds.data_vars.items():
+        mode = of(settings, vname)
+        if mode is None or var.dtype.kind != "f" or vname in categorical:
+            continue
+        kind, value = mode
+        bits = value if kind == "bits" else None
+        text = None
+        if kind == "auto":
+            data = var.data if var.chunks else var.chunk().data
+            bits = keepbits(codectuning.sample_chunks(data, samples), value)
+            text = "%d mantissa bits holding %g of the information" % (bits, value)
+        stored = stored_dtype(var.dtype, mode, bits)
+        mantissa = MANTISSA_BITS[stored.itemsize]
+        values = encoding.setdefault(vname, {})
+        if stored != var.dtype:
+            values["dtype"] = str(stored)
+        if bits is not None and bits < mantissa:
+            values["filters"] = [numcodecs.BitRound(keepbits=bits)] + list(values.get("filters") or [])
+        else:
+            bits = mantissa
+        text = "%s, %s" % (stored, text or "%d of %d mantissa bits" % (bits, mantissa))
+        error = max_relative_error(var.dtype, stored, bits)
+        var.attrs["precision"] = text
+        var.attrs["max_relative_error"] = error
+        logging.info("%s: %s, relative error at most %g", vname, text, error)
+        print("Precision of %s: %s, relative error at most %.2g" % (vname, text, error))
+    return ds, encoding
@@ -0,0 +1,127 @@
+# Multiscale pyramids (overviews) written together with the full resolution data.
+#
+# Level k halves the resolution of level k - 1 along the spatial dimensions and is
+# stored as the group "k" next to the full resolution variables in the root group,
+# described by a "multiscales" attribute of the root group. Every level is computed
+# from the blocks of the previous level inside the same task graph (or from the
+# raster in memory in the direct writer), so the source files are read once.
+#
+# Windows of 2x2 cells are averaged, missing values (NaN or the fill values of
+# packed integers) are left out. Categorical variables such as quality flags keep
+# the value of the upper left cell instead.
+
+import functools
+import numpy as np
+import dask.array as da
+import xarray as xr
+from zarrconverter import packing
+
+FACTOR = 2
+
+def fill_values(var):
+    """Fill values of packed integer data from the CF attributes"""
+    return packing.fill_values(var.attrs.get("_FillValue"), var.attrs.get("missing_value"))
+
+def masked_mean(x, axis=None, fills=(), dtype=None):
+    """Mean over axis without NaN and fill values, integers are rounded and empty windows get the first fill value"""
+    dtype = np.dtype(dtype or x.dtype)
+    valid = ~np.isnan(x) if x.dtype.kind == "f" else ~np.isin(x, fills)
+    counts = valid.sum(axis=axis)
+    sums = np.where(valid, x, 0).sum(axis=axis, dtype="float64")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+    if dtype.kind == "f":
+        return mean.astype(dtype)
+    empty = fills[0] if len(fills) else 0
+    return np.where(counts > 0, np.rint(mean), empty).astype(dtype)
+
+def first(x, axis=None):
+    """Value of the first cell of every window"""
+    for ax in sorted(axis or (), reverse=True):
+        x = np.take(x, 0, axis=ax)
+    return x
+
+def reduction(var, categorical=False):
+    """Function for dask.array.coarsen that reduces the windows of var to single values"""
+    if categorical:
+        return first
+    return functools.partial(masked_mean, fills=fill_values(var), dtype=var.dtype)
+
+def reduce_raster(data, reduce):
+    """Reduce the last two dimensions of a numpy array by FACTOR, the same as coarsen does it with dask"""
+    rows, cols = data.shape[-2] // FACTOR * FACTOR, data.shape[-1] // FACTOR * FACTOR
+    data = data[..., :rows, :cols]
+    shape = data.shape[:-2] + (rows // FACTOR, FACTOR, cols // FACTOR, FACTOR)
+    return reduce(data.reshape(shape), axis=(data.ndim - 1, data.ndim + 1))
+
+def coarsen_coord(coord):
+    """Centers of the merged cells of a regular coordinate"""
+    values = coord.values[:coord.size // FACTOR * FACTOR]
+    return xr.DataArray(values.reshape(-1, FACTOR).mean(axis=1), dims=coord.dims, attrs=coord.attrs)
+
+def coarsen(ds, dims, categorical=()):
+    """ds with the resolution reduced by FACTOR along dims, an incomplete window at the end is dropped"""
+    coords = {}
+    for name, coord in ds.coords.items():
+        if name in dims:
+            coords[name] = coarsen_coord(coord)
+        elif "GeoTransform" in coord.attrs:
+            # the grid mapping of rioxarray, the pixels get bigger
+            transform = [float(value) for value in coord.attrs["GeoTransform"].split()]
+            transform[1] *= FACTOR
+            transform[5] *= FACTOR
+            coords[name] = coord.copy(deep=False)
+            coords[name].attrs = {**coord.attrs, "GeoTransform": " ".join(str(value) for value in transform)}
+        elif not set(coord.dims) & set(dims):
+            coords[name] = coord
+    variables = {}
+    for vname, var in ds.data_vars.items():
+        axes = {var.dims.index(dim): FACTOR for dim in dims if dim in var.dims}
+        if not axes:
+            variables[vname] = var.variable
+            continue
+        data = var.data if isinstance(var.data, da.Array) else da.from_array(var.data)
+        # every block has to hold whole windows
+        data = data.rechunk({axis: data.chunks[axis][0] + data.chunks[axis][0] % FACTOR for axis in axes})
+        data = da.coarsen(reduction(var, vname in categorical), data, axes, trim_excess=True)
+        variables[vname] = xr.Variable(var.dims, data, var.attrs, var.encoding)
+    attrs = {key: value for key, value in ds.attrs.items() if key != "multiscales"}
+    return xr.Dataset(variables, coords=coords, attrs=attrs)
+
+def level_encoding(encoding):
+    """Encoding of a pyramid level, the compression of the full resolution without its chunk shapes"""
+    return {vname: {key: value for key, value in settings.items() if key not in ("chunks", "shards")}
+            for vname, settings in (encoding or {}).items()}
+
+def multiscales(ds, levels, dims, name=None):
+    """Multiscales attribute of the root group, level 0 is the root group itself"""
+    axes = [{"name": dim, "type": "space" if dim in dims else "time" if dim == "time" else "other"}
+            for dim in ds.dims]
+    datasets = []
+    for level in range(levels + 1):
+        scale = [float(FACTOR ** level if dim in dims else 1) for dim in ds.dims]
+        datasets.append({"path": "." if level == 0 else str(level),
+                         "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+    return [{
+        "version": "0.4",
+        "name": name or ds.attrs.get("title", ""),
+        "axes": axes,
+        "datasets": datasets,
+        "type": "mean",
+        "metadata": {"description": "2x2 mean without missing values, categorical variables keep the upper left cell"},
+    }]
+
+def reductions(ds, categorical=()):
+    """The reduction of every data variable, for writers that coarsen numpy rasters with reduce_raster"""
+    return {vname: reduction(var, vname in categorical) for vname, var in ds.data_vars.items()}
+
+def build(ds, encoding, levels, dims, categorical=()):
+    """Return ds with the multiscales attribute and the list of (dataset, encoding) of the levels 1 to levels"""
+    pyramid = []
+    level = ds
+    for _ in range(levels):
+        level = coarsen(level, dims, categorical)
+        pyramid.append((level, level_encoding(encoding)))
+    ds = ds.copy(deep=False)
+    ds.attrs = {**ds.attrs, "multiscales": multiscales(ds, levels, dims)}
+    return ds, pyramid
@@ -0,0 +1,104 @@
+# Pool of processes that decode the data variables of netCDF files.
+#
+# netCDF4 and HDF5 serialize all calls of a process behind one global lock, so
+# threads of one process read and decompress the files one after the other and
+# open_mfdataset(parallel=True) does not help either. The reader pool moves the
+# reads into worker processes, each with its own HDF5 library and its own open
+# files (fileindex.open_file). The dask tasks run in threads of the script: a
+# task sends file, variable and window of its block to a reader and waits
+# without holding the GIL while the reader decodes it, then it compresses and
+# writes the block itself (Blosc releases the GIL as well). Decoded blocks come
+# back through shared memory instead of being pickled through the pipe of the
+# pool, only small blocks take the pipe.
+#
+# The readers are started from a fork server that has only this module loaded,
+# never by forking the script with its threads and open HDF5 files.
+
+import logging
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+import dask
+from zarrconverter import cluster, fileindex
+
+# blocks smaller than this are sent through the pipe of the pool
+SHARED_BYTES = 64 * 1024
+
+def read_block(path, name, key):
+    """Decode a window of a variable in a reader, return it or the shared memory block it was copied to"""
+    data = fileindex.read_values(path, name, key)
+    if data.nbytes < SHARED_BYTES:
+        return data
+    shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, data.dtype, buffer=shm.buf)[...] = data
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, data.shape, data.dtype.str
+
+def receive(result):
+    """The array of read_block, a shared memory block is copied and released"""
+    if isinstance(result, np.ndarray):
+        return result
+    name, shape, dtype = result
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def context():
+    """Start method of the readers, a fork server where there is one"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+class ReaderPool:
+    """Processes that read the windows of netCDF variables for the FileArrays of a FileIndex
+
+    A copy in another process (e.g. a pickled task graph) has no processes
+    and reads the files itself.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or cluster.resources()["cores"]
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=context())
+
+    def __getstate__(self):
+        return {"processes": self.processes, "executor": None}
+
+    def read(self, path, name, key):
+        """Values of variable name of the file path at the outer indexer key"""
+        if self.executor is None:
+            return fileindex.read_values(path, name, key)
+        return receive(self.executor.submit(read_block, path, name, key).result())
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def start(processes=None, threads=None):
+    """Reader pool of processes (default: one per usable core), the dask tasks run in threads of this process
+
+    There are at least as many threads as readers, so every reader has a
+    block to decode while the other threads compress and write.
+    """
+    pool = ReaderPool(processes)
+    threads = max(threads or cluster.resources()["cores"], pool.processes)
+    dask.config.set(scheduler="threads", num_workers=threads)
+    print("%d reader processes decode the files, %d threads compress and write" % (pool.processes, threads))
+    logging.info("Reader pool of %d processes started", pool.processes)
+    return pool
+
+def stop(pool):
+    """Shut the reader processes down"""
+    if pool is not None:
+        pool.close()
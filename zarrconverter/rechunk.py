@@ -0,0 +1,137 @@
+# Rechunking of a zarr store with bounded memory.
+#
+# Going from spatial chunks (e.g. 1x1080x1080) to time series chunks (e.g. 256x30x30)
+# in one step means that every output chunk reads from hundreds of input chunks. If
+# a block that covers whole chunks of both layouts does not fit into the memory
+# limit, the copy goes through an intermediate store whose chunks are compatible
+# with both layouts (the same algorithm as the rechunker package).
+#
+# Every copy task is aligned to the chunks it writes, so no chunk is written by two
+# tasks, and reads and writes one block that is smaller than half the memory limit.
+
+import os
+import math
+import shutil
+import logging
+import itertools
+import dask
+import dask.array as da
+import xarray as xr
+import zarr
+import numcodecs
+from dask.utils import parse_bytes
+from zarrconverter import chunkstats, cluster, sharding
+
+def nbytes(chunks, itemsize):
+    return math.prod(chunks) * itemsize
+
+def consolidate(chunks, limits, shape, itemsize, budget):
+    """Grow chunks by integer multiples up to limits as long as a block fits into budget bytes"""
+    chunks = list(chunks)
+    for dim in range(len(chunks)):
+        limit = min(limits[dim], shape[dim])
+        others = nbytes(chunks[:dim] + chunks[dim + 1:], itemsize)
+        factor = min(limit // chunks[dim], budget // (others * chunks[dim]))
+        chunks[dim] *= max(1, factor)
+    return tuple(chunks)
+
+def plan(shape, source, target, itemsize, max_mem):
+    """Return the copy stages as (intermediate chunks, block) pairs, the last stage writes the target"""
+    source = tuple(min(s, n) for s, n in zip(source, shape))
+    target = tuple(min(t, n) for t, n in zip(target, shape))
+    budget = max_mem // 2
+    if nbytes(source, itemsize) > budget or nbytes(target, itemsize) > budget:
+        raise ValueError("max_mem is too small, it has to hold at least two source and two target chunks")
+
+    # a single copy is enough if one block covers whole source chunks and whole target chunks
+    direct = tuple(min(n, t * math.ceil(s / t)) for s, t, n in zip(source, target, shape))
+    if nbytes(direct, itemsize) <= budget:
+        return [(target, direct)]
+
+    limits = tuple(max(s, t) for s, t in zip(source, target))
+    read = consolidate(source, limits, shape, itemsize, budget)
+    write = consolidate(target, limits, shape, itemsize, budget)
+    intermediate = tuple(min(r, w) for r, w in zip(read, write))
+    first = tuple(i * max(1, r // i) for i, r in zip(intermediate, read))
+    return [(intermediate, first), (target, write)]
+
+def blocks(shape, block):
+    """All regions of an array with the given shape split into blocks"""
+    ranges = [range(0, n, b) for n, b in zip(shape, block)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + b, n)) for start, b, n in zip(starts, block, shape))
+
+def copy_block(source, target, region):
+    target[region] = source[region]
+
+def copy_tasks(source, target, block):
+    return [dask.delayed(copy_block)(source, target, region) for region in blocks(source.shape, block)]
+
+def template(ds, chunks):
+    """Dataset with the layout of the target store and cheap dummy data, only used to write the metadata"""
+    encoding = {}
+    for vname in list(ds.variables):
+        var = ds[vname]
+        if var.chunks is None or vname in ds.dims:
+            continue
+        if vname not in ds.data_vars:
+            ds[vname] = var.load()
+            continue
+        target = tuple(chunks.get(dim, size) for dim, size in zip(var.dims, var.shape))
+        ds[vname] = var.copy(data=da.zeros(var.shape, chunks=target, dtype=var.dtype))
+        encoding[vname] = {key: value for key, value in var.encoding.items()
+                           if key not in ("chunks", "shards", "preferred_chunks", "coordinates")}
+        encoding[vname]["chunks"] = target
+    return ds, encoding
+
+def rechunk(source_dir, target_dir, chunks, max_mem="2GB", temp_dir=None):
+    """Copy the zarr store source_dir to target_dir with chunks {dim: size} and at most max_mem per task"""
+    max_mem = parse_bytes(max_mem) if isinstance(max_mem, str) else max_mem
+    temp_dir = temp_dir or target_dir.rstrip("/\\") + ".intermediate"
+
+    ds = xr.open_zarr(source_dir)
+    ds, encoding = template(ds, chunks)
+    # the target and the intermediate store keep the zarr format of the source, zarr-python 3 writes v3 by default
+    options = {}
+    if chunkstats.zarr_v3():
+        options["zarr_format"] = zarr.open_group(source_dir, mode="r").metadata.zarr_format
+        if options["zarr_format"] == 2:
+            encoding = {vname: sharding.v2_encoding(settings) for vname, settings in encoding.items()}
+    ds.to_zarr(target_dir, mode="w", compute=False, consolidated=False, encoding=encoding, **options)
+
+    source_group = zarr.open_group(source_dir, mode="r")
+    target_group = zarr.open_group(target_dir, mode="r+")
+    temp_group = None
+    stages = {}
+    for vname in encoding:
+        source = source_group[vname]
+        target = target_group[vname]
+        stages[vname] = plan(source.shape, source.chunks, target.chunks, source.dtype.itemsize, max_mem)
+        logging.info("Rechunking %s from %s to %s in %d stage(s)", vname, source.chunks, target.chunks, len(stages[vname]))
+
+    # the stages are computed one after the other, every stage reads what the previous one wrote
+    for stage in range(max(len(steps) for steps in stages.values())):
+        tasks = []
+        for vname, steps in stages.items():
+            if stage >= len(steps):
+                continue
+            intermediate, block = steps[stage]
+            source = source_group[vname] if stage == 0 else temp_group[vname]
+            if stage == len(steps) - 1:
+                target = target_group[vname]
+            else:
+                if temp_group is None:
+                    temp_group = zarr.open_group(temp_dir, mode="w", **options)
+                compressor = numcodecs.Blosc(cname="lz4", clevel=1)
+                if options.get("zarr_format") == 3:
+                    compressor = sharding.v3_codec(compressor)
+                target = temp_group.create_dataset(vname, shape=source.shape, chunks=intermediate,
+                                                   dtype=source.dtype, fill_value=source.fill_value,
+                                                   compressor=compressor)
+            tasks += copy_tasks(source, target, block)
+        logging.info("Rechunking stage %d with %d tasks", stage + 1, len(tasks))
+        dask.compute(*tasks, priority=cluster.priority())
+
+    zarr.consolidate_metadata(target_dir)
+    if temp_group is not None and os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
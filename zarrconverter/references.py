@@ -0,0 +1,193 @@
+# Reference output: a zarr store whose chunks stay in the netCDF files.
+#
+# netCDF4 files are HDF5 files, and the chunks of an HDF5 dataset are stored as
+# byte ranges that zarr can read directly if the HDF5 filters (deflate, shuffle,
+# fletcher32, zstd) are given as zarr codecs. The chunk layout of every variable
+# of every file is scanned with h5py (in parallel, HDF5 serializes all calls of a
+# process) and mapped to the chunk keys of the combined dataset. Metadata,
+# attributes and coordinates are written by xarray exactly as for a full
+# conversion and kept inline. The result is a kerchunk style JSON file (version 1)
+# that fsspec's reference file system opens as a zarr store, nothing is copied.
+#
+# All files have to use the same chunks and filters for a variable and every
+# file has to start at a chunk boundary of the combined dataset.
+
+import os
+import json
+import base64
+import logging
+import concurrent.futures
+import numpy as np
+import numcodecs
+import fsspec
+import xarray as xr
+import zarr
+
+# HDF5 filter ids
+DEFLATE, SHUFFLE, FLETCHER32, ZSTD = 1, 2, 3, 32015
+# encoding of the source variables that describes the stored values
+CF_ENCODING = ("_FillValue", "missing_value", "scale_factor", "add_offset", "units", "calendar")
+
+def require_h5py():
+    """Import h5py, it is only needed to read the chunk layout of the files"""
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("Reference output needs h5py to read the chunk layout of the netCDF files (pip install h5py)")
+    return h5py
+
+def hdf5_codecs(dset):
+    """numcodecs configs that decode the chunks of an HDF5 dataset, in the order the filters were applied"""
+    plist = dset.id.get_create_plist()
+    codecs = []
+    for i in range(plist.get_nfilters()):
+        code, _, values, _ = plist.get_filter(i)
+        if code == DEFLATE:
+            codecs.append(numcodecs.Zlib(level=values[0] if values else 6))
+        elif code == SHUFFLE:
+            codecs.append(numcodecs.Shuffle(elementsize=dset.dtype.itemsize))
+        elif code == FLETCHER32:
+            codecs.append(numcodecs.Fletcher32())
+        elif code == ZSTD:
+            codecs.append(numcodecs.Zstd(level=values[0] if values else 1))
+        else:
+            raise ValueError("%s uses the HDF5 filter %d, which has no zarr codec, use the full conversion"
+                             % (dset.name, code))
+    return [codec.get_config() for codec in codecs]
+
+def scan_file(path, names):
+    """Chunk shape, codecs and (chunk index, offset, length) of the stored chunks of the variables names of a file"""
+    h5py = require_h5py()
+    layout = {}
+    with h5py.File(path, "r") as h5:
+        for name in names:
+            if name not in h5:
+                continue
+            dset = h5[name]
+            kind = dset.id.get_create_plist().get_layout()
+            if kind == h5py.h5d.CHUNKED:
+                chunks = dset.chunks
+                refs = []
+                for i in range(dset.id.get_num_chunks()):
+                    info = dset.id.get_chunk_info(i)
+                    if info.filter_mask:
+                        raise ValueError("A chunk of %s in %s skipped a filter, it can not be referenced" % (name, path))
+                    refs.append((tuple(o // c for o, c in zip(info.chunk_offset, chunks)), info.byte_offset, info.size))
+            elif kind == h5py.h5d.CONTIGUOUS and dset.ndim:
+                chunks = dset.shape
+                offset = dset.id.get_offset()
+                refs = [] if offset is None else [((0,) * dset.ndim, offset, dset.id.get_storage_size())]
+            else:
+                # compact and scalar datasets are written inline
+                continue
+            layout[name] = {"chunks": tuple(chunks), "codecs": hdf5_codecs(dset), "dtype": dset.dtype.str,
+                            "refs": refs}
+    return layout
+
+def scan(files, names, workers=None):
+    """scan_file of all files, in parallel by a pool of processes"""
+    if len(files) == 1:
+        return [scan_file(files[0], names)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(scan_file, files, [names] * len(files), chunksize=max(1, len(files) // 256)))
+
+def file_offsets(ds, file_ds, dims):
+    """Start and length of a file in the combined dataset along dims"""
+    offsets = {}
+    for dim in dims:
+        length = file_ds.sizes.get(dim, 1)
+        if dim in file_ds.indexes:
+            index = ds.get_index(dim)
+            start = index.get_loc(file_ds.indexes[dim][0])
+            if not index[start:start + length].equals(file_ds.indexes[dim]):
+                raise ValueError("The %s coordinate of %s is not a contiguous part of the combined dataset"
+                                 % (dim, file_ds.encoding.get("source")))
+        else:
+            start = 0
+        offsets[dim] = (start, length)
+    return offsets
+
+def inline(value):
+    """Value of a reference to data kept in the JSON file, text as is and binary data base64 encoded"""
+    try:
+        return value.decode("ascii")
+    except UnicodeDecodeError:
+        return "base64:" + base64.b64encode(value).decode("ascii")
+
+def build(ds, files, index=None, workers=None):
+    """References of a zarr store of ds (the combined files) with the data chunks in the files
+
+    index is the FileIndex of the files, without it every file is opened to
+    find its place in the combined dataset.
+    """
+    file_datasets = [index.open_dataset(file) if index is not None else xr.open_dataset(file) for file in files]
+    names = [vname for vname in ds.data_vars if ds[vname].ndim]
+    layouts = scan([os.path.abspath(file) for file in files], names, workers)
+
+    # chunks and codecs have to be the same in all files
+    referenced = {}
+    for vname in names:
+        found = [layout[vname] for layout in layouts if vname in layout]
+        if len(found) < sum(vname in file_ds for file_ds in file_datasets):
+            logging.info("%s is not stored in chunks in all files, it is written inline", vname)
+            continue
+        first = found[0]
+        for other in found[1:]:
+            if (other["chunks"], other["codecs"], other["dtype"]) != (first["chunks"], first["codecs"], first["dtype"]):
+                raise ValueError("%s has different chunks, filters or dtype in the files, use the full conversion" % vname)
+        referenced[vname] = first
+
+    refs = {}
+    encoded = ds.copy()
+    for vname in ds.variables:
+        var = encoded[vname]
+        cf = {key: value for key, value in var.encoding.items() if key in CF_ENCODING}
+        if vname not in referenced:
+            encoded[vname] = var.load()
+            encoded[vname].encoding = dict(cf, dtype=var.encoding.get("dtype", var.dtype))
+            continue
+        layout = referenced[vname]
+        # dimensions the files do not have (like time for variables concatenated by xarray) get chunks of 1
+        extra = var.ndim - len(layout["chunks"])
+        chunks = (1,) * extra + layout["chunks"]
+        compressor = layout["codecs"][-1] if layout["codecs"] else None
+        encoded[vname] = var.chunk(dict(zip(var.dims, chunks)))
+        encoded[vname].encoding = dict(cf, dtype=np.dtype(layout["dtype"]), chunks=chunks,
+                                       compressor=numcodecs.get_codec(compressor) if compressor else None,
+                                       filters=[numcodecs.get_codec(codec) for codec in layout["codecs"][:-1]] or None)
+        for file, file_ds, file_layout in zip(files, file_datasets, layouts):
+            if vname not in file_layout:
+                continue
+            if file_ds[vname].dims != var.dims[extra:]:
+                raise ValueError("%s has the dimensions %s in %s, the combined dataset %s"
+                                 % (vname, file_ds[vname].dims, file, var.dims))
+            offsets = file_offsets(ds, file_ds, var.dims)
+            for dim, chunk in zip(var.dims[extra:], layout["chunks"]):
+                start, length = offsets[dim]
+                if start % chunk or (length % chunk and start + length != ds.sizes[dim]):
+                    raise ValueError("%s of %s does not start at a chunk boundary along %s, use the full conversion"
+                                     % (vname, file, dim))
+            url = os.path.abspath(file)
+            for index_in_file, byte_offset, size in file_layout[vname]["refs"]:
+                grid = [offsets[dim][0] // chunk + i
+                        for dim, chunk, i in zip(var.dims[extra:], layout["chunks"], index_in_file)]
+                for outer in np.ndindex(*[offsets[dim][1] for dim in var.dims[:extra]]):
+                    position = [offsets[dim][0] + i for dim, i in zip(var.dims[:extra], outer)]
+                    refs[vname + "/" + ".".join(str(i) for i in position + grid)] = [url, byte_offset, size]
+
+    # metadata, attributes and coordinates as xarray writes them for a full conversion
+    metadata = {}
+    options = {"zarr_format": 2} if int(zarr.__version__.split(".")[0]) >= 3 else {}
+    encoded.to_zarr(metadata, mode="w", compute=False, consolidated=True, **options)
+    for key, value in metadata.items():
+        refs[key] = inline(bytes(value) if not isinstance(value, bytes) else value)
+    return refs
+
+def write(ds, files, path, index=None, workers=None, storage_options=None):
+    """Write the references of ds (the combined files) as JSON to path, returns the number of referenced chunks"""
+    refs = build(ds, files, index, workers)
+    with fsspec.open(path, "w", **(storage_options or {})) as f:
+        json.dump({"version": 1, "refs": refs}, f)
+    chunks = sum(1 for value in refs.values() if isinstance(value, list))
+    logging.info("%d chunks of %d files referenced in %s", chunks, len(files), path)
+    return chunks
@@ -0,0 +1,166 @@
+# Instrumentation of a conversion run.
+#
+# A RunReport collects the time spent in every stage of a run (file discovery,
+# opening, graph build, compute and write, metadata consolidation), counters such
+# as bytes read and chunks written and the peak memory of the script and of every
+# dask worker. At the end everything is written to a JSON file next to the zarr
+# store and a short summary is printed. The optional progress line follows the
+# manifest of the checkpoint writer, so it works with every dask scheduler. The
+# writer of --direct and verify print their progress only with it switched on.
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from datetime import datetime
+import psutil
+import fsspec
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the current instead of the peak memory is reported there
+    resource = None
+
+def peak_rss(children=False):
+    """Peak resident memory in bytes of this process or of its largest finished child process"""
+    if resource is None:
+        return 0 if children else psutil.Process().memory_info().rss
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # bytes on macOS, kilobytes everywhere else
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+def du(path, storage_options=None):
+    """Size of all files below path (or an fsspec URL) in bytes"""
+    if "://" in str(path):
+        fs, root = fsspec.url_to_fs(path, **(storage_options or {}))
+        return fs.du(root) if fs.exists(root) else 0
+    if not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+def stage(report, name):
+    """report.stage(name) or nothing if there is no report"""
+    return report.stage(name) if report is not None else contextlib.nullcontext()
+
+def watch(report, manifest, total):
+    """report.watch(manifest, total) or nothing if there is no report"""
+    return report.watch(manifest, total) if report is not None else contextlib.nullcontext()
+
+def show_progress(report, text):
+    """report.show_progress(text) or nothing if there is no report"""
+    if report is not None:
+        report.show_progress(text)
+
+def end_progress(report):
+    """report.end_progress() or nothing if there is no report"""
+    if report is not None:
+        report.end_progress()
+
+class RunReport:
+    """Stage timings, counters and memory of one run, written as JSON to path"""
+
+    def __init__(self, script, path=None, progress=False):
+        self.script = script
+        self.path = path
+        self.progress = progress
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.memory = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed code as stage name, repeated stages are added up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        """Add value to the counter name"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def read_files(self, files):
+        """Count the number and the size of the input files"""
+        self.count("files_read", len(files))
+        self.count("bytes_read", sum(os.path.getsize(file) for file in files))
+
+    @contextlib.contextmanager
+    def watch(self, manifest, total):
+        """Print a progress line with the number of finished blocks in manifest while the enclosed code runs"""
+        if not self.progress:
+            yield
+            return
+        stopped = threading.Event()
+
+        def show():
+            with open(manifest) as f:
+                # the first line is the header of the manifest
+                done = max(0, f.read().count("\n") - 1)
+            elapsed = time.perf_counter() - self.start
+            print("\r%d of %d blocks written (%.0f%%), %.0f s elapsed" % (
+                done, total, 100 * done / max(1, total), elapsed), end="", flush=True)
+
+        def run():
+            while not stopped.wait(1):
+                show()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+            show()
+            print()
+
+    def show_progress(self, text):
+        """Print text over the previous progress line, only with the progress line switched on"""
+        if self.progress:
+            print("\r" + text, end="", flush=True)
+
+    def end_progress(self):
+        """Finish the progress line printed by show_progress"""
+        if self.progress:
+            print()
+
+    def measure_memory(self, client=None):
+        """Record the peak memory of this process, of child processes and of every worker of client"""
+        self.memory["main"] = peak_rss()
+        self.memory["children"] = peak_rss(children=True)
+        if client is not None:
+            self.memory["workers"] = client.run(peak_rss)
+
+    def summary(self):
+        """Everything measured so far as a dict"""
+        wall = time.perf_counter() - self.start
+        return {
+            "script": self.script,
+            "started": self.started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "wall_s": wall,
+            "stages": self.stages,
+            "dominant_stage": max(self.stages, key=self.stages.get) if self.stages else None,
+            "counters": self.counters,
+            "memory": self.memory,
+        }
+
+    def write(self):
+        """Print the time of every stage and write the report as JSON"""
+        summary = self.summary()
+        for name, seconds in self.stages.items():
+            print("%s: %.1f s (%.0f%%)" % (name, seconds, 100 * seconds / summary["wall_s"]))
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump(summary, f, indent=2)
+            print("Run report written to " + self.path)
+        return summary
@@ -0,0 +1,87 @@
+# Zarr v3 output with sharding.
+#
+# A shard is one file (object) that holds many small inner chunks and an index of
+# their positions. Clients still read single inner chunks, but the store has one
+# file per shard instead of one file per chunk. The inner chunks are the chunks
+# planned by the converter, the shards are given separately and rounded up to
+# whole inner chunks. Every dask task writes whole shards, a shard written by two
+# tasks would lose the chunks of one of them.
+#
+# Sharding needs zarr-python 3 (and an xarray that supports it), all other output
+# modes work with zarr-python 2 as well. Under zarr-python 3 they write zarr v2
+# stores, with the compressor of the encoding given in the form of zarr-python 3.
+
+import math
+import logging
+import numcodecs
+import zarr
+
+SHUFFLE_NAMES = {numcodecs.Blosc.NOSHUFFLE: "noshuffle", numcodecs.Blosc.SHUFFLE: "shuffle",
+                 numcodecs.Blosc.BITSHUFFLE: "bitshuffle"}
+
+def require_v3():
+    """Raise an error if the installed zarr-python can not write shards"""
+    if int(zarr.__version__.split(".")[0]) < 3:
+        raise RuntimeError("Sharded output needs zarr-python 3, zarr %s is installed (pip install 'zarr>=3')"
+                           % zarr.__version__)
+
+def v3_codec(codec):
+    """Zarr v3 codec for a numcodecs codec of a zarr v2 encoding"""
+    if isinstance(codec, numcodecs.Blosc):
+        from zarr.codecs import BloscCodec
+        return BloscCodec(cname=codec.cname, clevel=codec.clevel, shuffle=SHUFFLE_NAMES[codec.shuffle])
+    # wrappers of the numcodecs codecs for zarr v3, only part of numcodecs for zarr-python 3
+    from numcodecs import zarr3
+    config = codec.get_config()
+    config.pop("id")
+    return getattr(zarr3, type(codec).__name__)(**config)
+
+def v3_encoding(settings):
+    """Encoding of one variable with compressor and filters converted to their zarr v3 form"""
+    settings = dict(settings)
+    compressor = settings.pop("compressor", None)
+    filters = settings.pop("filters", None)
+    if compressor is not None:
+        settings["compressors"] = [v3_codec(compressor)]
+    if filters:
+        settings["filters"] = [v3_codec(codec) for codec in filters]
+    return settings
+
+def v2_encoding(settings):
+    """Encoding of one variable of a zarr v2 store written by zarr-python 3, which takes a list of compressors"""
+    settings = dict(settings)
+    if "compressor" in settings:
+        compressor = settings.pop("compressor")
+        settings["compressors"] = [compressor] if compressor is not None else None
+    return settings
+
+def shard_shape(chunks, shards, sizes):
+    """Shards as whole multiples of the inner chunks, at most the size of the dimension rounded up"""
+    shape = {}
+    for dim, chunk in chunks.items():
+        shard = min(shards.get(dim, chunk), sizes[dim])
+        shape[dim] = max(1, math.ceil(shard / chunk)) * chunk
+    return shape
+
+def apply(ds, encoding, shards):
+    """Return ds with dask chunks of whole shards and the zarr v3 encoding with inner chunks and shards
+
+    The current dask chunks of ds become the inner chunks, shards is {dim: size}.
+    """
+    require_v3()
+    encoding = {vname: v3_encoding(settings) for vname, settings in (encoding or {}).items()}
+    for vname in ds.data_vars:
+        var = ds[vname]
+        if var.chunks is None:
+            continue
+        chunks = {dim: sizes[0] for dim, sizes in var.chunksizes.items()}
+        shape = shard_shape(chunks, shards, var.sizes)
+        ds[vname] = var.chunk(shape)
+        settings = encoding.setdefault(vname, {})
+        settings["chunks"] = tuple(chunks[dim] for dim in var.dims)
+        settings["shards"] = tuple(shape[dim] for dim in var.dims)
+        files = math.prod(math.ceil(var.sizes[dim] / shape[dim]) for dim in var.dims)
+        inner = math.prod(math.ceil(var.sizes[dim] / chunks[dim]) for dim in var.dims)
+        logging.info("%s: inner chunks %s in shards %s", vname, settings["chunks"], settings["shards"])
+        print("%s: %d shard files instead of %d chunk files" % (vname, files, inner))
+    return ds, encoding
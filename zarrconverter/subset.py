@@ -0,0 +1,295 @@
+# Regional and temporal subsets read straight from the files.
+#
+# A bounding box (in any CRS, longitude and latitude by default), a time range
+# and a selection of variables are applied before anything is read: files
+# outside of the time range are dropped by the dates parsed from their names
+# (or by the time coordinates in the file index) and never opened, TIFF files
+# are read through a GDAL window of the box, so only the tiles that intersect it
+# are decoded, and the netCDF variables are sliced lazily before they are
+# chunked, so HDF5 only decodes the chunks that intersect the box. The subset
+# keeps its georeferencing: the coordinates are those of the window and the
+# GeoTransform of the grid mapping is moved to its corner.
+#
+# On grids in longitude and latitude the box is moved by whole turns onto the
+# longitudes of the grid (a box from -10 to 10 selects 350 to 10 of a grid from 0
+# to 360), a west larger than east crosses the antimeridian. A netCDF selection
+# across the edge of a global grid continues past it with the longitudes of the
+# columns after the edge a turn larger, a TIFF window cannot wrap around.
+#
+# The functions for --plan work without xarray, rasterio is only imported by the
+# functions that transform boxes or CRS, a --plan without --bbox does not load it.
+
+import math
+import numpy as np
+
+DEFAULT_CRS = "EPSG:4326"
+# names of the spatial dimensions that are recognized without being given
+Y_NAMES = ("lat", "latitude", "y")
+X_NAMES = ("lon", "longitude", "x")
+# bounds closer than this (in pixels) to a pixel edge count as on the edge
+EDGE = 1e-6
+# degrees of longitude after which a geographic grid repeats
+TURN = 360.0
+
+def time_bounds(time_range):
+    """Start and inclusive end of a time range of ISO dates, a year or month as end includes all of it"""
+    if not time_range:
+        return None
+    start, end = (np.datetime64(value) for value in time_range)
+    unit = np.datetime_data(end.dtype)[0]
+    end = (end + np.timedelta64(1, unit)).astype("datetime64[ns]") - np.timedelta64(1, "ns")
+    return start.astype("datetime64[ns]"), end
+
+def as_datetime(value):
+    """numpy datetime64[ns] of a time stamp, a year given as integer or a cftime date (None if it has no such date)"""
+    if isinstance(value, (int, np.integer)):
+        return np.datetime64(str(value), "ns")
+    if hasattr(value, "isoformat") and not isinstance(value, np.datetime64):
+        try:
+            return np.datetime64(value.isoformat(), "ns")
+        except ValueError:
+            return None
+    return np.datetime64(value, "ns")
+
+def overlaps(times, bounds):
+    """True if any of times is within bounds (start, end), unknown times count as inside"""
+    if bounds is None:
+        return True
+    stamps = [as_datetime(time) for time in np.ravel(times)]
+    return any(stamp is None or bounds[0] <= stamp <= bounds[1] for stamp in stamps)
+
+def range_overlaps(first, last, bounds):
+    """True if the time steps from first to last can be within bounds (start, end), unknown times count as inside"""
+    first, last = as_datetime(first), as_datetime(last)
+    return bounds is None or first is None or last is None or (first <= bounds[1] and last >= bounds[0])
+
+def files_in_time(files, file_date, time_range):
+    """The files whose date (parsed from the name by file_date) is within time_range"""
+    bounds = time_bounds(time_range)
+    selected = [file for file in files if overlaps(file_date(file), bounds)]
+    if files and not selected:
+        raise ValueError("No files from %s to %s" % tuple(time_range))
+    return selected
+
+def netcdf_files(files, time_range, index=None, dim="time"):
+    """The netCDF files with a time step within time_range, the time coordinates come from the file index if given"""
+    bounds = time_bounds(time_range)
+    if bounds is None:
+        return files
+    import xarray as xr
+    selected = []
+    for file in files:
+        with (index.open_dataset(file) if index is not None else xr.open_dataset(file)) as nc:
+            if dim not in nc.variables or overlaps(nc[dim].values, bounds):
+                selected.append(file)
+    if files and not selected:
+        raise ValueError("No files from %s to %s" % tuple(time_range))
+    return selected
+
+def grid_bounds(bbox, bbox_crs=DEFAULT_CRS, crs=None):
+    """West, south, east and north of bbox (given in bbox_crs) in the CRS of the grid, bbox itself without a CRS"""
+    if crs is None:
+        return tuple(bbox)
+    from rasterio.crs import CRS
+    from rasterio.warp import transform_bounds
+    bbox_crs, crs = CRS.from_user_input(bbox_crs), CRS.from_user_input(crs)
+    if bbox_crs == crs:
+        return tuple(bbox)
+    # the edges are densified, a box in one CRS is curved in another
+    return transform_bounds(bbox_crs, crs, *bbox, densify_pts=21)
+
+def is_geographic(crs):
+    """True for a CRS in longitude and latitude"""
+    if crs is None:
+        return False
+    from rasterio.crs import CRS
+    return CRS.from_user_input(crs).is_geographic
+
+def longitude_parts(west, east, start, stop, tolerance=0.0):
+    """Parts (west, east) of a longitude box on a geographic grid from start to stop, at most two
+
+    The box is moved by whole turns so that it starts on the grid, a part
+    beyond the eastern edge of the grid continues at its western edge. A box
+    around the globe is the whole grid. Parts not wider than tolerance are
+    left out.
+    """
+    if east < west:
+        east += TURN
+    if east - west >= TURN - tolerance:
+        return [(start, stop)]
+    shift = math.floor((west - start) / TURN) * TURN
+    west, east = west - shift, east - shift
+    parts = [(west, min(east, stop)), (start, min(east - TURN, stop))]
+    return [(low, high) for low, high in parts if high - low > tolerance]
+
+def longitude_bounds(bounds, start, stop, tolerance=0.0):
+    """bounds with the longitudes moved onto a geographic grid from start to stop, for a window of the grid"""
+    west, south, east, north = bounds
+    parts = longitude_parts(west, east, start, stop, tolerance)
+    if not parts:
+        raise ValueError("The bounding box %s does not intersect the grid" % (tuple(bounds),))
+    if len(parts) > 1:
+        raise ValueError("The bounding box %s crosses the edge of the grid at longitude %g, a window of the files "
+                         "cannot wrap around, convert the parts on both sides separately" % (tuple(bounds), stop))
+    (west, east), = parts
+    return west, south, east, north
+
+def window(transform, width, height, bounds, geographic=False):
+    """Window of the pixels of a grid that intersect bounds (west, south, east, north in the CRS of the grid)
+
+    The longitudes of geographic grids are moved onto the grid, see longitude_bounds.
+    """
+    if geographic:
+        edges = sorted((transform.c, transform.c + width * transform.a))
+        bounds = longitude_bounds(bounds, *edges, tolerance=EDGE * abs(transform.a))
+    west, south, east, north = bounds
+    corners = [~transform * (x, y) for x in (west, east) for y in (south, north)]
+    cols = [col for col, _ in corners]
+    rows = [row for _, row in corners]
+    col_start = max(0, math.floor(min(cols) + EDGE))
+    col_stop = min(width, math.ceil(max(cols) - EDGE))
+    row_start = max(0, math.floor(min(rows) + EDGE))
+    row_stop = min(height, math.ceil(max(rows) - EDGE))
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError("The bounding box %s does not intersect the grid" % (tuple(bounds),))
+    from rasterio.windows import Window
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def tiff_window(header, bbox, bbox_crs=DEFAULT_CRS):
+    """Window of bbox in the grid of a tiffscan.Header (or a warped one), None without bbox"""
+    if not bbox:
+        return None
+    return window(header.transform, header.width, header.height, grid_bounds(bbox, bbox_crs, header.crs),
+                  geographic=is_geographic(header.crs))
+
+def half_cell(values):
+    """Half the spacing of a regular 1d coordinate"""
+    return abs(values[1] - values[0]) / 2 if len(values) > 1 else 0
+
+def intersecting_cells(values, low, high):
+    """Indices of the cells of a regular 1d coordinate (cell centers) that intersect low to high"""
+    values = np.asarray(values, dtype="float64")
+    half = half_cell(values)
+    return np.nonzero((values + half > low + EDGE * 2 * half) & (values - half < high - EDGE * 2 * half))[0]
+
+def coordinate_slice(values, low, high):
+    """Slice of the cells of a regular 1d coordinate (cell centers) that intersect low to high"""
+    values = np.asarray(values, dtype="float64")
+    inside = intersecting_cells(values, low, high)
+    if not len(inside):
+        raise ValueError("The bounding box (%s to %s) does not intersect the coordinate from %s to %s"
+                         % (low, high, values.min(), values.max()))
+    return slice(int(inside[0]), int(inside[-1]) + 1)
+
+def longitude_columns(values, west, east):
+    """Columns of a longitude coordinate (cell centers) that intersect west to east and their longitudes
+
+    The columns are a slice, or an index array if the box continues across the
+    edge of a global grid, the longitudes of the columns after the edge are a
+    turn larger. See longitude_parts.
+    """
+    values = np.asarray(values, dtype="float64")
+    half = half_cell(values)
+    start, stop = values.min() - half, values.max() + half
+    parts = [intersecting_cells(values, low, high)
+             for low, high in longitude_parts(west, east, start, stop, EDGE * 2 * half)]
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        raise ValueError("The bounding box (%s to %s) does not intersect the longitudes from %s to %s"
+                         % (west, east, values.min(), values.max()))
+    if len(parts) == 1:
+        columns = slice(int(parts[0][0]), int(parts[0][-1]) + 1)
+        return columns, values[columns]
+    if stop - start < TURN - EDGE * 2 * half:
+        raise ValueError("The bounding box (%s to %s) crosses the edge of the grid at longitude %g, but the grid "
+                         "from %g to %g does not go around the globe" % (west, east, stop, start, stop))
+    return np.concatenate(parts), np.concatenate([values[parts[0]], values[parts[1]] + TURN])
+
+def spatial_dims(dims, y=None, x=None):
+    """Names of the y and x dimensions among dims"""
+    y = y or next((name for name in Y_NAMES if name in dims), None)
+    x = x or next((name for name in X_NAMES if name in dims), None)
+    if y is None or x is None:
+        raise ValueError("No spatial dimensions among %s, the bounding box needs %s and %s"
+                         % (tuple(dims), "/".join(Y_NAMES), "/".join(X_NAMES)))
+    return y, x
+
+def grid_mapping_crs(variables):
+    """CRS of the first grid mapping among variables {name: attrs}, None without one"""
+    from rasterio.crs import CRS
+    for attrs in variables.values():
+        wkt = attrs.get("crs_wkt") or attrs.get("spatial_ref")
+        if isinstance(wkt, str):
+            return CRS.from_wkt(wkt)
+    return None
+
+def coordinate_crs(variables, x):
+    """CRS of a grid: its grid mapping, longitude and latitude for lon/longitude, else None (bbox in grid coordinates)"""
+    crs = grid_mapping_crs(variables)
+    if crs is None and x in ("lon", "longitude"):
+        from rasterio.crs import CRS
+        crs = CRS.from_user_input(DEFAULT_CRS)
+    return crs
+
+def shift_geotransform(attrs, row_off, col_off):
+    """Attributes of a grid mapping with the GeoTransform moved to the corner of a window"""
+    if "GeoTransform" not in attrs:
+        return attrs
+    from rasterio.transform import Affine
+    transform = Affine.from_gdal(*[float(value) for value in str(attrs["GeoTransform"]).split()])
+    transform = transform * Affine.translation(col_off, row_off)
+    return dict(attrs, GeoTransform=" ".join(str(value) for value in transform.to_gdal()))
+
+def select(ds, bbox=None, bbox_crs=DEFAULT_CRS, time_range=None, variables=None, y=None, x=None, crs=None,
+           dim="time"):
+    """Lazy subset of an opened netCDF dataset, before it is chunked for the store
+
+    The selection only slices the lazily opened variables, nothing is read.
+    crs is the CRS of the grid, by default from a grid mapping variable or
+    longitude and latitude for lon/longitude dimensions.
+    """
+    if variables:
+        missing = [name for name in variables if name not in ds.data_vars]
+        if missing:
+            raise ValueError("No variables %s, the dataset has %s" % (missing, list(ds.data_vars)))
+        # grid mappings stay with the data even if they are data variables
+        keep = [name for name in ds.data_vars if name in variables or "crs_wkt" in ds[name].attrs
+                or "spatial_ref" in ds[name].attrs]
+        ds = ds[keep]
+    if time_range and dim in ds.dims:
+        # partial dates select whole years or months, also for cftime calendars
+        ds = ds.sel({dim: slice(*time_range)})
+        if not ds.sizes[dim]:
+            raise ValueError("No time steps from %s to %s" % tuple(time_range))
+    if bbox:
+        y, x = spatial_dims(ds.dims, y, x)
+        crs = crs or coordinate_crs({name: ds[name].attrs for name in ds.variables}, x)
+        west, south, east, north = grid_bounds(bbox, bbox_crs, crs)
+        rows = coordinate_slice(ds[y].values, south, north)
+        if is_geographic(crs):
+            cols, longitudes = longitude_columns(ds[x].values, west, east)
+        else:
+            cols, longitudes = coordinate_slice(ds[x].values, west, east), None
+        # the copy keeps the grid mapping of the opened dataset, isel shares the variables without y and x
+        ds = ds.isel({y: rows, x: cols}).copy()
+        if not isinstance(cols, slice):
+            # across the edge of the grid the longitudes go on past it, the GeoTransform stays valid
+            ds = ds.assign_coords({x: ds[x].copy(data=longitudes)})
+        first = cols.start if isinstance(cols, slice) else int(cols[0])
+        for name in ds.variables:
+            if "GeoTransform" in ds[name].attrs:
+                ds[name].attrs = shift_geotransform(ds[name].attrs, rows.start, first)
+    return ds
+
+def bands(bands, variables):
+    """The bands {number: name} of the selected variables, all without a selection"""
+    if not variables:
+        return bands
+    missing = [name for name in variables if name not in bands.values()]
+    if missing:
+        raise ValueError("No variables %s, the files have %s" % (missing, list(bands.values())))
+    return {band: name for band, name in bands.items() if name in variables}
+
+def variables(ds, selected):
+    """ds with the selected data variables only, the other bands are never read"""
+    return ds[[name for name in ds.data_vars if name in selected]] if selected else ds
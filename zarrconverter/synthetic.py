@@ -0,0 +1,106 @@
+# Synthetic input data in the layout of the real datasets, used by benchmark.py.
+#
+# The fields are smooth in space with a seasonal cycle and a little noise, so they
+# compress about as well as real vegetation data, and the oceans are filled with
+# the fill values of the products. File names and directories are the ones the
+# converter scripts expect, the sizes are free.
+
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rasterio
+from rasterio.transform import from_origin
+
+def grid(width, height):
+    """Pixel centers of a global regular grid"""
+    lon = -180 + (np.arange(width) + 0.5) * 360 / width
+    lat = 90 - (np.arange(height) + 0.5) * 180 / height
+    return lon, lat
+
+def land_mask(width, height):
+    """Fixed pattern of continents, about a third of the grid is land"""
+    lon, lat = np.meshgrid(*[np.radians(values) for values in grid(width, height)])
+    pattern = np.sin(2 * lon) * np.cos(3 * lat) + 0.5 * np.sin(5 * lon + 1) * np.sin(4 * lat)
+    return (pattern > 0.3) & (np.abs(lat) < np.radians(80))
+
+def field(width, height, day, rng):
+    """Vegetation like values between 0 and 1 for the day of the year"""
+    lon, lat = np.meshgrid(*[np.radians(values) for values in grid(width, height)])
+    season = np.cos(2 * np.pi * (day - 200) / 365) * np.sign(lat)
+    base = 0.5 + 0.3 * np.cos(lat) * np.sin(3 * lon) + 0.2 * season * np.abs(np.sin(lat))
+    noise = rng.normal(0, 0.02, base.shape)
+    return np.clip(base + noise, 0, 1).astype("float32")
+
+def write_tiff(path, bands, nodata=None):
+    """Write the bands (2d arrays of one dtype) as a LZW compressed GeoTIFF in EPSG:4326"""
+    height, width = bands[0].shape
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": len(bands),
+        "dtype": bands[0].dtype.name, "crs": "EPSG:4326", "nodata": nodata, "compress": "lzw",
+        "transform": from_origin(-180, 90, 360 / width, 180 / height),
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        for index, band in enumerate(bands):
+            dst.write(band, index + 1)
+
+def gosif_tiffs(directory, width, height, steps, start_year=2000, prefix="GOSIF"):
+    """8-day uint16 GeoTIFFs named like GOSIF_2000001.tif with the fill values 65535 (ocean) and 65534"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    land = land_mask(width, height)
+    files = []
+    for step in range(steps):
+        year, doy = start_year + step // 46, 1 + 8 * (step % 46)
+        data = (field(width, height, doy, rng) * 20000).astype("uint16")
+        data[~land] = 65535
+        data[land & (rng.random(land.shape) < 0.001)] = 65534
+        path = os.path.join(directory, "%s_%d%03d.tif" % (prefix, year, doy))
+        write_tiff(path, [data])
+        files.append(path)
+    return files
+
+def gimms_tiffs(directory, width, height, steps, start_year=1982,
+                prefix="PKU_GIMMS_NDVI_AVHRR_MODIS_consolidated"):
+    """Half-monthly uint16 GeoTIFFs with an NDVI and a QC band named like ..._19820101.tif, 65535 is the fill value"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    land = land_mask(width, height)
+    files = []
+    for step in range(steps):
+        year, month, half = start_year + step // 24, 1 + (step % 24) // 2, 1 + step % 2
+        ndvi = (field(width, height, 30 * month + 15 * half, rng) * 1000).astype("uint16")
+        qc = rng.choice(np.array([100, 110, 120, 211, 300], dtype="uint16"), size=land.shape)
+        ndvi[~land] = 65535
+        qc[~land] = 65535
+        path = os.path.join(directory, "%s_%d%02d%02d.tif" % (prefix, year, month, half))
+        write_tiff(path, [ndvi, qc])
+        files.append(path)
+    return files
+
+def netcdf_stack(directory, width, height, days, days_per_file=30, start="2000-01-01",
+                 x="lon", y="lat", prefix="GPP"):
+    """Daily float32 netCDF files with GPP and land_fraction (time, y, x) like FLUXCOM-X"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    lon, lat = grid(width, height)
+    land = land_mask(width, height)
+    times = pd.date_range(start, periods=days, freq="D")
+    files = []
+    for first in range(0, days, days_per_file):
+        block = times[first:first + days_per_file]
+        gpp = np.stack([field(width, height, time.dayofyear, rng) * 10 for time in block])
+        gpp[:, ~land] = np.nan
+        land_fraction = np.broadcast_to(land.astype("float32"), gpp.shape)
+        ds = xr.Dataset(
+            {"GPP": (("time", y, x), gpp, {"long_name": "gross primary production", "units": "gC m-2 d-1"}),
+             "land_fraction": (("time", y, x), land_fraction, {"long_name": "land fraction"})},
+            coords={"time": block, y: lat, x: lon},
+            attrs={"title": "synthetic data for benchmarks", "history": "created " + datetime.date.today().isoformat()},
+        )
+        path = os.path.join(directory, "%s_%s.nc" % (prefix, block[0].strftime("%Y%m%d")))
+        # like the FLUXCOM-X files without _FillValue, the converters set it themselves
+        ds.to_netcdf(path, encoding={vname: {"_FillValue": None} for vname in ds.data_vars})
+        files.append(path)
+    return files
@@ -0,0 +1,133 @@
+# Fast pre-scan of a set of GeoTIFF files.
+#
+# Instead of opening every file with rioxarray, only the TIFF headers are read
+# (in parallel) and the time stamps are parsed from the file names. All files have
+# to be on the same grid. From the headers (see scan) one lazy dask array (time, band, y, x)
+# is built, each block reads a single band of a single file when it is computed.
+
+import os
+import collections
+import concurrent.futures
+import numpy as np
+import xarray as xr
+import dask.array as da
+import rasterio
+import pyproj
+from dask.base import tokenize
+from rasterio.windows import Window
+
+Header = collections.namedtuple("Header", ["file", "time", "transform", "width", "height",
+                                           "count", "dtype", "nodata", "crs", "block"])
+
+# avoids a listing of the whole directory by GDAL for every opened file
+GDAL_ENV = {"GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+
+def read_header(file, file_date):
+    """Read the header of a single GeoTIFF file without touching the pixel data"""
+    with rasterio.Env(**GDAL_ENV), rasterio.open(file) as src:
+        return Header(file, file_date(file), src.transform, src.width, src.height,
+                      src.count, src.dtypes[0], src.nodata, src.crs, src.block_shapes[0])
+
+def scan(files, file_date, workers=32):
+    """Read the headers of all files in parallel, sorted by time"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # the files are read by absolute path, workers of a shared or remote cluster have another working directory
+        headers = list(pool.map(lambda file: read_header(os.path.abspath(file), file_date), files))
+    return sorted(headers, key=lambda header: header.time)
+
+def check_grid(headers, tolerance=1e-3):
+    """Check that all files share the grid of the first one, up to tolerance times the pixel size"""
+    ref = headers[0]
+    atol = tolerance * min(abs(ref.transform.a), abs(ref.transform.e))
+    for header in headers[1:]:
+        if (header.width, header.height, header.count, header.dtype) != (ref.width, ref.height, ref.count, ref.dtype):
+            raise ValueError("%s has shape, band count or dtype different from %s" % (header.file, ref.file))
+        if not np.allclose(tuple(header.transform)[:6], tuple(ref.transform)[:6], rtol=0, atol=atol):
+            raise ValueError("%s is on a different grid than %s" % (header.file, ref.file))
+    times = [header.time for header in headers]
+    if len(set(times)) != len(times):
+        raise ValueError("Several files have the same time stamp")
+    return ref
+
+def masked_dtype(dtype):
+    """Float type that holds NaN and all values of dtype, the same promotion as DataArray.where"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return dtype
+    return np.dtype("float32") if dtype.itemsize <= 2 else np.dtype("float64")
+
+def read_block(file, band, rows, cols, fill_values, dtype):
+    """Read one band of a window of a file, replacing the fill values by NaN"""
+    window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+    with rasterio.Env(**GDAL_ENV), rasterio.open(file) as src:
+        data = src.read(band, window=window)
+    if fill_values:
+        mask = np.isin(data, fill_values)
+        data = data.astype(dtype)
+        data[mask] = np.nan
+    return data[np.newaxis, np.newaxis]
+
+def slices(size, chunk):
+    """Split size into slices of length chunk"""
+    return [slice(start, min(start + chunk, size)) for start in range(0, size, chunk)]
+
+def grid_coords(transform, width, height):
+    """Pixel center coordinates of a north up grid"""
+    x = transform.c + (np.arange(width) + 0.5) * transform.a
+    y = transform.f + (np.arange(height) + 0.5) * transform.e
+    return x, y
+
+def spatial_ref(crs, transform):
+    """Grid mapping coordinate in the same form rioxarray writes it"""
+    attrs = {"GeoTransform": " ".join(str(value) for value in transform.to_gdal())}
+    if crs is not None:
+        attrs.update(pyproj.CRS.from_wkt(crs.to_wkt()).to_cf())
+        attrs["crs_wkt"] = attrs["spatial_ref"] = crs.to_wkt()
+    return xr.DataArray(0, attrs=attrs)
+
+def open_cube(headers, fill_values=None, chunks=None, y="y", x="x", reader=read_block, window=None):
+    """Lazy DataArray (time, band, y, x) of all scanned files, like xr.concat of the single files along time
+
+    fill_values are replaced by NaN (the data then becomes float like with
+    DataArray.where) and chunks can split the grid into windows {y: ..., x: ...},
+    by default there is one block per band and file. y and x are the names of
+    the spatial dimensions. reader reads a block, with the arguments of read_block.
+    window (a rasterio Window, see subset.tiff_window) limits the cube to a part
+    of the grid, only the blocks of the window are read.
+    """
+    ref = check_grid(headers)
+    dtype = masked_dtype(ref.dtype) if fill_values else np.dtype(ref.dtype)
+    chunks = chunks or {}
+    window = window or Window(0, 0, ref.width, ref.height)
+    rows = [slice(row.start + window.row_off, row.stop + window.row_off)
+            for row in slices(window.height, chunks.get(y, window.height))]
+    cols = [slice(col.start + window.col_off, col.stop + window.col_off)
+            for col in slices(window.width, chunks.get(x, window.width))]
+
+    name = "read-tiff-" + tokenize([header.file for header in headers], fill_values, rows, cols, reader)
+    dsk = {}
+    for t, header in enumerate(headers):
+        for b in range(ref.count):
+            for i, row in enumerate(rows):
+                for j, col in enumerate(cols):
+                    dsk[(name, t, b, i, j)] = (reader, header.file, b + 1, row, col, fill_values, dtype)
+    data = da.Array(dsk, name,
+                    chunks=((1,) * len(headers), (1,) * ref.count,
+                            tuple(row.stop - row.start for row in rows),
+                            tuple(col.stop - col.start for col in cols)),
+                    dtype=dtype)
+
+    transform = rasterio.windows.transform(window, ref.transform)
+    x_coords, y_coords = grid_coords(transform, window.width, window.height)
+    coords = {
+        "time": np.array([header.time for header in headers], dtype="datetime64[ns]"),
+        "band": np.arange(1, ref.count + 1),
+        y: y_coords,
+        x: x_coords,
+        "spatial_ref": spatial_ref(ref.crs, transform),
+    }
+    attrs = {} if fill_values or ref.nodata is None else {"_FillValue": ref.nodata}
+    cube = xr.DataArray(data, dims=("time", "band", y, x), coords=coords, attrs=attrs)
+    # the internal tiling of the files, used to plan the chunks of the zarr store
+    cube.encoding["preferred_chunks"] = {y: ref.block[0], x: ref.block[1]}
+    return cube
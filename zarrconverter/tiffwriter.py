@@ -0,0 +1,203 @@
+# Direct writer for TIFF cubes without dask.
+#
+# All TIFF converters write chunks with one time step, so every input file maps
+# onto its own set of output chunks. The zarr metadata is created up front and a
+# pool of processes reads one file after the other and writes its time slice
+# straight into the store. There is no scheduler and no task graph, memory is
+# about one raster per worker. Finished files are recorded in the same manifest
+# as checkpoint.to_zarr, so a direct run can be resumed as well. The levels of a
+# multiscale pyramid are reduced from the raster while it is in memory. Files can
+# be reprojected while they are read, see warp.py, and limited to a window of
+# the grid, see subset.py. Empty chunks are skipped and
+# the statistics of every chunk are recorded like in checkpoint.py. With temporal
+# aggregates (see aggregate.py) a process writes all files of a month or year
+# one after the other and adds them to the accumulators of their periods, every
+# period is written as soon as its last file is added.
+
+import os
+import logging
+import contextlib
+import concurrent.futures
+import numpy as np
+import numcodecs
+import rasterio
+import zarr
+from rasterio.vrt import WarpedVRT
+from zarrconverter import aggregate, checkpoint, chunkstats, objectstore, pyramid, runreport, sharding, tiffscan
+
+def init_worker():
+    # the processes already use all cores, blosc must not start threads on top of that
+    numcodecs.blosc.use_threads = False
+
+def write_file(store, file, index, bands, fill_values, levels=0, reductions=None, warp=None, records=None,
+               decodings=None, window=None):
+    """Read all bands of one file and write them into time step index of their variables and pyramid levels
+
+    warp are the arguments of WarpedVRT to reproject the file while it is read,
+    window is the part of the (warped) grid that is read.
+    The statistics of the written chunks are appended to the file records,
+    decodings are the fill values and scaling of the variables (see chunkstats.decoding).
+    Returns the full resolution rasters {variable: data} as they were stored.
+    """
+    # the time slices of the variables and of their pyramid levels
+    arrays = {name: chunkstats.open_array(store, name)
+              for vname in bands.values() for name in [vname] + ["%d/%s" % (level, vname) for level in range(1, levels + 1)]}
+    written = []
+    rasters = {}
+
+    def write(name, data):
+        array = arrays[name]
+        array[index] = data
+        region = (slice(index, index + 1),) + tuple(slice(None) for _ in data.shape)
+        written.extend(chunkstats.chunk_records(name, array, region, data[np.newaxis], decodings[name.split("/")[-1]]))
+
+    with rasterio.Env(**tiffscan.GDAL_ENV), rasterio.open(file) as tiff, \
+            (WarpedVRT(tiff, **warp) if warp else contextlib.nullcontext(tiff)) as src:
+        for band, vname in bands.items():
+            data = src.read(band, window=window)
+            if fill_values:
+                mask = np.isin(data, fill_values)
+                data = data.astype(arrays[vname].dtype)
+                data[mask] = np.nan
+            write(vname, data)
+            rasters[vname] = data
+            for level in range(1, levels + 1):
+                data = pyramid.reduce_raster(data, reductions[vname])
+                write("%d/%s" % (level, vname), data)
+    chunkstats.append(records, written)
+    return rasters
+
+def write_files(store, items, bands, fill_values, levels=0, reductions=None, warp=None, records=None,
+                decodings=None, window=None, products=None):
+    """Write the files [(index, file)] one after the other with write_file and return the keys of the manifest
+
+    products are the temporal aggregates of the files (see to_zarr), the
+    periods are written into their groups once their last file is added.
+    """
+    keys = []
+    accumulators = {}
+    for index, file in items:
+        rasters = write_file(store, file, index, bands, fill_values, levels, reductions, warp, records, decodings, window)
+        keys.append("%d:%d" % (index, index + 1))
+        if not products:
+            continue
+        values = {vname: aggregate.decode(rasters[vname][np.newaxis], **decodings[vname]) for vname in products["variables"]}
+        for vname, flag in products["quality"].items():
+            if vname in values:
+                values[vname] = np.where(flag.mask(rasters[flag.variable][np.newaxis]), values[vname], np.nan)
+        for period, periods in products["periods"].items():
+            for number, start, stop in periods:
+                if not start <= index < stop:
+                    continue
+                period_accumulators = accumulators.setdefault((period, number), {vname: aggregate.Accumulator() for vname in values})
+                for vname, accumulator in period_accumulators.items():
+                    accumulator.add(values[vname])
+                if index + 1 < stop:
+                    continue
+                written = []
+                for group, reduction in products["groups"][period]:
+                    for vname, accumulator in period_accumulators.items():
+                        name = group + "/" + vname
+                        array = chunkstats.open_array(store, name)
+                        data = accumulator.result(reduction, array.dtype)
+                        array[number] = data
+                        region = (slice(number, number + 1),) + tuple(slice(None) for _ in data.shape)
+                        written.extend(chunkstats.chunk_records(name, array, region, data[np.newaxis], decodings[name]))
+                    keys.append("%s:%d:%d" % (group, number, number + 1))
+                del accumulators[(period, number)]
+                chunkstats.append(records, written)
+    return keys
+
+def to_zarr(ds, zarr_dir, headers, bands, encoding=None, fill_values=None, resume=False, workers=None, report=None,
+            shards=None, overviews=None, storage=None, warp=None, window=None, aggregates=None):
+    """Write ds, built by tiffscan.open_cube from headers, directly with a process pool
+
+    bands maps the band numbers in the files to the data variables of ds,
+    like the mapping given to rename_vars after DataArray.to_dataset(dim="band").
+    The stages and the written bytes and chunks are recorded in report. With
+    shards {dim: size} a sharded zarr v3 store is written, every file fills its
+    own shards, so the shards have to hold a single time step as well.
+    overviews are the arguments of pyramid.build for a multiscale pyramid.
+    zarr_dir may be an fsspec URL, storage are the arguments of
+    objectstore.open_store then, the store is passed on to every process.
+    warp are the arguments of WarpedVRT when ds was built by warp.open_cube,
+    window the window given to open_cube. aggregates are the arguments of
+    aggregate.build (specs, quality, categorical) for temporal aggregates, the
+    files of one month (or one year for annual aggregates) are written by the
+    same process then.
+    """
+    if shards:
+        if shards.get("time", 1) != 1:
+            raise ValueError("The direct writer needs shards of one time step")
+        ds, encoding = sharding.apply(ds, encoding, shards)
+    for vname in bands.values():
+        if ds[vname].chunksizes.get("time", (1,))[0] != 1 or ds[vname].dims[0] != "time":
+            raise ValueError("The direct writer needs time as first dimension with chunks of one time step")
+    products = aggregate.build(ds, encoding, **aggregates) if aggregates else []
+    levels, reductions = [], None
+    if overviews:
+        ds, levels = pyramid.build(ds, encoding, **overviews)
+        reductions = pyramid.reductions(ds, overviews.get("categorical", ()))
+    storage = storage or {}
+    store = objectstore.open_store(zarr_dir, **storage)
+    stored = runreport.du(zarr_dir, storage.get("storage_options")) if resume else 0
+    with runreport.stage(report, "create store"):
+        path, plan, done = checkpoint.prepare(ds, zarr_dir, encoding, resume, zarr_format=3 if shards else None,
+                                              levels=levels, store=store, products=products)
+    records = chunkstats.begin(zarr_dir, resume=bool(done))
+    decodings = {vname: chunkstats.decoding(var) for vname, var in checkpoint.encoded_variables(ds, encoding).items() if vname in bands.values()}
+    # every task writes a run of files, one file without aggregates, otherwise the files of whole periods
+    streams = [(index, index + 1, None) for index in range(len(headers))]
+    tasks = {}
+    if products:
+        specs = [aggregate.parse(spec) for spec in aggregates["specs"]]
+        tasks = {"variables": list(products[0][1].data_vars), "quality": aggregates.get("quality") or {},
+                 "groups": {period: [(aggregate.group_name(period, reduction), reduction) for p, reduction in specs if p == period]
+                            for period in dict.fromkeys(period for period, _ in specs)}}
+        for group, product_ds, product_encoding in products:
+            decodings.update({group + "/" + vname: chunkstats.decoding(var)
+                              for vname, var in checkpoint.encoded_variables(product_ds, product_encoding).items()})
+        streams = aggregate.streams(ds["time"].values, aggregates["specs"])
+    todo = []
+    for start, stop, periods in streams:
+        keys = ["%d:%d" % (index, index + 1) for index in range(start, stop)]
+        if periods:
+            keys += ["%s:%d:%d" % (group, number, number + 1) for period, runs in periods.items()
+                     for group, _ in tasks["groups"][period] for number, _, _ in runs]
+        # a run is written again as a whole if anything of it is missing, its periods need all of its files
+        if not done.issuperset(keys):
+            todo.append((start, stop, periods))
+    files = sum(stop - start for start, stop, _ in todo)
+    logging.info("Writing %d files with %s processes", files, workers or os.cpu_count())
+
+    with runreport.stage(report, "compute and write"), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = {pool.submit(write_files, store, [(index, headers[index].file) for index in range(start, stop)],
+                               bands, fill_values, len(levels), reductions, warp, records, decodings, window,
+                               dict(tasks, periods=periods) if periods else None): stop - start
+                   for start, stop, periods in todo}
+        count = 0
+        for future in concurrent.futures.as_completed(futures):
+            for key in future.result():
+                checkpoint.record(None, path, key)
+            count += futures[future]
+            runreport.show_progress(report, "%d of %d files written" % (count, files))
+    runreport.end_progress(report)
+
+    with runreport.stage(report, "consolidate metadata"):
+        empty = chunkstats.write(store, zarr_dir)
+        checkpoint.finish(zarr_dir, store)
+    logging.info("%d chunks only hold fill values and are not stored", empty)
+    if report is not None:
+        group = zarr.open_group(store, mode="r")
+        report.count("blocks_written", files)
+        arrays = [group[vname] for vname in bands.values()]
+        arrays += [group["%d/%s" % (level, vname)] for level in range(1, len(levels) + 1) for vname in bands.values()]
+        chunks = files * sum(array.nchunks // array.cdata_shape[0] for array in arrays)
+        for _, _, periods in todo:
+            for period, runs in (periods or {}).items():
+                chunks += len(runs) * sum(group[name + "/" + vname].nchunks // group[name + "/" + vname].cdata_shape[0]
+                                          for name, _ in tasks["groups"][period] for vname in tasks["variables"])
+        report.count("chunks_written", chunks)
+        report.count("chunks_empty", empty)
+        report.count("bytes_written", runreport.du(zarr_dir, storage.get("storage_options")) - stored)
@@ -0,0 +1,189 @@
+# Verification of a zarr store against its source.
+#
+# The chunk grid of every variable in the store is walked with a pool of threads.
+# For every chunk the stored values and the matching window of the source dataset
+# (the lazily opened TIFF or netCDF files) are read and compared after both were
+# decoded like xarray reads them, so a fill value in the source and NaN in the
+# store (or packed integers with their CF attributes) count as the same missing
+# value. The raw values of TIFF files are masked here with the fill values of the
+# product, not by the reader of the writer, so a wrong mask of the writer shows
+# up as a mismatch. Variables rounded by --precision are compared within the relative error
+# recorded in their max_relative_error attribute. A hash and statistics of every
+# chunk are written as JSON lines to a manifest next to the store. Only a few
+# chunks are in memory at any time.
+
+import os
+import json
+import hashlib
+import logging
+import itertools
+import concurrent.futures
+import numpy as np
+import xarray as xr
+import zarr
+from zarrconverter import objectstore, runreport
+
+def manifest_path(zarr_dir):
+    """Path of the verification manifest next to the zarr store"""
+    return objectstore.local_path(zarr_dir, ".verify.jsonl")
+
+def chunk_regions(shape, chunks):
+    """Regions (tuples of slices) of all chunks of an array"""
+    ranges = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + chunk, size)) for start, chunk, size in zip(starts, chunks, shape))
+
+def checksum(values):
+    """SHA-256 of the decoded values of a chunk"""
+    return hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+def statistics(values):
+    """Number of valid cells and their minimum, maximum and mean"""
+    valid = values[~np.isnan(values)] if values.dtype.kind == "f" else values.ravel()
+    if not valid.size:
+        return {"valid": 0, "min": None, "max": None, "mean": None}
+    return {"valid": int(valid.size), "min": float(valid.min()), "max": float(valid.max()),
+            "mean": float(valid.mean(dtype="float64"))}
+
+def compare(stored, source, rtol=0.0, atol=0.0):
+    """Number of cells that differ, cells missing on one side only and the largest absolute difference"""
+    if stored.dtype.kind != "f" and source.dtype.kind != "f" and not rtol and not atol:
+        return {"mismatches": int(np.count_nonzero(stored != source)), "missing_mismatches": 0, "max_abs_diff": None}
+    stored = stored.astype("float64")
+    source = source.astype("float64")
+    missing = np.isnan(stored) != np.isnan(source)
+    equal = np.isclose(stored, source, rtol=rtol, atol=atol, equal_nan=True) if rtol or atol else \
+        (stored == source) | (np.isnan(stored) & np.isnan(source))
+    both = ~np.isnan(stored) & ~np.isnan(source)
+    return {"mismatches": int(np.count_nonzero(~equal)), "missing_mismatches": int(np.count_nonzero(missing)),
+            "max_abs_diff": float(np.abs(stored[both] - source[both]).max()) if both.any() else None}
+
+def decode(values, fill_values, dtype, scale_factor=None, add_offset=None):
+    """Raw source values as a store of dtype holds them decoded: fill values missing, scaled like xarray scales"""
+    if dtype.kind != "f":
+        return values
+    missing = np.isin(values, fill_values)
+    values = values.astype(dtype)
+    values[missing] = np.nan
+    if scale_factor is not None:
+        values *= scale_factor
+    if add_offset is not None:
+        values += add_offset
+    return values
+
+def check_chunk(stored, source, vname, region, source_region, rtol, atol, fill_values=None):
+    """Read one chunk of the store and its window of the source and compare them"""
+    stored_values = stored[vname].variable[region].values
+    source_values = source[vname].variable[source_region].data
+    # the source window is computed right here, not by the cluster, so memory stays at a few chunks per thread
+    source_values = np.asarray(source_values.compute(scheduler="synchronous")
+                               if hasattr(source_values, "compute") else source_values)
+    if fill_values is not None:
+        encoding = stored[vname].encoding
+        source_values = decode(source_values, fill_values, stored_values.dtype,
+                               encoding.get("scale_factor"), encoding.get("add_offset"))
+    result = {
+        "variable": vname,
+        "region": [[r.start, r.stop] for r in region],
+        "sha256": checksum(stored_values),
+        **statistics(stored_values),
+        **compare(stored_values, source_values, rtol, atol),
+    }
+    result["ok"] = result["mismatches"] == 0
+    return result
+
+def check_coords(stored, source, dim, offset):
+    """Names of the dimension coordinates that differ between the store and the source"""
+    differing = []
+    for name in source.dims:
+        if name not in source.coords or name not in stored.coords:
+            continue
+        values = stored[name].values
+        if name == dim:
+            values = values[offset:offset + source.sizes[name]]
+        if values.shape != source[name].shape or not np.array_equal(values, source[name].values):
+            differing.append(name)
+    return differing
+
+def verify(ds, zarr_dir, rtol=0.0, atol=0.0, workers=None, dim="time", offset=0, report=None, storage_options=None,
+           fill_values=None):
+    """Compare every chunk of zarr_dir with ds, the source dataset as it was read from the files
+
+    ds may also cover only the time steps offset to offset + ds.sizes[dim] of
+    the store, e.g. after an append. Values are equal if they agree within rtol
+    and atol (exact by default) or are missing on both sides, a variable with
+    a max_relative_error attribute in the store (see precision.py) within
+    at least that relative error. The hash and the
+    statistics of every chunk are written to the manifest next to the store.
+    zarr_dir may be an fsspec URL with storage_options. With fill_values ds
+    holds the raw values of the files, the fill values are masked and packed
+    integers scaled with the scale_factor and add_offset of the store here.
+    Without them ds is decoded with its CF attributes like xarray does.
+    Returns a summary, "ok" is False if any chunk or coordinate differs.
+    """
+    store = objectstore.mapper(zarr_dir, storage_options)
+    stored = xr.open_zarr(store, chunks=None)
+    source = xr.decode_cf(ds) if fill_values is None else ds
+    group = zarr.open_group(store, mode="r")
+    workers = workers or os.cpu_count()
+    path = manifest_path(zarr_dir)
+    # the values of rounded variables only agree within the error of their precision
+    rtols = {vname: max(rtol, stored[vname].attrs.get("max_relative_error", 0.0)) for vname in source.data_vars}
+    summary = {"store": zarr_dir, "rtol": rtol, "atol": atol, "chunks": 0, "failed_chunks": 0, "mismatches": 0,
+               "coords": check_coords(stored, source, dim, offset)}
+
+    def tasks():
+        for vname in source.data_vars:
+            dims = source[vname].dims
+            array = group[vname]
+            for region in chunk_regions(array.shape, array.chunks):
+                if dim in dims:
+                    axis = dims.index(dim)
+                    start, stop = max(region[axis].start, offset), min(region[axis].stop, offset + source.sizes[dim])
+                    if start >= stop:
+                        continue
+                    region = region[:axis] + (slice(start, stop),) + region[axis + 1:]
+                    source_region = region[:axis] + (slice(start - offset, stop - offset),) + region[axis + 1:]
+                else:
+                    source_region = region
+                yield vname, region, source_region
+
+    total = sum(1 for _ in tasks())
+    logging.info("Verifying %d chunks with %d threads", total, workers)
+    with runreport.stage(report, "verify"), open(path, "w") as f, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        f.write(json.dumps({"store": zarr_dir, "rtol": rtol, "atol": atol, "dim": dim, "offset": offset}) + "\n")
+        pending = set()
+        todo = tasks()
+
+        def collect(done):
+            for future in done:
+                result = future.result()
+                f.write(json.dumps(result) + "\n")
+                summary["chunks"] += 1
+                summary["mismatches"] += result["mismatches"]
+                if not result["ok"]:
+                    summary["failed_chunks"] += 1
+                    logging.warning("%s %s differs in %d cells", result["variable"], result["region"],
+                                    result["mismatches"])
+            runreport.show_progress(report, "%d of %d chunks verified" % (summary["chunks"], total))
+
+        # at most two chunks per thread are queued, the results are written while the others are read
+        for vname, region, source_region in todo:
+            if len(pending) >= 2 * workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(check_chunk, stored, source, vname, region, source_region, rtols[vname], atol,
+                                    fill_values))
+        collect(concurrent.futures.as_completed(pending))
+    runreport.end_progress(report)
+
+    summary["ok"] = summary["failed_chunks"] == 0 and not summary["coords"]
+    if report is not None:
+        report.count("chunks_verified", summary["chunks"])
+        report.count("chunks_failed", summary["failed_chunks"])
+    if summary["coords"]:
+        logging.warning("Coordinates differ: %s", ", ".join(summary["coords"]))
+    print("%d of %d chunks match the source, hashes written to %s" % (
+        summary["chunks"] - summary["failed_chunks"], summary["chunks"], path))
+    return summary
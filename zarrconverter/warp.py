@@ -0,0 +1,68 @@
+# Reprojection of GeoTIFFs while they are read (what gdalwarp did in convert.bat).
+#
+# Instead of warping every file to an intermediate netCDF file one after the
+# other, the files are read through a GDAL warped VRT: every block of the lazy
+# cube (or every file of the direct writer) warps only its own window of the
+# target grid, in as many processes as there are workers, and the result goes
+# straight into the zarr store. The target grid is chosen like gdalwarp -t_srs
+# does it, from the grid of the first file, optionally with a given resolution.
+
+import functools
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window
+from zarrconverter import tiffscan
+
+def target_grid(header, crs, resolution=None):
+    """Transform, width and height of the grid of header in crs, the default grid of gdalwarp -t_srs"""
+    west, south, east, north = array_bounds(header.height, header.width, header.transform)
+    return calculate_default_transform(header.crs, crs, header.width, header.height, west, south, east, north,
+                                       resolution=resolution)
+
+def options(headers, crs, resolution=None, resampling="nearest", nodata=None):
+    """Arguments of WarpedVRT for all files, which have to share the grid of the first one
+
+    nodata is used for files without a nodata value, without any the cells
+    outside of the source grid become 0.
+    """
+    ref = tiffscan.check_grid(headers)
+    crs = CRS.from_user_input(crs)
+    transform, width, height = target_grid(ref, crs, resolution)
+    warp = {"crs": crs, "transform": transform, "width": width, "height": height,
+            "resampling": Resampling[resampling]}
+    # cells outside of the source get the fill value, so they are masked like missing data
+    nodata = ref.nodata if ref.nodata is not None else nodata
+    if nodata is not None:
+        warp.update(src_nodata=nodata, nodata=nodata)
+    return warp
+
+def warp_headers(headers, warp):
+    """Headers of the files as they look after warping to the grid of warp"""
+    return [header._replace(transform=warp["transform"], width=warp["width"], height=warp["height"],
+                            crs=warp["crs"], nodata=warp.get("nodata", header.nodata),
+                            block=(min(header.block[0], warp["height"]), min(header.block[1], warp["width"])))
+            for header in headers]
+
+def read_block(file, band, rows, cols, fill_values, dtype, warp=None):
+    """Read one band of a window of the warped file, replacing the fill values by NaN"""
+    window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+    with rasterio.Env(**tiffscan.GDAL_ENV), rasterio.open(file) as src, WarpedVRT(src, **warp) as vrt:
+        data = vrt.read(band, window=window)
+    if fill_values:
+        mask = np.isin(data, fill_values)
+        data = data.astype(dtype)
+        data[mask] = np.nan
+    return data[np.newaxis, np.newaxis]
+
+def open_cube(headers, warp, fill_values=None, chunks=None, y="y", x="x", window=None):
+    """Lazy DataArray (time, band, y, x) of the files warped to the grid of warp, see tiffscan.open_cube
+
+    window is a window of the warped grid, only its blocks are warped.
+    """
+    return tiffscan.open_cube(warp_headers(headers, warp), fill_values, chunks, y, x,
+                              reader=functools.partial(read_block, warp=warp), window=window)